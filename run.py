@@ -1,4 +1,11 @@
-from flask import Flask, render_template, Response, jsonify, request
+import time
+# Imports dominate a cold start; their cost is reported by /ready
+import_started = time.perf_counter()
+from flask import Flask, render_template, Response, jsonify, request, send_file
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 import cv2
 import numpy as np
 import os
@@ -6,6 +13,21 @@ import threading
 import torch
 import socket
 import logging
+import argparse
+import asyncio
+import io
+import re
+import sys
+import urllib.parse
+import json
+import queue
+import struct
+import atexit
+import bisect
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import_seconds = time.perf_counter() - import_started
 
 app = Flask(__name__)
 
@@ -14,163 +36,4010 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 # Global variables
-camera = None
-output_frame = None
-lock = threading.Lock()
 detection_enabled = True
 model = None
+class_names = np.array([], dtype=object)
+
+# Compact per-frame detection record handed from inference to the drawing code
+DETECTION_DTYPE = np.dtype([
+    ('x1', np.int32), ('y1', np.int32), ('x2', np.int32), ('y2', np.int32),
+    ('confidence', np.float32), ('class_id', np.int32), ('track_id', np.int32),
+])
+
+# Reference-counted frame buffer handed out by a FrameBufferPool. Every holder
+# calls retain() before keeping it and release() when done; the last release
+# returns the array to the pool instead of freeing it.
+class FrameBuffer:
+    def __init__(self, pool, array):
+        self.pool = pool
+        self.array = array
+        self.refs = 0
+
+    def retain(self):
+        with self.pool.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.pool.lock:
+            self.refs -= 1
+            if self.refs == 0:
+                self.pool.free.setdefault(self.array.shape, []).append(self)
+
+# Preallocated frame buffers keyed by shape. Capture reads straight into a
+# pooled buffer, and colour conversion and inference input reuse pooled
+# arrays, so once every shape in use has been seen the hot path allocates
+# no frame memory. allocations/acquires prove it: in steady state only
+# acquires keeps growing.
+class FrameBufferPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.free = {}
+        self.buffers = 0
+        self.acquires = 0
+        self.allocations = 0
+        self.last_allocation_at = 0
+
+    def acquire(self, shape, dtype=np.uint8):
+        shape = tuple(shape)
+        with self.lock:
+            self.acquires += 1
+            free = self.free.get(shape)
+            if free:
+                buffer = free.pop()
+                buffer.refs = 1
+                return buffer
+        return self.adopt(np.empty(shape, dtype=dtype))
+
+    # Take ownership of an array allocated outside the pool (e.g. the first
+    # frame of a new resolution) so it is recycled from now on
+    def adopt(self, array):
+        with self.lock:
+            self.buffers += 1
+            self.allocations += 1
+            self.last_allocation_at = self.acquires
+        buffer = FrameBuffer(self, array)
+        buffer.refs = 1
+        return buffer
+
+    def stats(self):
+        with self.lock:
+            return {
+                "buffers": self.buffers,
+                "free": sum(len(free) for free in self.free.values()),
+                "acquires": self.acquires,
+                "allocations": self.allocations,
+                "last_allocation_at_acquire": self.last_allocation_at,
+            }
+
+frame_pool = FrameBufferPool()
+
+# Frame travelling through the pipeline stages. It owns one reference to its
+# pooled buffer, which goes back to the pool when the packet is released.
+class FramePacket:
+    def __init__(self, index, frame, buffer=None, captured_at=None):
+        self.index = index
+        self.captured_at = time.monotonic() if captured_at is None else captured_at
+        self.timestamp = time.time()
+        self.frame = frame
+        self.buffer = buffer
+        self.detections = None
+
+    def release(self):
+        buffer, self.buffer = self.buffer, None
+        if buffer is not None:
+            buffer.release()
+
+# Bounded "latest-value" slot joining two pipeline stages. It only ever holds
+# the newest item: a put() over an unconsumed item replaces it and counts a drop,
+# so a slow consumer sees fresh frames instead of a backlog.
+class LatestSlot:
+    def __init__(self, name):
+        self.name = name
+        self.cond = threading.Condition()
+        self.item = None
+        self.closed = False
+        self.put_count = 0
+        self.get_count = 0
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if self.closed:
+                item.release()
+                return
+            if self.item is not None:
+                self.dropped += 1
+                self.item.release()
+            self.item = item
+            self.put_count += 1
+            self.cond.notify_all()
+
+    # Take the newest item, waiting up to timeout; None when closed or timed out
+    def get(self, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.item is not None or self.closed, timeout)
+            item, self.item = self.item, None
+            if item is not None:
+                self.get_count += 1
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            if self.item is not None:
+                self.item.release()
+            self.item = None
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {"put": self.put_count, "taken": self.get_count, "dropped": self.dropped}
+
+# Broadcast hub for a source's output: encoded JPEG frames or detection
+# messages. Each value is produced once and stored under a sequence number;
+# subscribers block on the condition until a newer sequence exists and always
+# jump straight to the newest value, so a slow viewer skips frames instead of
+# falling behind.
+class BroadcastHub:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.value = None
+        self.viewers = 0
+        # One pending future per asyncio loop with coroutines awaiting a value,
+        # so a publish costs one thread-safe wake-up per loop, not per client
+        self.async_wakeups = {}
+
+    def publish(self, value):
+        with self.cond:
+            self.seq += 1
+            self.value = value
+            self.cond.notify_all()
+            wakeups = list(self.async_wakeups.items())
+            self.async_wakeups.clear()
+        for loop, future in wakeups:
+            loop.call_soon_threadsafe(resolve_wakeup, future)
+
+    def clear(self):
+        with self.cond:
+            self.value = None
+            self.cond.notify_all()
+
+    def latest(self):
+        with self.cond:
+            return self.value
+
+    # Wait for a value newer than last_seq; returns (seq, value) or (last_seq, None) on timeout
+    def wait_newer(self, last_seq, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > last_seq and self.value is not None, timeout):
+                return last_seq, None
+            return self.seq, self.value
+
+    # Coroutine counterpart of wait_newer for the ASGI server
+    async def wait_newer_async(self, last_seq, timeout=None):
+        loop = asyncio.get_running_loop()
+        with self.cond:
+            if self.seq > last_seq and self.value is not None:
+                return self.seq, self.value
+            future = self.async_wakeups.get(loop)
+            if future is None:
+                future = self.async_wakeups[loop] = loop.create_future()
+        try:
+            # Shielded because the future is shared by every waiter on this loop
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self.cond:
+            if self.seq > last_seq and self.value is not None:
+                return self.seq, self.value
+            return last_seq, None
+
+def resolve_wakeup(future):
+    if not future.done():
+        future.set_result(None)
+
+# Latency histogram over fixed Prometheus-style buckets (seconds). observe()
+# is a bisect and three adds under an uncontended lock, so every stage can
+# record every frame without measurable cost.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    # Estimate a quantile by interpolating inside the bucket that holds it
+    def quantile(self, q, counts, count):
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+# Hot-path telemetry: a latency histogram per (stage, source) and monotonic
+# counters. Gauges such as FPS and viewers live on the objects they describe
+# and are read when /metrics is scraped.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    # Record how long a stage took; source is '' for stages shared by a batch
+    def observe(self, stage, seconds, source=''):
+        histogram = self.histograms.get((stage, source))
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault((stage, source), LatencyHistogram())
+        histogram.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Forget everything recorded so far, e.g. at the end of a benchmark warm-up
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    # Bucket counts, sum and count of a stage merged over every source
+    def stage_counts(self, stage):
+        with self.lock:
+            histograms = [histogram for (name, _), histogram in self.histograms.items() if name == stage]
+        counts, total, count = [0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0
+        for histogram in histograms:
+            bucket_counts, bucket_sum, bucket_count = histogram.snapshot()
+            counts = [a + b for a, b in zip(counts, bucket_counts)]
+            total += bucket_sum
+            count += bucket_count
+        return counts, total, count
+
+    def counter_totals(self, name):
+        with self.lock:
+            return {labels: value for (counter, labels), value in self.counters.items() if counter == name}
+
+    # Per-stage count, mean, p50 and p99 in milliseconds for /status
+    def stage_summary(self):
+        summary = {}
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        for (stage, source), histogram in histograms:
+            counts, total, count = histogram.snapshot()
+            summary.setdefault(stage, {})[source or 'all'] = {
+                "count": count,
+                "mean_ms": round(total / count * 1e3, 3) if count else 0.0,
+                "p50_ms": round(histogram.quantile(0.5, counts, count) * 1e3, 3),
+                "p99_ms": round(histogram.quantile(0.99, counts, count) * 1e3, 3),
+            }
+        return summary
+
+    # Histograms and counters in the Prometheus text exposition format
+    def render(self):
+        lines = ["# HELP yolo_stage_seconds Processing latency per pipeline stage",
+                 "# TYPE yolo_stage_seconds histogram"]
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        for (stage, source), histogram in histograms:
+            counts, total, count = histogram.snapshot()
+            labels = f'stage="{stage}",source="{source}"'
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'yolo_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'yolo_stage_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'yolo_stage_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'yolo_stage_seconds_count{{{labels}}} {count}')
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE yolo_{name}_total counter")
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"yolo_{name}_total{{{label_text}}} {value}")
+        return lines
+
+metrics = Metrics()
+
+# Cold-start progress: starting -> loading -> warming -> ready (or failed),
+# with the time each phase took and when the first frame came out
+class StartupState:
+    def __init__(self):
+        self.phase = 'starting'
+        self.error = None
+        self.timings = {"imports_s": round(import_seconds, 3)}
+        self.phase_started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.phase == 'ready'
+
+    # Enter a phase, recording how long the previous one took
+    def enter(self, phase):
+        with self.lock:
+            now = time.perf_counter()
+            if self.phase not in ('starting', 'ready', 'failed'):
+                self.timings[f"{self.phase}_s"] = round(now - self.phase_started, 3)
+            self.phase, self.phase_started = phase, now
+            if phase == 'ready':
+                self.timings["ready_after_s"] = round(now - import_started, 3)
+        logger.info(f"Startup: {phase}")
+
+    def fail(self, error):
+        self.enter('failed')
+        self.error = error
+
+    # Record a one-off timing (the first of its kind wins)
+    def mark(self, name, value=None):
+        if name not in self.timings:
+            self.timings[name] = round(time.perf_counter() - import_started if value is None else value, 3)
+
+    def status(self):
+        return {"ready": self.ready, "phase": self.phase, "error": self.error, "timings": dict(self.timings)}
+
+startup = StartupState()
+
+# Slots joining capture -> inference -> annotate -> encode. A fresh set is
+# created for every source start so stages left over from a previous run exit
+# on their own closed slots.
+def create_pipeline_slots():
+    return {name: LatestSlot(name) for name in ('capture', 'inference', 'annotate')}
+
+# Registered video sources by id; the web UI's camera is the default source
+DEFAULT_SOURCE_ID = '0'
+sources = {}
+sources_lock = threading.Lock()
+scheduler_threads = []
+model_lock = threading.Lock()
+# Set by capture stages whenever a new frame is waiting for the scheduler
+frames_ready = threading.Event()
+
+# Inference settings, overridden from the command line at startup
+config = {
+    'backend': 'torch',        # torch, torchscript, onnx, openvino or auto (first exported graph found)
+    'weights': 'yolov5s.pt',
+    'imgsz': 640,              # Network input size (fixed at export time for exported backends)
+    'detection_stride': 1,     # Run the detector every Nth frame, track in between
+    'optical_flow': False,     # Correct tracked boxes with sparse optical flow
+    'motion_gate': False,      # Skip the detector while the scene is static
+    'motion_threshold': 0.002, # Fraction of changed pixels that counts as motion
+    'motion_refresh': 10.0,    # Seconds between forced detector runs on a static scene
+    'camera': '0',             # Default source opened by /start_camera
+    'max_batch': 8,            # Most frames batched into one model call across sources
+    'source_fps_cap': 0,       # Default per-source inference FPS cap (0 = uncapped)
+    'workers': 0,              # Inference worker processes (0 = run in the server process)
+    'worker_max_frame': (1080, 1920),  # Largest frame a shared-memory slot holds; bigger frames are downscaled
+    'client_overlay': False,   # Ship raw frames and let browsers draw the boxes
+    'server': 'flask',         # flask (threaded WSGI) or asgi (asyncio, one coroutine per client)
+    'max_clients': 100,        # Concurrent stream clients accepted by the ASGI server
+    'client_send_timeout': 10.0,  # Seconds a stalled ASGI client may block before it is dropped
+    'jpeg_encoder': 'opencv',  # opencv, simplejpeg or turbojpeg
+    'jpeg_quality': 95,        # Quality of the default stream tier (OpenCV's default)
+    'max_tiers': 8,            # Distinct size/quality/fps stream tiers per source
+    'tile_size': 0,            # Split frames into overlapping tiles of this size (0 = whole frame)
+    'tile_overlap': 0.2,       # Fraction of a tile shared with its neighbour
+    'tile_full_frame': True,   # Add a whole-frame pass so objects larger than a tile are kept
+    'roi': [],                 # Default ROI polygons (normalized points) for sources without their own
+    'target_fps': 0.0,         # Adaptive controller FPS target (0 = off)
+    'target_latency_ms': 0.0,  # Adaptive controller p99 capture-to-output latency target (0 = off)
+    'controller_interval': 1.0,  # Seconds between controller decisions
+    'controller_cooldown': 2,  # Intervals to wait after a change before the next one
+    'pinned': [],              # Knobs the controller must leave alone
+    'stream_scale': 1.0,       # Scale applied to every stream tier's width (controller knob)
+    'stream_quality_cap': 100, # Upper bound on every stream tier's JPEG quality (controller knob)
+    'capture_api': 'auto',     # OpenCV capture backend for devices and streams (see CAPTURE_APIS)
+    'capture_buffer_size': 1,  # Frames the driver may queue for a live device
+    'capture_fourcc': 'MJPG',  # Pixel format requested from live devices ('' = driver default)
+    'capture_width': 0,        # Resolution requested from live devices (0 = driver default)
+    'capture_height': 0,
+    'capture_fps': 0.0,        # Frame rate requested from live devices (0 = driver default)
+    'capture_retry_delay': 0.1,  # First wait after a failed read; doubles on every further failure
+    'capture_retry_max': 5.0,  # Longest wait between reads of a failing source
+    'offline': False,          # Never reach the network for the yolov5 hub code
+    'warmup_runs': 3,          # Inferences run at boot before /ready reports ready (0 = load lazily)
+    'record_rules': [],        # Clip triggers: {"class", "confidence", "dwell"} (empty = no recording)
+    'record_dir': 'clips',     # Where clips are written
+    'pre_roll': 5.0,           # Seconds kept in memory and saved before a trigger
+    'post_roll': 5.0,          # Seconds recorded after the last trigger
+    'max_clip_seconds': 120.0, # Longest clip; a trigger that persists starts a new one
+    'record_ring_bytes': 64 << 20,  # Encoded pre-roll kept in memory per source
+    'record_max_bytes': 1 << 30,    # Clips on disk beyond this are deleted, oldest first
+    'record_size': 0,          # Width of recorded frames (0 = native)
+    'record_quality': 80,      # JPEG quality of recorded frames
+    'record_fps': 0.0,         # Recorded frame rate cap (0 = every frame)
+    'history_dir': '',         # Detection history store ('' = off)
+    'history_interval': 0.5,   # Seconds between frames logged per source (0 = every processed frame)
+    'history_segment_records': 1 << 20,  # Detections per memory-mapped segment file
+    'history_days': 30.0,      # Raw detection segments older than this are deleted
+    'port': 5000,              # Port shown in the on-frame access URL
+    'ip_refresh': 60.0,        # Seconds between re-resolving the server IP (sooner on interface changes)
+    'overlay_text': [],        # Extra static text lines drawn under the detection status
+    'quantize': 'none',        # INT8 ONNX graph the onnx backend loads: none, dynamic or static (see export --quantize)
+    'channels_last': False,    # NHWC memory format for the torch and torchscript backends
+    'intra_op_threads': 0,     # Threads one operator is split across (0 = runtime default)
+    'inter_op_threads': 0,     # Threads running independent operators in parallel (0 = runtime default)
+    'inference_cores': [],     # CPU cores inference is pinned to; other threads get the rest (empty = no pinning)
+    'remote_servers': [],      # (host, port) of inference servers; frames go there instead of a local model
+    'remote_max_in_flight': 4, # Requests outstanding per inference server
+    'remote_timeout': 2.0,     # Seconds to wait for a reply before retrying elsewhere
+    'remote_quality': 90,      # JPEG quality of frames sent to inference servers
+    'remote_fallback': True,   # Run frames no server takes on the local model, if its files are present
+    'remote_retry_max': 5.0,   # Longest wait between reconnects to an unreachable server
+}
+
+INFERENCE_BACKENDS = ('torch', 'torchscript', 'onnx', 'openvino')
+QUANTIZE_MODES = ('none', 'dynamic', 'static')
+
+# Path of the artifact a backend loads, derived from the .pt weights the
+# same way yolov5's export.py names its outputs. The onnx backend loads the
+# INT8 graph for the configured quantization mode.
+def engine_artifact(backend, weights, quantize=None):
+    stem = os.path.splitext(weights)[0]
+    if backend == 'torchscript':
+        return stem + '.torchscript'
+    if backend == 'onnx':
+        quantize = quantize or config['quantize']
+        return stem + (f'.int8-{quantize}.onnx' if quantize != 'none' else '.onnx')
+    if backend == 'openvino':
+        return os.path.join(stem + '_openvino_model', os.path.basename(stem) + '.xml')
+    return weights
+
+# Class names, stride and input size written next to the exported artifacts
+def export_metadata_path(weights):
+    return os.path.splitext(weights)[0] + '.export.json'
+
+# Load the yolov5 AutoShape model, using the local torch hub checkout when one
+# exists. Offline, a missing checkout is an error instead of a download.
+def load_hub_model(weights):
+    repo_dir = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+    if config['offline']:
+        # Stop yolov5 from pip-installing missing requirements
+        os.environ['YOLOv5_AUTOINSTALL'] = 'False'
+    if os.path.isdir(repo_dir):
+        return torch.hub.load(repo_dir, 'custom', path=weights, source='local')
+    if config['offline']:
+        raise RuntimeError(f"No yolov5 checkout in {repo_dir}; run once online or use an exported backend")
+    return torch.hub.load('ultralytics/yolov5', 'custom', path=weights)
+
+# Backend for 'auto': the first exported graph next to the weights whose
+# runtime is installed, since those load without the hub code or tracing.
+# Falls back to torch.
+def resolve_backend(backend, weights):
+    if backend != 'auto':
+        return backend
+    import importlib.util
+    runtimes = {'onnx': 'onnxruntime', 'openvino': 'openvino', 'torchscript': 'torch'}
+    for candidate in ('onnx', 'openvino', 'torchscript'):
+        if os.path.exists(engine_artifact(candidate, weights)) and importlib.util.find_spec(runtimes[candidate]):
+            return candidate
+    return 'torch'
+
+# Thread and core settings for inference, applied once at startup before
+# any other thread exists. With inference_cores set, the process moves to
+# the remaining cores so capture, encoding and HTTP threads inherit those,
+# and inference threads pin themselves with pin_inference_thread().
+def configure_cpu():
+    if config['intra_op_threads']:
+        torch.set_num_threads(config['intra_op_threads'])
+    if config['inter_op_threads']:
+        try:
+            torch.set_num_interop_threads(config['inter_op_threads'])
+        except RuntimeError as e:
+            logger.warning(f"Could not set inter-op threads: {str(e)}")
+    cores = set(config['inference_cores'])
+    if cores and hasattr(os, 'sched_setaffinity'):
+        others = os.sched_getaffinity(0) - cores
+        if others:
+            os.sched_setaffinity(0, others)
+        logger.info(f"Inference pinned to cores {sorted(cores)}, other threads to {sorted(others) or 'all'}")
+
+# Pin the calling thread to the inference cores. Runtime thread pools the
+# thread creates afterwards (OpenMP, ONNX Runtime) inherit the mask.
+# Returns the previous mask so a borrowed thread can be restored.
+def pin_inference_thread():
+    if not config['inference_cores'] or not hasattr(os, 'sched_setaffinity'):
+        return None
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, config['inference_cores'])
+    return previous
+
+def cpu_status():
+    return {
+        "intra_op_threads": torch.get_num_threads(),
+        "inter_op_threads": torch.get_num_interop_threads(),
+        "inference_cores": config['inference_cores'],
+        "quantize": config['quantize'],
+        "channels_last": config['channels_last'],
+    }
+
+# Parse a core list such as "0-3,6"
+def parse_cpu_list(text):
+    cores = []
+    for part in filter(None, text.split(',')):
+        first, _, last = part.partition('-')
+        cores.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(cores))
+
+# Resize and pad a frame to a square network input keeping its aspect ratio,
+# writing into out when given. Returns the padded image, the scale ratio and
+# the (left, top) padding.
+def letterbox(frame, size, color=(114, 114, 114), out=None):
+    height, width = frame.shape[:2]
+    ratio = min(size / height, size / width)
+    new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+    left, top = (size - new_width) // 2, (size - new_height) // 2
+    
+    if out is None:
+        out = np.empty((size, size, 3), dtype=np.uint8)
+    # Paint only the borders, the resize fills the rest in place
+    out[:top] = color
+    out[top + new_height:] = color
+    out[top:top + new_height, :left] = color
+    out[top:top + new_height, left + new_width:] = color
+    inner = out[top:top + new_height, left:left + new_width]
+    if (new_width, new_height) != (width, height):
+        cv2.resize(frame, (new_width, new_height), dst=inner, interpolation=cv2.INTER_LINEAR)
+    else:
+        inner[...] = frame
+    return out, ratio, (left, top)
+
+# Greedy IoU suppression over xyxy boxes; returns the kept indices by descending score
+def nms_indices(boxes, scores, iou_threshold):
+    order = scores.argsort()[::-1]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        xx1 = np.maximum(boxes[best, 0], boxes[rest, 0])
+        yy1 = np.maximum(boxes[best, 1], boxes[rest, 1])
+        xx2 = np.minimum(boxes[best, 2], boxes[rest, 2])
+        yy2 = np.minimum(boxes[best, 3], boxes[rest, 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        iou = inter / (areas[best] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+# Decode one image's raw YOLOv5 output (rows of cx, cy, w, h, objectness,
+# class scores) into an (n, 6) xyxy/confidence/class array after NMS
+def non_max_suppression(prediction, conf_threshold, iou_threshold, classes=None, max_det=300):
+    prediction = prediction[prediction[:, 4] > conf_threshold]
+    scores = prediction[:, 5:] * prediction[:, 4:5]
+    class_ids = scores.argmax(axis=1)
+    confidences = scores[np.arange(len(scores)), class_ids]
+    
+    mask = confidences > conf_threshold
+    if classes is not None:
+        mask &= np.isin(class_ids, classes)
+    prediction, class_ids, confidences = prediction[mask], class_ids[mask], confidences[mask]
+    if not len(prediction):
+        return np.zeros((0, 6), dtype=np.float32)
+    
+    boxes = np.empty((len(prediction), 4), dtype=np.float32)
+    boxes[:, :2] = prediction[:, :2] - prediction[:, 2:4] / 2
+    boxes[:, 2:] = prediction[:, :2] + prediction[:, 2:4] / 2
+    
+    # Offset boxes by class so a single pass suppresses within each class only
+    offsets = class_ids[:, None].astype(np.float32) * 4096
+    keep = nms_indices(boxes + offsets, confidences, iou_threshold)[:max_det]
+    return np.hstack([boxes[keep], confidences[keep, None], class_ids[keep, None]]).astype(np.float32)
+
+# Common interface of every inference backend: takes BGR frames and returns one
+# DETECTION_DTYPE array per frame. conf/iou/classes/max_det mirror the
+# attributes of the yolov5 AutoShape model.
+class InferenceEngine:
+    name = 'base'
+    
+    def __init__(self):
+        self.names = []
+        self.conf = 0.45
+        self.iou = 0.45
+        self.classes = None
+        self.max_det = 50
+        self.input_size = config['imgsz']
+    
+    # Whether input_size can change at runtime (exported graphs have a fixed shape)
+    supports_input_size = False
+    
+    def __call__(self, frame):
+        return self.infer_batch([frame])[0]
+    
+    def infer_batch(self, frames):
+        raise NotImplementedError
+
+# Eager PyTorch through the yolov5 AutoShape wrapper, which does its own
+# letterboxing and NMS
+class TorchEngine(InferenceEngine):
+    name = 'torch'
+    supports_input_size = True
+    
+    def __init__(self, weights):
+        super().__init__()
+        self.model = load_hub_model(weights)
+        if config['channels_last']:
+            self.model.to(memory_format=torch.channels_last)
+        self.names = self.model.names
+    
+    def infer_batch(self, frames):
+        self.model.conf, self.model.iou = self.conf, self.iou
+        self.model.classes, self.model.max_det = self.classes, self.max_det
+        # Convert BGR to RGB (YOLOv5 expects RGB) into pooled buffers
+        buffers = [frame_pool.acquire(frame.shape) for frame in frames]
+        try:
+            start = time.perf_counter()
+            for frame, buffer in zip(frames, buffers):
+                cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=buffer.array)
+            converted = time.perf_counter()
+            # AutoShape letterboxes and runs NMS inside this call
+            results = self.model([buffer.array for buffer in buffers], size=self.input_size)
+            forwarded = time.perf_counter()
+        finally:
+            for buffer in buffers:
+                buffer.release()
+        detections = [detections_from_xyxy(xyxy) for xyxy in results.xyxy]
+        metrics.observe('preprocess', converted - start)
+        metrics.observe('forward', forwarded - converted)
+        metrics.observe('postprocess', time.perf_counter() - forwarded)
+        return detections
+
+# Backends that run a bare exported graph and need their own letterbox and NMS
+class ExportedEngine(InferenceEngine):
+    def __init__(self, weights, imgsz):
+        super().__init__()
+        self.imgsz = imgsz
+        metadata_path = export_metadata_path(weights)
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            self.names = metadata['names']
+            self.imgsz = metadata.get('imgsz', imgsz)
+        else:
+            logger.warning(f"Missing {metadata_path}, class names will be numeric")
+        self.padded = np.empty((self.imgsz, self.imgsz, 3), dtype=np.uint8)
+        self.channels_last = False
+        self.input_buffers = {}
+        self.buffer_lock = threading.Lock()
+    
+    # Letterbox a batch into the network input tensor. The padded image and
+    # the input tensor for each batch size are allocated once and reused.
+    def preprocess(self, frames):
+        batch = self.input_buffers.get(len(frames))
+        if batch is None:
+            if self.channels_last:
+                # NHWC storage viewed as NCHW, which torch takes as a channels-last tensor without a copy
+                batch = np.empty((len(frames), self.imgsz, self.imgsz, 3), dtype=np.float32).transpose(0, 3, 1, 2)
+            else:
+                batch = np.empty((len(frames), 3, self.imgsz, self.imgsz), dtype=np.float32)
+            self.input_buffers[len(frames)] = batch
+        transforms = []
+        for i, frame in enumerate(frames):
+            padded, ratio, pad = letterbox(frame, self.imgsz, out=self.padded)
+            # BGR HWC uint8 -> RGB CHW float in [0, 1]
+            np.multiply(padded[:, :, ::-1].transpose(2, 0, 1), 1 / 255.0, out=batch[i], casting='unsafe')
+            transforms.append((ratio, pad))
+        return batch, transforms
+    
+    def forward(self, batch):
+        raise NotImplementedError
+    
+    def infer_batch(self, frames):
+        # The reused input buffers allow one batch at a time
+        with self.buffer_lock:
+            start = time.perf_counter()
+            batch, transforms = self.preprocess(frames)
+            preprocessed = time.perf_counter()
+            predictions = self.forward(batch)
+            forwarded = time.perf_counter()
+        metrics.observe('preprocess', preprocessed - start)
+        metrics.observe('forward', forwarded - preprocessed)
+        
+        results = []
+        for frame, prediction, (ratio, (left, top)) in zip(frames, predictions, transforms):
+            xyxy = non_max_suppression(prediction, self.conf, self.iou, self.classes, self.max_det)
+            # Undo the letterbox and clip to the frame
+            xyxy[:, [0, 2]] = np.clip((xyxy[:, [0, 2]] - left) / ratio, 0, frame.shape[1])
+            xyxy[:, [1, 3]] = np.clip((xyxy[:, [1, 3]] - top) / ratio, 0, frame.shape[0])
+            results.append(detections_from_xyxy(xyxy))
+        metrics.observe('postprocess', time.perf_counter() - forwarded)
+        return results
+
+class TorchScriptEngine(ExportedEngine):
+    name = 'torchscript'
+    
+    def __init__(self, weights, imgsz):
+        super().__init__(weights, imgsz)
+        self.module = torch.jit.load(engine_artifact('torchscript', weights), map_location='cpu').eval()
+        if config['channels_last']:
+            self.module.to(memory_format=torch.channels_last)
+            self.channels_last = True
+    
+    def forward(self, batch):
+        with torch.inference_mode():
+            output = self.module(torch.from_numpy(batch))
+        if isinstance(output, (list, tuple)):
+            output = output[0]
+        return output.numpy()
+
+class OnnxEngine(ExportedEngine):
+    name = 'onnx'
+    
+    def __init__(self, weights, imgsz):
+        super().__init__(weights, imgsz)
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = config['intra_op_threads']
+        options.inter_op_num_threads = config['inter_op_threads']
+        if config['inter_op_threads'] > 1:
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        self.session = onnxruntime.InferenceSession(engine_artifact('onnx', weights), options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+    
+    def forward(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+class OpenVinoEngine(ExportedEngine):
+    name = 'openvino'
+    
+    def __init__(self, weights, imgsz):
+        super().__init__(weights, imgsz)
+        import openvino
+        core = openvino.Core()
+        if config['intra_op_threads']:
+            core.set_property('CPU', {'INFERENCE_NUM_THREADS': config['intra_op_threads']})
+        self.compiled = core.compile_model(core.read_model(engine_artifact('openvino', weights)), 'CPU')
+        self.output = self.compiled.output(0)
+    
+    def forward(self, batch):
+        return self.compiled(batch)[self.output]
+
+# Create the inference engine for a backend name
+def create_engine(backend, weights, imgsz):
+    backend = resolve_backend(backend, weights)
+    if backend == 'torch':
+        return TorchEngine(weights)
+    engines = {'torchscript': TorchScriptEngine, 'onnx': OnnxEngine, 'openvino': OpenVinoEngine}
+    if backend not in engines:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    return engines[backend](weights, imgsz)
+
+# Export the .pt weights to TorchScript, ONNX and/or OpenVINO IR without
+# needing network access beyond the local hub checkout
+def export_model(weights, formats, imgsz=640):
+    logger.info(f"Loading {weights} for export...")
+    hub_model = load_hub_model(weights)
+    net = hub_model.model
+    if type(net).__name__ == 'DetectMultiBackend':
+        net = net.model
+    net = net.float().eval()
+    for module in net.modules():
+        # Make the Detect head return only the decoded predictions
+        if type(module).__name__ == 'Detect':
+            module.inplace = False
+            module.export = True
+    
+    names = hub_model.names
+    if isinstance(names, dict):
+        names = [names[i] for i in sorted(names)]
+    with open(export_metadata_path(weights), 'w') as f:
+        json.dump({'names': list(names), 'imgsz': imgsz, 'stride': int(net.stride.max())}, f)
+    
+    dummy = torch.zeros(1, 3, imgsz, imgsz)
+    with torch.no_grad():
+        net(dummy)  # Build the anchor grids before tracing
+    
+    outputs = []
+    if 'torchscript' in formats:
+        path = engine_artifact('torchscript', weights)
+        with torch.no_grad():
+            traced = torch.jit.trace(net, dummy, strict=False)
+        traced.save(path)
+        outputs.append(path)
+    
+    if 'onnx' in formats or 'openvino' in formats:
+        import inspect
+        path = engine_artifact('onnx', weights)
+        extra = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+        torch.onnx.export(net, dummy, path, opset_version=12, input_names=['images'], output_names=['output0'],
+                          dynamic_axes={'images': {0: 'batch'}, 'output0': {0: 'batch'}}, **extra)
+        outputs.append(path)
+        
+        if 'openvino' in formats:
+            import openvino
+            path = engine_artifact('openvino', weights)
+            openvino.save_model(openvino.convert_model(engine_artifact('onnx', weights)), path)
+            outputs.append(path)
+    
+    for path in outputs:
+        logger.info(f"Exported {path}")
+    return outputs
+
+# INT8 copies of the exported ONNX graph for the onnx backend. Only the
+# convolutions are quantized; the Detect head's box decoding stays in float
+# so coordinates keep their precision. Dynamic quantization measures
+# activation ranges on every inference; static quantization calibrates them
+# once on sample images, letterboxed the way ExportedEngine feeds the graph.
+def quantize_model(weights, modes, calibration_dir=None, imgsz=640, limit=100):
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_dynamic, quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+    source = engine_artifact('onnx', weights, 'none')
+    if not os.path.exists(source):
+        raise RuntimeError(f"Missing {source}; export the onnx format first")
+    metadata_path = export_metadata_path(weights)
+    if os.path.exists(metadata_path):
+        # Calibrate at the size the graph was exported with
+        with open(metadata_path) as f:
+            imgsz = json.load(f).get('imgsz', imgsz)
+    # Fold constants and infer shapes so the quantizer sees every tensor
+    prepared = os.path.splitext(source)[0] + '.prepared.onnx'
+    quant_pre_process(source, prepared)
+    
+    outputs = []
+    try:
+        if 'dynamic' in modes:
+            path = engine_artifact('onnx', weights, 'dynamic')
+            quantize_dynamic(prepared, path, op_types_to_quantize=['Conv'], weight_type=QuantType.QUInt8)
+            outputs.append(path)
+        
+        if 'static' in modes:
+            if not calibration_dir:
+                raise ValueError("Static quantization needs calibration images")
+            paths = sorted(os.path.join(calibration_dir, name) for name in os.listdir(calibration_dir)
+                           if name.lower().endswith(ImageSequenceCapture.EXTENSIONS))[:limit]
+            if not paths:
+                raise ValueError(f"No calibration images found in {calibration_dir}")
+            
+            class CalibrationImages(CalibrationDataReader):
+                def __init__(self):
+                    self.paths = iter(paths)
+                    self.padded = np.empty((imgsz, imgsz, 3), dtype=np.uint8)
+                
+                def get_next(self):
+                    for path in self.paths:
+                        image = cv2.imread(path)
+                        if image is None:
+                            continue
+                        padded, _, _ = letterbox(image, imgsz, out=self.padded)
+                        batch = np.empty((1, 3, imgsz, imgsz), dtype=np.float32)
+                        np.multiply(padded[:, :, ::-1].transpose(2, 0, 1), 1 / 255.0, out=batch[0], casting='unsafe')
+                        return {'images': batch}
+                    return None
+            
+            logger.info(f"Calibrating on {len(paths)} images...")
+            path = engine_artifact('onnx', weights, 'static')
+            quantize_static(prepared, path, CalibrationImages(), quant_format=QuantFormat.QDQ,
+                            op_types_to_quantize=['Conv'], per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+            outputs.append(path)
+    finally:
+        os.remove(prepared)
+    
+    for path in outputs:
+        logger.info(f"Quantized {path}")
+    return outputs
+
+# Fixed-shape frame ring in shared memory. Each slot holds one frame of up to
+# max_height x max_width plus room for max_det detection records, so frames and
+# results cross the process boundary without pickling; only slot numbers and
+# counts travel through the queues.
+class SharedFrameRing:
+    def __init__(self, slots, max_height, max_width, max_det, name=None):
+        self.shape = (slots, max_height, max_width, max_det)
+        frame_bytes = slots * max_height * max_width * 3
+        # Keep the detection records cache-line aligned after the frames
+        self.detections_offset = (frame_bytes + 63) // 64 * 64
+        size = self.detections_offset + slots * max_det * DETECTION_DTYPE.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.frames = np.ndarray((slots, max_height, max_width, 3), dtype=np.uint8, buffer=self.shm.buf)
+        self.detections = np.ndarray((slots, max_det), dtype=DETECTION_DTYPE, buffer=self.shm.buf,
+                                     offset=self.detections_offset)
+
+    def close(self, unlink=False):
+        self.frames = self.detections = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+# Body of an inference worker process: attach to the ring, load its own
+# engine and answer (task_id, [(slot, height, width), ...]) requests
+def inference_process_main(ring_name, ring_shape, task_queue, result_queue, worker_config, threads, cores):
+    config.update(worker_config, intra_op_threads=threads, inference_cores=cores)
+    configure_cpu()
+    pin_inference_thread()
+    ring = SharedFrameRing(*ring_shape, name=ring_name)
+    try:
+        engine = create_engine(config['backend'], config['weights'], config['imgsz'])
+        result_queue.put(('ready', engine.names))
+    except Exception as e:
+        result_queue.put(('error', str(e)))
+        ring.close()
+        return
+    
+    max_det = ring_shape[3]
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, frames, settings = task
+        engine.conf, engine.iou, engine.classes, engine.max_det, engine.input_size = settings
+        try:
+            results = engine.infer_batch([ring.frames[slot, :height, :width] for slot, height, width in frames])
+            counts = []
+            for (slot, _, _), detections in zip(frames, results):
+                count = min(len(detections), max_det)
+                ring.detections[slot, :count] = detections[:count]
+                counts.append(count)
+            result_queue.put((task_id, counts))
+        except Exception as e:
+            result_queue.put((task_id, str(e)))
+    ring.close()
+
+# Pool of inference worker processes fed through a SharedFrameRing. It has
+# the InferenceEngine interface, so the scheduler uses it like a local engine;
+# each infer_batch() call is split across the workers and several calls may
+# be in flight at once from different scheduler threads.
+class InferenceWorkerPool(InferenceEngine):
+    name = 'process-pool'
+    
+    def __init__(self, workers, max_height=1080, max_width=1920, slots_per_worker=None, max_det=300):
+        super().__init__()
+        context = multiprocessing.get_context('spawn')
+        slots = workers * (slots_per_worker or config['max_batch'])
+        self.workers = workers
+        self.ring = SharedFrameRing(slots, max_height, max_width, max_det)
+        # The workers' engines are torch ones exactly when the backend is
+        self.supports_input_size = config['backend'] == 'torch'
+        self.free_slots = queue.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.next_task = 0
+        self.tasks_done = 0
+        
+        # Split the cores between the worker processes
+        cores = config['inference_cores']
+        shares = [[int(core) for core in share] for share in np.array_split(cores, workers)] if cores else [[]] * workers
+        threads = config['intra_op_threads'] or max(len(cores or range(os.cpu_count() or 1)) // workers, 1)
+        worker_config = {key: config[key] for key in ('backend', 'weights', 'imgsz', 'quantize', 'channels_last',
+                                                     'inter_op_threads')}
+        self.processes = [
+            context.Process(target=inference_process_main, name=f"inference-{i}", daemon=True,
+                            args=(self.ring.shm.name, self.ring.shape, self.task_queue, self.result_queue, worker_config,
+                                  threads, shares[i]))
+            for i in range(workers)
+        ]
+        for process in self.processes:
+            process.start()
+        for _ in range(workers):
+            status, payload = self.result_queue.get()
+            if status == 'error':
+                self.close()
+                raise RuntimeError(f"Inference worker failed to start: {payload}")
+            self.names = payload
+        
+        threading.Thread(target=self.collect_results, name='inference-pool-results', daemon=True).start()
+        atexit.register(self.close)
+    
+    # Route worker replies to the infer_batch() call waiting for them
+    def collect_results(self):
+        while True:
+            try:
+                task_id, counts = self.result_queue.get()
+            except (EOFError, OSError):
+                break
+            with self.pending_lock:
+                entry = self.pending.pop(task_id, None)
+            if entry is not None:
+                entry[1] = counts
+                entry[0].set()
+    
+    def infer_batch(self, frames):
+        slots = [self.free_slots.get() for _ in frames]
+        try:
+            max_height, max_width = self.ring.shape[1:3]
+            entries, scales = [], []
+            for slot, frame in zip(slots, frames):
+                height, width = frame.shape[:2]
+                scale = min(max_height / height, max_width / width, 1.0)
+                if scale < 1.0:
+                    frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+                    height, width = frame.shape[:2]
+                self.ring.frames[slot, :height, :width] = frame
+                entries.append((slot, height, width))
+                scales.append(scale)
+            
+            # One task per worker, each a contiguous share of the batch
+            settings = (self.conf, self.iou, self.classes, self.max_det, self.input_size)
+            chunk = -(-len(entries) // self.workers)
+            tasks = []
+            for start in range(0, len(entries), chunk):
+                with self.pending_lock:
+                    task_id = self.next_task
+                    self.next_task += 1
+                    entry = self.pending[task_id] = [threading.Event(), None]
+                tasks.append(entry)
+                self.task_queue.put((task_id, entries[start:start + chunk], settings))
+            
+            counts = []
+            for event, _ in tasks:
+                event.wait()
+            for _, result in tasks:
+                if isinstance(result, str):
+                    raise RuntimeError(result)
+                counts.extend(result)
+            self.tasks_done += len(tasks)
+            
+            results = []
+            for slot, count, scale in zip(slots, counts, scales):
+                detections = self.ring.detections[slot, :count].copy()
+                if scale < 1.0:
+                    for key in ('x1', 'y1', 'x2', 'y2'):
+                        detections[key] = (detections[key] / scale).astype(np.int32)
+                results.append(detections)
+            return results
+        finally:
+            for slot in slots:
+                self.free_slots.put(slot)
+    
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "alive": sum(process.is_alive() for process in self.processes),
+            "tasks_done": self.tasks_done,
+            "in_flight": len(self.pending),
+            "free_slots": self.free_slots.qsize(),
+        }
+    
+    def close(self):
+        if self.ring is None:
+            return
+        for process in self.processes:
+            if process.is_alive():
+                self.task_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+        self.ring.close(unlink=True)
+        self.ring = None
+
+# Wire protocol between capture nodes and inference servers (serve-inference).
+# Every message is a header (magic, kind, request id, payload bytes) and a
+# payload. On connect the server sends HELLO with its class names and
+# capabilities as JSON. The client then sends FRAME messages, the detection
+# settings followed by a JPEG, and gets a DETECTIONS reply (DETECTION_DTYPE
+# rows) or an ERROR message for each request id. Requests are pipelined, so
+# several may be in flight on one connection and replies come back in any
+# order.
+REMOTE_MAGIC = b'YLO1'
+REMOTE_HEADER = struct.Struct('<4sBII')
+# conf, iou, max_det, input size, number of class filter ids that follow
+REMOTE_SETTINGS = struct.Struct('<ffHHH')
+REMOTE_HELLO, REMOTE_FRAME, REMOTE_DETECTIONS, REMOTE_ERROR = 1, 2, 3, 4
+
+def send_message(sock, kind, request_id, *parts):
+    sock.sendall(b''.join([REMOTE_HEADER.pack(REMOTE_MAGIC, kind, request_id, sum(len(part) for part in parts)), *parts]))
+
+def recv_exact(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("Connection closed by peer")
+        view = view[received:]
+    return data
+
+def recv_message(sock):
+    magic, kind, request_id, size = REMOTE_HEADER.unpack(recv_exact(sock, REMOTE_HEADER.size))
+    if magic != REMOTE_MAGIC:
+        raise ConnectionError("Not an inference protocol peer")
+    return kind, request_id, recv_exact(sock, size)
+
+def parse_address(text, default_port=6000):
+    host, _, port = text.rpartition(':') if ':' in text else (text, '', default_port)
+    return host or '127.0.0.1', int(port)
+
+# Inference server for capture nodes (python run.py serve-inference). A
+# reader thread per connection decodes the incoming JPEGs, and frames from
+# every connection are batched into model calls of up to max_batch frames.
+# The model is the one load_model() builds, so --workers, --backend and the
+# CPU options all apply.
+class InferenceServer:
+    def __init__(self, host, port):
+        self.listener = socket.create_server((host, port))
+        self.requests = queue.Queue()
+        self.connections = 0
+        self.frames_done = 0
+    
+    def serve(self):
+        # One batch loop per inference worker process, or one for an in-process engine
+        for i in range(max(config['workers'], 1)):
+            threading.Thread(target=self.run_batches, name=f"inference-server-batch-{i}", daemon=True).start()
+        while True:
+            conn, address = self.listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.handle, args=(conn, address), daemon=True).start()
+    
+    def handle(self, conn, address):
+        send_lock = threading.Lock()
+        self.connections += 1
+        logger.info(f"Capture node {address[0]}:{address[1]} connected")
+        try:
+            hello = {"names": [str(name) for name in class_names.tolist()], "backend": model.name,
+                     "supports_input_size": model.supports_input_size, "max_batch": config['max_batch']}
+            send_message(conn, REMOTE_HELLO, 0, json.dumps(hello).encode())
+            while True:
+                kind, request_id, payload = recv_message(conn)
+                if kind != REMOTE_FRAME:
+                    raise ConnectionError(f"Unexpected message kind {kind}")
+                conf, iou, max_det, input_size, class_count = REMOTE_SETTINGS.unpack_from(payload)
+                offset = REMOTE_SETTINGS.size
+                classes = list(struct.unpack_from(f'<{class_count}H', payload, offset)) if class_count else None
+                frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8, offset=offset + 2 * class_count), cv2.IMREAD_COLOR)
+                if frame is None:
+                    with send_lock:
+                        send_message(conn, REMOTE_ERROR, request_id, b"Could not decode frame")
+                    continue
+                self.requests.put((conn, send_lock, request_id, frame, (conf, iou, classes, max_det, input_size)))
+        except (ConnectionError, OSError) as e:
+            logger.info(f"Capture node {address[0]}:{address[1]} disconnected: {str(e)}")
+        finally:
+            self.connections -= 1
+            conn.close()
+    
+    def run_batches(self):
+        pin_inference_thread()
+        while True:
+            batch = [self.requests.get()]
+            while len(batch) < config['max_batch']:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            # Frames with the same settings share a model call
+            groups = {}
+            for item in batch:
+                conf, iou, classes, max_det, input_size = item[4]
+                groups.setdefault((conf, iou, tuple(classes or ()), max_det, input_size), []).append(item)
+            for (conf, iou, classes, max_det, input_size), items in groups.items():
+                model.conf, model.iou, model.classes, model.max_det = conf, iou, list(classes) or None, max_det
+                if model.supports_input_size:
+                    model.input_size = input_size
+                try:
+                    replies = [(REMOTE_DETECTIONS, np.ascontiguousarray(detections).tobytes())
+                               for detections in model.infer_batch([item[3] for item in items])]
+                except Exception as e:
+                    logger.error(f"Detection error: {str(e)}")
+                    replies = [(REMOTE_ERROR, str(e).encode())] * len(items)
+                self.frames_done += len(items)
+                for (conn, send_lock, request_id, _, _), (kind, payload) in zip(items, replies):
+                    try:
+                        with send_lock:
+                            send_message(conn, kind, request_id, payload)
+                    except OSError:
+                        pass  # The capture node went away; its reader thread cleans up
+
+# Serve inference to capture nodes until interrupted
+def run_inference_server(listen):
+    host, port = parse_address(listen)
+    if not check_model_file() or ensure_model() is None:
+        return
+    server = InferenceServer(host, port)
+    logger.info(f"Inference server listening on {host}:{port} ({model.name} backend)")
+    server.serve()
+
+# Connection from a capture node to one inference server. Its requests
+# waiting for a reply live in pending, guarded by the pool's condition.
+class RemoteServer:
+    def __init__(self, address, slots):
+        self.address = address
+        self.slots = slots
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.hello = None
+        self.latency = None  # Moving average of the reply time in seconds
+        self.sent = 0
+        self.failures = 0
+        self.retry_at = 0.0
+        self.retry_delay = config['capture_retry_delay']
+        self.closed = False
+    
+    @property
+    def connected(self):
+        return self.sock is not None
+    
+    def connect(self):
+        sock = socket.create_connection(self.address, timeout=config['remote_timeout'])
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            kind, _, payload = recv_message(sock)
+            if kind != REMOTE_HELLO:
+                raise ConnectionError("No greeting from inference server")
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        self.hello = json.loads(payload)
+        self.retry_delay = config['capture_retry_delay']
+        with self.slots:
+            self.sock = sock
+            self.slots.notify_all()
+        threading.Thread(target=self.read_replies, args=(sock,), name=f"remote-{self.address[0]}:{self.address[1]}",
+                         daemon=True).start()
+    
+    def read_replies(self, sock):
+        try:
+            while True:
+                kind, request_id, payload = recv_message(sock)
+                with self.slots:
+                    entry = self.pending.pop(request_id, None)
+                    self.slots.notify_all()
+                if entry is None:
+                    continue  # Timed out already
+                elapsed = time.monotonic() - entry[2]
+                self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+                if kind == REMOTE_DETECTIONS:
+                    entry[1] = np.frombuffer(payload, dtype=DETECTION_DTYPE).copy()
+                else:
+                    entry[1] = RuntimeError(payload.decode(errors='replace'))
+                entry[0].set()
+        except (ConnectionError, OSError) as e:
+            self.disconnect(sock, str(e))
+    
+    # Drop the connection and fail its pending requests so they are retried
+    # elsewhere. Reconnects back off exponentially like a failing capture.
+    def disconnect(self, sock, reason):
+        with self.slots:
+            if sock is None or self.sock is not sock:
+                return
+            self.sock = None
+            failed, self.pending = self.pending, {}
+            self.failures += 1
+            self.retry_at = time.monotonic() + self.retry_delay
+            self.retry_delay = min(self.retry_delay * 2, config['remote_retry_max'])
+            self.slots.notify_all()
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for entry in failed.values():
+            entry[1] = ConnectionError(reason)
+            entry[0].set()
+        if not self.closed:
+            logger.warning(f"Inference server {self.address[0]}:{self.address[1]} dropped: {reason}")
+    
+    def send(self, request_id, payload):
+        sock = self.sock
+        try:
+            with self.send_lock:
+                send_message(sock, REMOTE_FRAME, request_id, *payload)
+            self.sent += 1
+        except (AttributeError, OSError) as e:
+            self.disconnect(sock, str(e))
+    
+    def stats(self):
+        return {
+            "address": f"{self.address[0]}:{self.address[1]}",
+            "connected": self.connected,
+            "backend": self.hello.get("backend") if self.hello else None,
+            "in_flight": len(self.pending),
+            "sent": self.sent,
+            "failures": self.failures,
+            "latency_ms": round(self.latency * 1e3, 2) if self.latency is not None else None,
+        }
+
+# Inference on remote servers for a thin capture node. It has the
+# InferenceEngine interface, so the scheduler uses it like a local engine.
+# Every frame of a batch is a separate request. A request goes to the
+# connected server with the least expected wait: its in-flight requests
+# times its recent reply time. Each server takes at most
+# remote_max_in_flight requests and callers wait for a free slot. A
+# request that fails or times out is retried once on another server. When
+# no server can take it, the frame runs on a local engine if the node has
+# the model files (remote_fallback).
+class RemoteInferencePool(InferenceEngine):
+    name = 'remote'
+    
+    def __init__(self, addresses):
+        super().__init__()
+        self.slots = threading.Condition()
+        self.servers = [RemoteServer(address, self.slots) for address in addresses]
+        self.request_ids = iter(range(1, 1 << 32))
+        self.local = None
+        self.local_lock = threading.Lock()
+        self.local_failed = False
+        self.fallbacks = 0
+        self.retries = 0
+        self.closed = False
+        
+        for server in self.servers:
+            try:
+                server.connect()
+            except OSError as e:
+                logger.warning(f"Inference server {server.address[0]}:{server.address[1]} unreachable: {str(e)}")
+                server.retry_at = time.monotonic() + server.retry_delay
+        greetings = [server.hello for server in self.servers if server.hello]
+        if greetings:
+            self.names = greetings[0]["names"]
+            self.supports_input_size = all(hello["supports_input_size"] for hello in greetings)
+        elif self.local_engine() is not None:
+            self.names = self.local.names
+            self.supports_input_size = self.local.supports_input_size
+        else:
+            raise RuntimeError("No inference server reachable and no local model to fall back to")
+        threading.Thread(target=self.reconnect_servers, name='remote-reconnect', daemon=True).start()
+    
+    def reconnect_servers(self):
+        while not self.closed:
+            time.sleep(0.2)
+            for server in self.servers:
+                if not server.connected and time.monotonic() >= server.retry_at:
+                    try:
+                        server.connect()
+                        logger.info(f"Inference server {server.address[0]}:{server.address[1]} connected")
+                    except OSError:
+                        server.retry_at = time.monotonic() + server.retry_delay
+                        server.retry_delay = min(server.retry_delay * 2, config['remote_retry_max'])
+    
+    # Local engine for frames no server can take, loaded on first need
+    def local_engine(self):
+        with self.local_lock:
+            if self.local is None and not self.local_failed:
+                if config['remote_fallback'] and os.path.exists(engine_artifact(config['backend'], config['weights'])):
+                    try:
+                        logger.info("Loading the local model for fallback inference...")
+                        self.local = create_engine(config['backend'], config['weights'], config['imgsz'])
+                    except Exception as e:
+                        logger.error(f"Error loading fallback model: {str(e)}")
+                self.local_failed = self.local is None
+        return self.local
+    
+    # Frame as sent: downscaled so its longest side fits the network input
+    # (it would be letterboxed to that size anyway) and JPEG-compressed
+    def encode(self, frame):
+        height, width = frame.shape[:2]
+        scale = min(self.input_size / max(height, width), 1.0)
+        if scale < 1.0:
+            frame = cv2.resize(frame, (max(int(width * scale), 1), max(int(height * scale), 1)), interpolation=cv2.INTER_AREA)
+        return get_jpeg_encoder().encode(frame, config['remote_quality']), scale
+    
+    # Send a request to the best server, waiting while all are at their
+    # in-flight limit. Returns the pending entry, or None if no server is
+    # connected (or none freed up) before the deadline.
+    def submit(self, payload, deadline, exclude=None):
+        with self.slots:
+            while True:
+                ready = [server for server in self.servers
+                         if server.connected and server is not exclude and len(server.pending) < config['remote_max_in_flight']]
+                if ready:
+                    server = min(ready, key=lambda s: (len(s.pending) + 1) * (s.latency or 1e-3))
+                    request_id = next(self.request_ids)
+                    entry = server.pending[request_id] = [threading.Event(), None, time.monotonic(), server, request_id]
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not any(s.connected and s is not exclude for s in self.servers):
+                    return None
+                self.slots.wait(timeout=remaining)
+        server.send(request_id, payload)
+        return entry
+    
+    # Reply to a request, or None when it failed or timed out. A timed-out
+    # server is dropped, so it stops receiving frames until it reconnects.
+    def collect(self, entry, deadline):
+        event, _, _, server, request_id = entry
+        if not event.wait(timeout=max(deadline - time.monotonic(), 0)):
+            with self.slots:
+                server.pending.pop(request_id, None)
+                self.slots.notify_all()
+            server.disconnect(server.sock, "reply timed out")
+            return None
+        if isinstance(entry[1], RuntimeError):
+            raise entry[1]
+        return entry[1] if isinstance(entry[1], np.ndarray) else None
+    
+    def infer_batch(self, frames):
+        deadline = time.monotonic() + config['remote_timeout']
+        classes = self.classes or []
+        settings = REMOTE_SETTINGS.pack(self.conf, self.iou, self.max_det, self.input_size, len(classes)) + \
+            struct.pack(f'<{len(classes)}H', *classes)
+        encoded = [self.encode(frame) for frame in frames]
+        entries = [self.submit((settings, jpeg), deadline) for jpeg, _ in encoded]
+        
+        results, missing = [], []
+        for i, ((jpeg, scale), entry) in enumerate(zip(encoded, entries)):
+            detections = self.collect(entry, deadline) if entry is not None else None
+            if detections is None and entry is not None:
+                # One retry on another server with a fresh deadline
+                self.retries += 1
+                retry = self.submit((settings, jpeg), time.monotonic() + config['remote_timeout'], exclude=entry[3])
+                detections = self.collect(retry, time.monotonic() + config['remote_timeout']) if retry else None
+            if detections is None:
+                missing.append(i)
+            elif scale < 1.0:
+                for key in ('x1', 'y1', 'x2', 'y2'):
+                    detections[key] = (detections[key] / scale).astype(np.int32)
+            results.append(detections)
+        
+        if missing:
+            local = self.local_engine()
+            if local is None:
+                raise RuntimeError("No inference server responded and no local model to fall back to")
+            local.conf, local.iou, local.classes, local.max_det = self.conf, self.iou, self.classes, self.max_det
+            if local.supports_input_size:
+                local.input_size = self.input_size
+            self.fallbacks += len(missing)
+            for i, detections in zip(missing, local.infer_batch([frames[i] for i in missing])):
+                results[i] = detections
+        return results
+    
+    def stats(self):
+        return {
+            "servers": [server.stats() for server in self.servers],
+            "connected": sum(server.connected for server in self.servers),
+            "retries": self.retries,
+            "local_fallbacks": self.fallbacks,
+            "local_model": self.local is not None,
+        }
+    
+    def close(self):
+        self.closed = True
+        for server in self.servers:
+            server.closed = True
+            server.disconnect(server.sock, "closed")
 
 # Load YOLOv5 model
 def load_model():
-    global model
+    global model, class_names
     try:
         # Load YOLOv5 model
-        logger.info("Loading YOLOv5 model...")
-        model = torch.hub.load('ultralytics/yolov5', 'custom', path='yolov5s.pt')
+        logger.info(f"Loading YOLOv5 model ({config['backend']} backend)...")
+        start = time.perf_counter()
+        if config['remote_servers']:
+            model = RemoteInferencePool(config['remote_servers'])
+        elif config['workers'] > 0:
+            model = InferenceWorkerPool(config['workers'], *config['worker_max_frame'])
+        else:
+            # Runtimes that start their thread pools at load time get the inference cores
+            previous = pin_inference_thread()
+            try:
+                model = create_engine(config['backend'], config['weights'], config['imgsz'])
+            finally:
+                if previous:
+                    os.sched_setaffinity(0, previous)
         # Configure model
         model.conf = 0.45  # Confidence threshold
         model.iou = 0.45   # IoU threshold
         model.classes = None  # All classes
         model.max_det = 50  # Maximum detections
-        logger.info("YOLOv5 model loaded successfully")
+        class_names = build_class_names(model.names)
+        startup.mark('model_load_s', time.perf_counter() - start)
+        logger.info(f"YOLOv5 model loaded successfully in {time.perf_counter() - start:.2f}s")
         return model
     except Exception as e:
         logger.error(f"Error loading model: {str(e)}")
         return None
 
+# Lookup array from class id to class name (model.names may be a dict or a list)
+def build_class_names(names):
+    if isinstance(names, dict):
+        lookup = np.empty(max(names, default=-1) + 1, dtype=object)
+        for class_id, name in names.items():
+            lookup[class_id] = name
+        return lookup
+    return np.array(list(names), dtype=object)
+
+# Convert a raw (n, 6) xyxy/confidence/class tensor into a structured detection array
+def detections_from_xyxy(xyxy):
+    if isinstance(xyxy, torch.Tensor):
+        xyxy = xyxy.detach().cpu().numpy()
+    xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 6)
+    
+    detections = np.empty(len(xyxy), dtype=DETECTION_DTYPE)
+    boxes = xyxy[:, :4].astype(np.int32)
+    detections['x1'], detections['y1'] = boxes[:, 0], boxes[:, 1]
+    detections['x2'], detections['y2'] = boxes[:, 2], boxes[:, 3]
+    detections['confidence'] = xyxy[:, 4]
+    detections['class_id'] = xyxy[:, 5]
+    detections['track_id'] = -1
+    return detections
+
+# Build the "[#<track>] <name> <confidence>" label of every detection in one pass
+def format_labels(detections):
+    if len(detections) == 0:
+        return []
+    class_ids = detections['class_id']
+    if len(class_names) and class_ids.min() >= 0 and class_ids.max() < len(class_names):
+        names = class_names[class_ids].astype(str)
+    else:
+        names = class_ids.astype(str)
+    labels = np.char.add(np.char.add(names, ' '), np.char.mod('%.2f', detections['confidence']))
+    tracked = detections['track_id'] >= 0
+    if tracked.any():
+        labels = np.where(tracked, np.char.add(np.char.mod('#%d ', detections['track_id']), labels), labels)
+    return labels.tolist()
+
+# (n, 4) x1/y1/x2/y2 array of a detection array
+def detection_boxes(detections):
+    return np.stack([detections['x1'], detections['y1'], detections['x2'], detections['y2']], axis=1)
+
+# Detection array as [track, class, confidence %, x1, y1, x2, y2] integer rows
+def detection_rows(detections):
+    return np.column_stack([detections['track_id'], detections['class_id'], np.round(detections['confidence'] * 100),
+                            detection_boxes(detections)]).astype(np.int64).tolist()
+
+# Pairwise IoU between two sets of xyxy boxes
+def box_iou(boxes_a, boxes_b):
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+# Constant-velocity Kalman filter over a box centre and size (cx, cy, w, h)
+class BoxKalman:
+    H = np.eye(4, 8)
+    R = np.diag([1.0, 1.0, 10.0, 10.0])
+    Q = np.diag([1.0, 1.0, 1.0, 1.0, 0.01, 0.01, 0.0001, 0.0001])
+
+    def __init__(self, box):
+        self.x = np.zeros(8)
+        self.x[:4] = self.to_state(box)
+        self.P = np.diag([10.0, 10.0, 10.0, 10.0, 1e4, 1e4, 1e4, 1e4])
+
+    @staticmethod
+    def to_state(box):
+        x1, y1, x2, y2 = box
+        return np.array([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1])
+
+    def box(self):
+        cx, cy, w, h = self.x[:4]
+        return np.array([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2])
+
+    # Advance the state by dt frames
+    def predict(self, dt=1):
+        # Results may arrive out of order from parallel workers; never step backwards
+        dt = max(dt, 0)
+        F = np.eye(8)
+        F[range(4), range(4, 8)] = dt
+        self.x = F @ self.x
+        self.x[2:4] = np.maximum(self.x[2:4], 1)
+        self.P = F @ self.P @ F.T + self.Q * dt
+        return self.box()
+
+    def update(self, box):
+        y = self.to_state(box) - self.H @ self.x
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ y
+        self.P = (np.eye(8) - K @ self.H) @ self.P
+
+class Track:
+    def __init__(self, track_id, box, class_id, confidence, frame_index):
+        self.track_id = track_id
+        self.class_id = class_id
+        self.confidence = confidence
+        self.kalman = BoxKalman(box)
+        self.box = np.asarray(box, dtype=np.float64)
+        self.misses = 0
+        self.frame_index = frame_index
+
+# Multi-object tracker that lets YOLO run only every Nth frame. Detector frames
+# are associated to existing tracks by IoU (same class, greedy best-first);
+# frames in between are propagated with the Kalman motion model, optionally
+# corrected by sparse Lucas-Kanade optical flow inside each box.
+class ObjectTracker:
+    def __init__(self, iou_threshold=0.3, max_misses=3, optical_flow=False):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.optical_flow = optical_flow
+        self.tracks = []
+        self.next_id = 1
+        self.prev_gray = None
+
+    # Associate fresh detections; returns them with their track ids filled in
+    def update(self, frame, detections, frame_index):
+        for track in self.tracks:
+            track.box = track.kalman.predict(frame_index - track.frame_index)
+            track.frame_index = frame_index
+        
+        boxes = detection_boxes(detections).astype(np.float64)
+        matched_tracks, matched_detections = set(), set()
+        if self.tracks and len(detections):
+            iou = box_iou(np.array([track.box for track in self.tracks]), boxes)
+            same_class = np.array([track.class_id for track in self.tracks])[:, None] == detections['class_id'][None, :]
+            iou[~same_class] = 0
+            for flat in np.argsort(iou, axis=None)[::-1]:
+                t, d = np.unravel_index(flat, iou.shape)
+                if iou[t, d] < self.iou_threshold:
+                    break
+                if t in matched_tracks or d in matched_detections:
+                    continue
+                track = self.tracks[t]
+                track.kalman.update(boxes[d])
+                track.box, track.confidence, track.misses = boxes[d], float(detections['confidence'][d]), 0
+                detections['track_id'][d] = track.track_id
+                matched_tracks.add(t)
+                matched_detections.add(d)
+        
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+        
+        for d in range(len(detections)):
+            if d not in matched_detections:
+                track = Track(self.next_id, boxes[d], int(detections['class_id'][d]),
+                              float(detections['confidence'][d]), frame_index)
+                self.tracks.append(track)
+                detections['track_id'][d] = track.track_id
+                self.next_id += 1
+        
+        if self.optical_flow:
+            self.prev_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return detections
+
+    # Propagate the live tracks onto a frame the detector skipped
+    def propagate(self, frame, frame_index):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if self.optical_flow else None
+        live = [track for track in self.tracks if track.misses == 0]
+        
+        for track in live:
+            previous = track.box
+            track.box = track.kalman.predict(frame_index - track.frame_index)
+            track.frame_index = frame_index
+            if gray is not None and self.prev_gray is not None:
+                # Measured motion of the box contents corrects the prediction
+                shift = self.flow_shift(self.prev_gray, gray, previous)
+                if shift is not None:
+                    track.kalman.update(previous + np.tile(shift, 2))
+                    track.box = track.kalman.box()
+        if gray is not None:
+            self.prev_gray = gray
+        
+        detections = np.empty(len(live), dtype=DETECTION_DTYPE)
+        if live:
+            boxes = np.array([track.box for track in live])
+            boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, frame.shape[1] - 1)
+            boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, frame.shape[0] - 1)
+            boxes = boxes.astype(np.int32)
+            detections['x1'], detections['y1'] = boxes[:, 0], boxes[:, 1]
+            detections['x2'], detections['y2'] = boxes[:, 2], boxes[:, 3]
+            detections['confidence'] = [track.confidence for track in live]
+            detections['class_id'] = [track.class_id for track in live]
+            detections['track_id'] = [track.track_id for track in live]
+        return detections
+
+    # Median displacement of good features inside a box between two gray frames
+    @staticmethod
+    def flow_shift(prev_gray, gray, box):
+        height, width = gray.shape
+        x1, y1 = max(int(box[0]), 0), max(int(box[1]), 0)
+        x2, y2 = min(int(box[2]), width), min(int(box[3]), height)
+        if x2 - x1 < 8 or y2 - y1 < 8:
+            return None
+        points = cv2.goodFeaturesToTrack(prev_gray[y1:y2, x1:x2], maxCorners=20, qualityLevel=0.01, minDistance=5)
+        if points is None:
+            return None
+        points = points + np.array([x1, y1], dtype=np.float32)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None, winSize=(15, 15), maxLevel=2)
+        good = status.ravel() == 1
+        if not good.any():
+            return None
+        return np.median((moved - points)[good].reshape(-1, 2), axis=0)
+
+# Cheap motion gate in front of the detector. Frames are compared, downsampled
+# and blurred, against the frame the detector last ran on; when too few pixels
+# changed the previous detections are reused. A periodic refresh still runs
+# the detector so slow changes are caught, and when motion is confined to a
+# small area only that region is sent to the model.
+class MotionGate:
+    def __init__(self, threshold=0.002, pixel_threshold=25, refresh_interval=10.0,
+                 max_region_fraction=0.4, width=160):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.refresh_interval = refresh_interval
+        self.max_region_fraction = max_region_fraction
+        self.width = width
+        self.reference = None
+        self.last_inference = 0.0
+        self.checked = 0
+        self.skipped = 0
+        self.region_inferences = 0
+
+    def small_gray(self, frame):
+        height, width = frame.shape[:2]
+        small = cv2.resize(frame, (self.width, max(int(height * self.width / width), 1)), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+    # Decide whether to run the detector. Returns (run, region) where region is
+    # an (x1, y1, x2, y2) crop of the frame to restrict inference to, or None.
+    def check(self, frame):
+        self.checked += 1
+        gray = self.small_gray(frame)
+        now = time.monotonic()
+        
+        if self.reference is None or self.reference.shape != gray.shape or now - self.last_inference >= self.refresh_interval:
+            self.reference, self.last_inference = gray, now
+            return True, None
+        
+        changed = cv2.absdiff(gray, self.reference) > self.pixel_threshold
+        if changed.mean() < self.threshold:
+            self.skipped += 1
+            return False, None
+        
+        self.reference, self.last_inference = gray, now
+        ys, xs = np.nonzero(cv2.dilate(changed.astype(np.uint8), np.ones((5, 5), np.uint8)))
+        scale = frame.shape[1] / gray.shape[1]
+        margin = 8
+        x1, y1 = max(int((xs.min() - margin) * scale), 0), max(int((ys.min() - margin) * scale), 0)
+        x2 = min(int((xs.max() + 1 + margin) * scale), frame.shape[1])
+        y2 = min(int((ys.max() + 1 + margin) * scale), frame.shape[0])
+        if (x2 - x1) * (y2 - y1) > self.max_region_fraction * frame.shape[0] * frame.shape[1]:
+            return True, None
+        self.region_inferences += 1
+        return True, (x1, y1, x2, y2)
+
+    def stats(self):
+        return {
+            "checked": self.checked,
+            "skipped": self.skipped,
+            "skip_rate": round(self.skipped / self.checked, 3) if self.checked else 0.0,
+            "region_inferences": self.region_inferences,
+        }
+
+# Combine detections from a region-restricted inference with the previous
+# detections that lie entirely outside that region
+def merge_region_detections(previous, fresh, region):
+    if previous is None or len(previous) == 0:
+        return fresh
+    x1, y1, x2, y2 = region
+    outside = (previous['x2'] <= x1) | (previous['x1'] >= x2) | (previous['y2'] <= y1) | (previous['y1'] >= y2)
+    return np.concatenate([previous[outside], fresh])
+
+# Validate ROI polygons given as lists of normalized [x, y] points (0-1, so
+# one ROI fits every resolution); raises ValueError when malformed
+def parse_roi(polygons):
+    if not polygons:
+        return []
+    parsed = []
+    for polygon in polygons:
+        points = np.asarray(polygon, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 2 or len(points) < 3:
+            raise ValueError("Each ROI polygon needs at least three [x, y] points")
+        if points.min() < 0 or points.max() > 1:
+            raise ValueError("ROI points are normalized to 0-1")
+        parsed.append(points.tolist())
+    return parsed
+
+# Start of each tile along one axis: evenly spread so the first and last tile
+# touch the frame edges and neighbours overlap by at least `overlap`
+def tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    step = tile_size * (1 - overlap)
+    count = int(np.ceil((length - tile_size) / step)) + 1
+    return [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+
+# Regions the detector runs on for one frame size, tile setting and ROI.
+# Tiles that miss the ROI are dropped, so unwatched areas are never
+# computed; with tiling off the single region is the ROI's bounding box.
+# With full_frame a downscaled whole-frame (or whole-ROI) pass is added for
+# objects larger than a tile. Built once per combination and cached.
+class TileLayout:
+    def __init__(self, shape, tile_size=0, overlap=0.2, roi=None, full_frame=True):
+        height, width = shape[:2]
+        self.shape = (height, width)
+        self.mask = None
+        bounds = (0, 0, width, height)
+        if roi:
+            self.mask = np.zeros((height, width), dtype=np.uint8)
+            polygons = [np.round(np.asarray(polygon) * (width, height)).astype(np.int32) for polygon in roi]
+            cv2.fillPoly(self.mask, polygons, 1)
+            x, y, w, h = cv2.boundingRect(self.mask)
+            bounds = (x, y, x + w, y + h)
+        
+        self.bounds = bounds
+        tiles = []
+        self.tiled = bool(tile_size) and max(height, width) > tile_size
+        if self.tiled:
+            for y in tile_starts(height, tile_size, overlap):
+                for x in tile_starts(width, tile_size, overlap):
+                    tile = (x, y, min(x + tile_size, width), min(y + tile_size, height))
+                    if self.mask is None or self.mask[tile[1]:tile[3], tile[0]:tile[2]].any():
+                        tiles.append(tile)
+        self.full_frame = not self.tiled or full_frame
+        if self.full_frame and bounds[2] > bounds[0] and bounds[3] > bounds[1]:
+            tiles.append(bounds)
+        self.tiles = np.array(tiles, dtype=np.int32).reshape(-1, 4)
+
+    # Tiles overlapping a motion-gate region (all tiles if region is None)
+    def tiles_within(self, region=None):
+        if region is None:
+            return self.tiles
+        x1, y1, x2, y2 = region
+        tiles = self.tiles
+        return tiles[(tiles[:, 0] < x2) & (tiles[:, 2] > x1) & (tiles[:, 1] < y2) & (tiles[:, 3] > y1)]
+
+    # Combine the detections of every tile of one frame: drop boxes cut off
+    # by an interior tile edge (the overlapping neighbour or the full-frame
+    # pass holds the whole object), drop boxes centred outside the ROI, then
+    # class-aware NMS removes the duplicates found in overlapping tiles.
+    def merge(self, parts, tiles, iou_threshold=0.45, margin=2):
+        height, width = self.shape
+        kept = []
+        for detections, tile in zip(parts, tiles.tolist()):
+            # The full-frame pass itself is never trimmed
+            if len(detections) and self.tiled and self.full_frame and tuple(tile) != self.bounds:
+                x1, y1, x2, y2 = tile
+                cut = np.zeros(len(detections), dtype=bool)
+                if x1 > 0:
+                    cut |= detections['x1'] <= x1 + margin
+                if y1 > 0:
+                    cut |= detections['y1'] <= y1 + margin
+                if x2 < width:
+                    cut |= detections['x2'] >= x2 - margin
+                if y2 < height:
+                    cut |= detections['y2'] >= y2 - margin
+                detections = detections[~cut]
+            kept.append(detections)
+        detections = np.concatenate(kept) if kept else np.empty(0, dtype=DETECTION_DTYPE)
+        if self.mask is not None and len(detections):
+            cx = np.clip((detections['x1'] + detections['x2']) // 2, 0, width - 1)
+            cy = np.clip((detections['y1'] + detections['y2']) // 2, 0, height - 1)
+            detections = detections[self.mask[cy, cx].astype(bool)]
+        if len(parts) < 2 or len(detections) < 2:
+            return detections
+        boxes = detection_boxes(detections).astype(np.float32)
+        offsets = detections['class_id'][:, None].astype(np.float32) * (max(width, height) + 1)
+        return detections[np.sort(nms_indices(boxes + offsets, detections['confidence'], iou_threshold))]
+
+tile_layouts = {}
+
+# Cached TileLayout for a frame shape and ROI under the current tile settings
+def get_tile_layout(shape, roi=None):
+    key = (shape[0], shape[1], config['tile_size'], config['tile_overlap'], config['tile_full_frame'],
+           json.dumps(roi) if roi else None)
+    layout = tile_layouts.get(key)
+    if layout is None:
+        layout = tile_layouts[key] = TileLayout(shape, config['tile_size'], config['tile_overlap'],
+                                                roi, config['tile_full_frame'])
+        logger.info(f"Tile layout for {shape[1]}x{shape[0]}: {len(layout.tiles)} regions")
+    return layout
+
+# Whether frames of a source go through a TileLayout at all
+def uses_layout(roi=None):
+    return bool(config['tile_size']) or bool(roi)
+
+# Reads an image-sequence directory through the cv2.VideoCapture interface
+class ImageSequenceCapture:
+    EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+    def __init__(self, directory, fps=30.0):
+        self.paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith(self.EXTENSIONS)
+        )
+        self.position = 0
+        self.fps = fps
+
+    def isOpened(self):
+        return bool(self.paths)
+
+    def grab(self):
+        self.position += 1
+        return self.position <= len(self.paths)
+
+    def read(self, image=None):
+        if self.position >= len(self.paths):
+            return False, None
+        frame = cv2.imread(self.paths[self.position])
+        self.position += 1
+        if frame is not None and image is not None and image.shape == frame.shape:
+            image[...] = frame
+            frame = image
+        return frame is not None, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.paths)
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.position = int(value)
+            return True
+        return False
+
+    def release(self):
+        self.paths = []
+
+# Synthetic camera-like frame: smooth gradients, a few solid shapes and
+# sensor noise, so JPEG sizes resemble real footage more than flat colour
+def synthetic_frame(width=1280, height=720, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    frame = np.stack([80 + 100 * x + 0 * y, 60 + 120 * y + 0 * x, 140 - 60 * x * y], axis=2)
+    frame += rng.normal(0, 6, frame.shape)
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+    for _ in range(12):
+        x1, y1 = int(rng.integers(0, width - 100)), int(rng.integers(0, height - 100))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.rectangle(frame, (x1, y1), (x1 + int(rng.integers(40, 300)), y1 + int(rng.integers(40, 300))), color, -1)
+    return frame
+
+# Generated frames for benchmarks and camera-less testing: the synthetic
+# background with `objects` solid boxes bouncing across it. With fps > 0,
+# read() blocks like a device delivering frames at that rate; with fps 0 it
+# returns frames as fast as they are drawn.
+class SyntheticCapture:
+    def __init__(self, width=1280, height=720, fps=30.0, objects=5, seed=0):
+        self.background = synthetic_frame(width, height, seed)
+        rng = np.random.default_rng(seed + 1)
+        self.sizes = rng.uniform(0.05, 0.25, size=(objects, 2)) * (width, height)
+        self.origins = rng.uniform(0, 1, size=(objects, 2)) * ((width, height) - self.sizes)
+        self.velocities = rng.uniform(-8, 8, size=(objects, 2))
+        self.colors = [tuple(int(c) for c in color) for color in rng.integers(0, 255, size=(objects, 3))]
+        self.fps = fps
+        self.position = 0
+        self.next_frame_at = None
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self, image=None):
+        if not self.opened:
+            return False, None
+        if self.fps:
+            now = time.monotonic()
+            self.next_frame_at = max(self.next_frame_at or now, now - 1 / self.fps) + 1 / self.fps
+            time.sleep(max(self.next_frame_at - now, 0))
+        if image is None or image.shape != self.background.shape:
+            image = np.empty_like(self.background)
+        np.copyto(image, self.background)
+        
+        # Bounce every box off the frame edges
+        height, width = image.shape[:2]
+        span = np.array((width, height)) - self.sizes
+        travel = np.abs(self.origins + self.velocities * self.position) % (2 * span)
+        corners = np.where(travel > span, 2 * span - travel, travel)
+        for (x1, y1), (w, h), color in zip(corners.astype(int), self.sizes.astype(int), self.colors):
+            cv2.rectangle(image, (x1, y1), (x1 + w, y1 + h), color, -1)
+        self.position += 1
+        return True, image
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.background.shape[1]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.background.shape[0]
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.position = int(value)
+            return True
+        return False
+
+    def release(self):
+        self.opened = False
+
+# synthetic:WIDTHxHEIGHT[?fps=N&objects=N&seed=N] -> SyntheticCapture arguments
+def parse_synthetic_spec(spec):
+    size, _, query = spec[len('synthetic:'):].partition('?')
+    options = {key: values[0] for key, values in urllib.parse.parse_qs(query).items()}
+    width, _, height = (size or '1280x720').partition('x')
+    return {
+        "width": int(width),
+        "height": int(height),
+        "fps": float(options.get('fps', 30)),
+        "objects": int(options.get('objects', 5)),
+        "seed": int(options.get('seed', 0)),
+    }
+
+# Plays a video file or image directory as if it were a live device: frame k
+# arrives k/fps seconds after open whether or not anyone reads it, and the
+# driver queue only keeps the newest `buffer` frames. With outage_after set the
+# device drops off for `outage` seconds after every outage_after frames, and
+# open() fails until it is back. Implements the grab()/retrieve()/open()
+# subset of cv2.VideoCapture that LiveCapture uses.
+class FakeDevice:
+    def __init__(self, path, fps=30.0, buffer=4, outage_after=0, outage=2.0):
+        self.path = path
+        self.fps = fps
+        self.buffer_size = buffer
+        self.outage_after = outage_after
+        self.outage = outage
+        self.offline_until = 0.0
+        self.reader = None
+        self.frame = None
+        self.overwritten = 0
+        self.open(path)
+
+    def open(self, path, api=None):
+        self.release()
+        if time.monotonic() < self.offline_until:
+            return False
+        self.path = path
+        self.reader = ImageSequenceCapture(path) if os.path.isdir(path) else cv2.VideoCapture(path)
+        if not self.reader.isOpened():
+            self.reader = None
+            return False
+        self.opened_at = time.monotonic()
+        self.next_index = 0
+        return True
+
+    def isOpened(self):
+        return self.reader is not None
+
+    # Next frame of the file, rewinding at the end like a looping feed
+    def decode(self, reader, keep=True):
+        for _ in range(2):
+            success, frame = reader.read() if keep else (reader.grab(), None)
+            if success:
+                return frame if keep else True
+            reader.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return None
+
+    def grab(self):
+        # release() may run on another thread mid-grab, as with real drivers
+        reader = self.reader
+        if reader is None:
+            return False
+        if self.outage_after and self.next_index >= self.outage_after:
+            logger.warning(f"Fake device {self.path} going offline for {self.outage:.1f}s")
+            self.offline_until = time.monotonic() + self.outage
+            self.release()
+            return False
+        
+        # Wait for the sensor when the queue is empty
+        now = time.monotonic()
+        arrived = int((now - self.opened_at) * self.fps)
+        if self.next_index >= arrived:
+            time.sleep(self.opened_at + (self.next_index + 1) / self.fps - now)
+            arrived = self.next_index + 1
+        # Frames older than the queue were overwritten by the driver
+        index = max(self.next_index, arrived - self.buffer_size)
+        self.overwritten += index - self.next_index
+        for _ in range(index - self.next_index):
+            self.decode(reader, keep=False)
+        self.frame = self.decode(reader)
+        self.next_index = index + 1
+        return self.frame is not None
+
+    def retrieve(self, image=None, flag=0):
+        if self.frame is None:
+            return False, None
+        if image is not None and image.shape == self.frame.shape:
+            image[...] = self.frame
+            return True, image
+        return True, self.frame
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_BUFFERSIZE:
+            return self.buffer_size
+        if prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT) and self.reader is not None:
+            return self.reader.get(prop)
+        return 0.0
+
+    # Like most webcams, only some requests are honoured
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_BUFFERSIZE:
+            self.buffer_size = max(int(value), 1)
+            return True
+        if prop == cv2.CAP_PROP_FPS and value > 0:
+            self.fps = float(value)
+            return True
+        return False
+
+    def release(self):
+        reader, self.reader = self.reader, None
+        if reader is not None:
+            reader.release()
+
+# fake:PATH[?fps=N&buffer=N&outage_after=N&outage=SECONDS] -> FakeDevice arguments
+def parse_fake_spec(spec):
+    path, _, query = spec[len('fake:'):].partition('?')
+    options = {key: values[0] for key, values in urllib.parse.parse_qs(query).items()}
+    return {
+        "path": path,
+        "fps": float(options.get('fps', 30)),
+        "buffer": int(options.get('buffer', 4)),
+        "outage_after": int(options.get('outage_after', 0)),
+        "outage": float(options.get('outage', 2.0)),
+    }
+
+CAPTURE_APIS = {
+    'auto': cv2.CAP_ANY,
+    'v4l2': cv2.CAP_V4L2,
+    'dshow': cv2.CAP_DSHOW,
+    'msmf': cv2.CAP_MSMF,
+    'gstreamer': cv2.CAP_GSTREAMER,
+    'ffmpeg': cv2.CAP_FFMPEG,
+}
+
+# Low-latency reader for live devices and streams. Opening requests the
+# configured buffer size, FOURCC, resolution and FPS (FOURCC first, V4L2 picks
+# the frame sizes per format). read() drains frames that queued up in the
+# driver with grab() and decodes only the newest with retrieve(); timestamp is
+# the monotonic time its grab returned.
+class LiveCapture:
+    MAX_DRAIN = 16
+
+    def __init__(self, device, target, api=cv2.CAP_ANY):
+        self.device = device
+        self.target = target
+        self.api = api
+        self.timestamp = None
+        self.interval = 1 / 30.0
+        self.negotiated = {}
+        self.drained = 0
+        self.reconnects = 0
+        if device.isOpened():
+            self.configure()
+
+    def configure(self):
+        requests = [(cv2.CAP_PROP_BUFFERSIZE, config['capture_buffer_size'])]
+        if config['capture_fourcc']:
+            requests.append((cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*config['capture_fourcc'][:4].ljust(4))))
+        requests += [(cv2.CAP_PROP_FRAME_WIDTH, config['capture_width']),
+                     (cv2.CAP_PROP_FRAME_HEIGHT, config['capture_height']),
+                     (cv2.CAP_PROP_FPS, config['capture_fps'])]
+        for prop, value in requests:
+            if value:
+                self.device.set(prop, value)
+        
+        # Drivers report what they actually agreed to
+        fps = self.device.get(cv2.CAP_PROP_FPS)
+        self.interval = 1 / fps if 1 <= fps <= 1000 else 1 / 30.0
+        fourcc = int(self.device.get(cv2.CAP_PROP_FOURCC))
+        self.negotiated = {
+            "width": int(self.device.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(self.device.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "fps": round(fps, 2),
+            "fourcc": fourcc.to_bytes(4, 'little').decode('ascii', 'replace').strip('\x00') if fourcc > 0 else '',
+            "buffer_size": int(self.device.get(cv2.CAP_PROP_BUFFERSIZE)),
+        }
+        logger.info(f"Capture {self.target} negotiated {self.negotiated}")
+
+    def isOpened(self):
+        return self.device.isOpened()
+
+    def read(self, image=None):
+        start = time.monotonic()
+        if not self.device.grab():
+            return False, None
+        grabbed_at = time.monotonic()
+        
+        # A grab that returns well inside a frame interval came out of the
+        # driver queue rather than the sensor: keep grabbing until one waits
+        drained = 0
+        while grabbed_at - start < self.interval * 0.5 and drained < self.MAX_DRAIN:
+            start = grabbed_at
+            if not self.device.grab():
+                return False, None
+            grabbed_at = time.monotonic()
+            drained += 1
+        self.drained += drained
+        
+        success, frame = self.device.retrieve(image) if image is not None else self.device.retrieve()
+        self.timestamp = grabbed_at
+        return success, frame
+
+    # Release and reopen the device, reapplying the requested properties
+    def reconnect(self):
+        self.device.release()
+        if not self.device.open(self.target, self.api):
+            return False
+        self.configure()
+        self.reconnects += 1
+        logger.info(f"Reconnected to {self.target}")
+        return True
+
+    def get(self, prop):
+        return self.device.get(prop)
+
+    def set(self, prop, value):
+        return self.device.set(prop, value)
+
+    def release(self):
+        self.device.release()
+
+    def stats(self):
+        return dict(self.negotiated, frames_drained=self.drained, reconnects=self.reconnects)
+
+# A source spec is a device index ("0"), a video file / stream URL, an image
+# directory, a synthetic:WIDTHxHEIGHT generator or a fake:PATH device
+def parse_source_spec(spec):
+    spec = str(spec)
+    return int(spec) if spec.isdigit() else spec
+
+# Open a source spec as a capture object
+def open_capture(spec):
+    spec = parse_source_spec(spec)
+    if isinstance(spec, str) and spec.startswith('synthetic:'):
+        return SyntheticCapture(**parse_synthetic_spec(spec))
+    if isinstance(spec, str) and spec.startswith('fake:'):
+        options = parse_fake_spec(spec)
+        return LiveCapture(FakeDevice(**options), options['path'])
+    if isinstance(spec, str) and os.path.isdir(spec):
+        return ImageSequenceCapture(spec)
+    if is_live_source(spec):
+        api = CAPTURE_APIS[config['capture_api']]
+        return LiveCapture(cv2.VideoCapture(spec, api), spec, api)
+    return cv2.VideoCapture(spec)
+
+# Live devices, streams and synthetic or fake devices run at their own pace;
+# files are played back at their native FPS
+def is_live_source(spec):
+    spec = parse_source_spec(spec)
+    return isinstance(spec, int) or spec.startswith(('/dev/', 'synthetic:', 'fake:')) or '://' in spec
+
+# Normalize /video_feed size/quality/max_fps parameters into a tier key.
+# Sizes snap down to a multiple of 16 and fps to 0.5 steps so near-identical
+# requests share a tier; raises ValueError for malformed values.
+def stream_tier_key(size=None, quality=None, max_fps=None):
+    size = int(size) if size not in (None, '') else 0
+    quality = int(quality) if quality not in (None, '') else config['jpeg_quality']
+    max_fps = float(max_fps) if max_fps not in (None, '') else 0.0
+    if size < 0 or max_fps < 0:
+        raise ValueError("size and max_fps must not be negative")
+    size = max(size // 16 * 16, 160) if size else 0
+    quality = min(max(quality, 10), 100)
+    max_fps = round(max_fps * 2) / 2
+    return size, quality, max_fps
+
+# One encoded variant of a source's stream: frame width (0 = native), JPEG
+# quality and an fps cap. Each tier is encoded once per frame and published
+# on its own hub; hub.viewers counts the clients that joined it.
+class StreamTier:
+    def __init__(self, size, quality, max_fps, hub=None, adaptive=True):
+        self.size = size
+        self.quality = quality
+        self.max_fps = max_fps
+        self.hub = hub if hub is not None else BroadcastHub()
+        # Whether the controller's stream scale and quality cap apply
+        self.adaptive = adaptive
+        self.next_due = 0.0
+        self.encoded = 0
+        self.bytes_encoded = 0
+
+    @property
+    def key(self):
+        return self.size, self.quality, self.max_fps
+
+    # Whether this tier takes the frame at time now under its fps cap
+    def due(self, now):
+        if not self.max_fps:
+            return True
+        if now < self.next_due:
+            return False
+        self.next_due = max(self.next_due + 1 / self.max_fps, now)
+        return True
+
+    def publish(self, data):
+        self.encoded += 1
+        self.bytes_encoded += len(data)
+        self.hub.publish(data)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "quality": self.quality,
+            "max_fps": self.max_fps,
+            "viewers": self.hub.viewers,
+            "frames_encoded": self.encoded,
+            "bytes_encoded": self.bytes_encoded,
+        }
+
+# A camera, video file or image-sequence directory with its own pipeline
+# slots, tracker, motion gate and output stream
+class VideoSource:
+    def __init__(self, source_id, spec, fps_cap=None, roi=None):
+        self.source_id = source_id
+        self.spec = parse_source_spec(spec)
+        self.fps_cap = config['source_fps_cap'] if fps_cap is None else fps_cap
+        self.roi = config['roi'] if roi is None else roi
+        self.camera = None
+        self.slots = create_pipeline_slots()
+        self.hub = BroadcastHub()
+        # The native, default-quality tier always exists and publishes on self.hub
+        self.default_tier = StreamTier(*stream_tier_key(), hub=self.hub)
+        self.tiers = {self.default_tier.key: self.default_tier}
+        self.tiers_lock = threading.Lock()
+        self.detection_hub = BroadcastHub()
+        self.tracker = None
+        self.motion_gate = None
+        self.recorder = None
+        self.last_detections = None
+        self.lock = threading.Lock()
+        self.scheduled = 0
+        self.processed = 0
+        self.last_output_index = -1
+        self.stale_dropped = 0
+        self.next_due = 0.0
+        self.last_processed_at = None
+        self.inference_fps = 0.0
+        self.captured = 0
+        self.last_captured_at = None
+        self.capture_fps = 0.0
+
+    @property
+    def running(self):
+        return self.camera is not None
+
+    # Open the capture and start this source's capture, annotation and encoding stages
+    def start(self):
+        logger.info(f"Opening source {self.source_id} ({self.spec})...")
+        camera = open_capture(self.spec)
+        if not camera.isOpened():
+            logger.error(f"Failed to open source {self.source_id}")
+            return False
+        
+        self.slots = create_pipeline_slots()
+        self.tracker = ObjectTracker(optical_flow=config['optical_flow'])
+        self.motion_gate = MotionGate(config['motion_threshold'], refresh_interval=config['motion_refresh']) if config['motion_gate'] else None
+        self.recorder = ClipRecorder(self.source_id) if config['record_rules'] else None
+        self.last_detections = None
+        self.scheduled = self.processed = self.stale_dropped = 0
+        self.last_output_index = -1
+        self.last_captured_at = None
+        self.camera = camera
+        for stage in (capture_frames, annotate_worker, encode_worker):
+            threading.Thread(target=stage, args=(self,), name=f"{stage.__name__}-{self.source_id}", daemon=True).start()
+        ensure_scheduler()
+        return True
+
+    def stop(self):
+        camera, self.camera = self.camera, None
+        if camera is not None:
+            camera.release()
+        # Stop the pipeline stages and clear the output frame
+        for slot in self.slots.values():
+            slot.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        with self.tiers_lock:
+            for tier in self.tiers.values():
+                tier.hub.clear()
+        self.detection_hub.clear()
+
+    # Join the stream tier for key, creating it on first use. Past max_tiers
+    # new clients share the default tier. Pair every call with leave_tier.
+    def join_tier(self, key):
+        with self.tiers_lock:
+            tier = self.tiers.get(key)
+            if tier is None:
+                if len(self.tiers) < config['max_tiers']:
+                    tier = self.tiers[key] = StreamTier(*key)
+                else:
+                    tier = self.default_tier
+            with tier.hub.cond:
+                tier.hub.viewers += 1
+        return tier
+
+    # Drop a client from its tier; the last client tears the tier down
+    def leave_tier(self, tier):
+        with self.tiers_lock:
+            with tier.hub.cond:
+                tier.hub.viewers -= 1
+                idle = tier.hub.viewers == 0
+            if idle and tier is not self.default_tier:
+                self.tiers.pop(tier.key, None)
+
+    # Tiers with at least one client; only these are encoded
+    def active_tiers(self):
+        with self.tiers_lock:
+            return [tier for tier in self.tiers.values() if tier.hub.viewers > 0]
+
+    # Whether the scheduler may take a frame now under this source's FPS cap
+    def due(self, now):
+        return not self.fps_cap or now >= self.next_due
+
+    def mark_processed(self, now):
+        if self.fps_cap:
+            self.next_due = max(self.next_due + 1 / self.fps_cap, now)
+        if self.last_processed_at is not None and now > self.last_processed_at:
+            self.inference_fps = 0.9 * self.inference_fps + 0.1 / (now - self.last_processed_at)
+        self.last_processed_at = now
+        self.processed += 1
+
+    def mark_captured(self, now):
+        if self.last_captured_at is not None and now > self.last_captured_at:
+            self.capture_fps = 0.9 * self.capture_fps + 0.1 / (now - self.last_captured_at)
+        self.last_captured_at = now
+        self.captured += 1
+
+    def status(self):
+        return {
+            "id": self.source_id,
+            "source": str(self.spec),
+            "running": self.running,
+            "fps_cap": self.fps_cap,
+            "roi": self.roi,
+            "capture_fps": round(self.capture_fps, 2),
+            "inference_fps": round(self.inference_fps, 2),
+            "frames_captured": self.captured,
+            "frames_processed": self.processed,
+            "stale_dropped": self.stale_dropped,
+            "viewers": sum(tier.hub.viewers for tier in self.active_tiers()),
+            "stream_tiers": [tier.stats() for tier in self.active_tiers()],
+            "detection_subscribers": self.detection_hub.viewers,
+            "pipeline": {name: slot.stats() for name, slot in self.slots.items()},
+            "motion_gate": self.motion_gate.stats() if self.motion_gate else None,
+            "capture": self.camera.stats() if hasattr(self.camera, 'stats') else None,
+            "recording": self.recorder.stats() if self.recorder else None,
+        }
+
+# Look up a registered source, None if unknown
+def get_source(source_id):
+    with sources_lock:
+        return sources.get(source_id)
+
+# Register a new source; raises ValueError for a bad or duplicate id
+def add_source(source_id, spec, fps_cap=None, roi=None):
+    if not source_id or not all(c.isalnum() or c in '-_' for c in source_id):
+        raise ValueError(f"Invalid source id: {source_id!r}")
+    with sources_lock:
+        if source_id in sources:
+            raise ValueError(f"Source {source_id} already exists")
+        source = sources[source_id] = VideoSource(source_id, spec, fps_cap, roi)
+    return source
+
+# Return the registered source, registering it with spec first if needed
+def get_or_add_source(source_id, spec):
+    with sources_lock:
+        if source_id not in sources:
+            sources[source_id] = VideoSource(source_id, spec)
+        return sources[source_id]
+
+# Unregister and stop a source; returns it, or None if unknown
+def remove_source(source_id):
+    with sources_lock:
+        source = sources.pop(source_id, None)
+    if source is not None:
+        source.stop()
+    return source
+
+def active_sources():
+    with sources_lock:
+        return [source for source in sources.values() if source.running]
+
+# Start the shared inference scheduler once. With worker processes there is
+# one scheduler thread per worker so that many batches can be in flight.
+def ensure_scheduler():
+    with sources_lock:
+        scheduler_threads[:] = [thread for thread in scheduler_threads if thread.is_alive()]
+        for i in range(len(scheduler_threads), max(config['workers'], 1)):
+            thread = threading.Thread(target=inference_scheduler, name=f"inference_scheduler-{i}", daemon=True)
+            thread.start()
+            scheduler_threads.append(thread)
+    controller.start()
+
+# Load the model once, however many threads ask for it
+def ensure_model():
+    with model_lock:
+        if model is None:
+            load_model()
+    return model
+
+# Load the model and run a few inferences on a synthetic frame so lazy
+# initialization and first-call kernel setup are paid at boot, not by the
+# first viewer. Each batch size the scheduler is expected to use is warmed;
+# with worker processes, as many batches run in parallel as there are workers.
+def warm_up_model(batch_sizes=(1,)):
+    startup.enter('loading')
+    if ensure_model() is None:
+        startup.fail("model failed to load")
+        return
+    
+    startup.enter('warming')
+    width, height = config['capture_width'] or 1280, config['capture_height'] or 720
+    frame = synthetic_frame(width, height)
+    
+    errors = []
+    def run():
+        pin_inference_thread()
+        try:
+            for batch_size in batch_sizes:
+                for _ in range(config['warmup_runs']):
+                    start = time.perf_counter()
+                    model.infer_batch([frame] * batch_size)
+                    startup.mark('first_inference_ms', (time.perf_counter() - start) * 1e3)
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(max(config['workers'], 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        logger.error(f"Error warming up model: {str(errors[0])}")
+        startup.fail(str(errors[0]))
+        return
+    startup.enter('ready')
+
 # Ensure model file exists
 def check_model_file():
-    if not os.path.exists('yolov5s.pt'):
-        logger.error("Missing yolov5s.pt file")
+    if config['remote_servers']:
+        # A capture node needs no model; the servers have it
+        return True
+    path = engine_artifact(config['backend'], config['weights'])
+    if not os.path.exists(path):
+        logger.error(f"Missing {path} file")
         return False
-    logger.info("Found yolov5s.pt model file")
+    logger.info(f"Found {path} model file")
     return True
 
-# Perform object detection on a frame
-def detect_objects(frame):
-    global model
-    
-    if model is None:
-        model = load_model()
-        if model is None:
-            # If model failed to load, return original frame
-            return frame
+# Run the model on a batch of frames in one call. Each frame may come with an
+# (x1, y1, x2, y2) region to restrict inference to; those boxes are shifted
+# back to frame coordinates. Returns one detection array per frame, or None.
+def infer_detections_batch(frames, regions=None):
+    if ensure_model() is None:
+        # If model failed to load, there is nothing to detect
+        return None
     
+    regions = regions or [None] * len(frames)
     try:
-        # Convert BGR to RGB (YOLOv5 expects RGB)
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        
         # Perform inference
-        results = model(rgb_frame)
-        
-        # Get detections and draw them on the frame
-        detections = results.pandas().xyxy[0]
-        
-        # Draw bounding boxes on the frame
-        for _, detection in detections.iterrows():
-            x1, y1 = int(detection['xmin']), int(detection['ymin'])
-            x2, y2 = int(detection['xmax']), int(detection['ymax'])
-            label = detection['name']
-            confidence = detection['confidence']
-            
-            # Draw rectangle and label
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.putText(frame, f"{label} {confidence:.2f}", (x1, y1 - 10), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+        crops = [frame if region is None else frame[region[1]:region[3], region[0]:region[2]]
+                 for frame, region in zip(frames, regions)]
+        results = model.infer_batch(crops)
     except Exception as e:
         logger.error(f"Detection error: {str(e)}")
+        return None
+    
+    for detections, region in zip(results, regions):
+        if region is not None:
+            detections['x1'] += region[0]
+            detections['x2'] += region[0]
+            detections['y1'] += region[1]
+            detections['y2'] += region[1]
+    return results
+
+# Run one batch where frames may be split into the regions of a TileLayout
+# (layout None = the frame or its motion region as is). The tiles of every
+# frame go to the model in a single call and are merged back into one
+# detection array per frame.
+def infer_layout_batch(frames, regions, layouts):
+    crop_frames, crop_regions, spans = [], [], []
+    for frame, region, layout in zip(frames, regions, layouts):
+        if layout is None:
+            crop_frames.append(frame)
+            crop_regions.append(region)
+            spans.append(None)
+        else:
+            tiles = layout.tiles_within(region)
+            crop_frames.extend([frame] * len(tiles))
+            crop_regions.extend(tuple(tile) for tile in tiles.tolist())
+            spans.append(tiles)
     
+    results = infer_detections_batch(crop_frames, crop_regions) if crop_frames else []
+    if results is None:
+        return None
+    merged, start = [], 0
+    for layout, tiles in zip(layouts, spans):
+        if layout is None:
+            merged.append(results[start])
+            start += 1
+        else:
+            merged.append(layout.merge(results[start:start + len(tiles)], tiles))
+            start += len(tiles)
+    return merged
+
+# Run the model on a frame and return its detections
+def infer_detections(frame, region=None):
+    results = infer_detections_batch([frame], [region])
+    return results[0] if results else None
+
+# Draw bounding boxes and labels on the frame
+def draw_detections(frame, detections):
+    if detections is None or len(detections) == 0:
+        return frame
+    
+    for (x1, y1, x2, y2), label in zip(detection_boxes(detections).tolist(), format_labels(detections)):
+        # Draw rectangle and label
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(frame, label, (x1, y1 - 10), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
     return frame
 
-# Function to capture frames from webcam
-def capture_frames():
-    global camera, output_frame, lock, detection_enabled
+# Perform object detection on a frame
+def detect_objects(frame):
+    return draw_detections(frame, infer_detections(frame))
+
+# Static overlay text: the detection status, any --overlay-text lines and
+# the access URL. A negative y counts up from the bottom of the frame.
+def overlay_layers():
+    layers = [(f"Detection: {'ON' if detection_enabled else 'OFF'}", (10, 30), 0.8, (0, 0, 255), 2)]
+    for i, text in enumerate(config['overlay_text']):
+        layers.append((text, (10, 60 + 25 * i), 0.6, (255, 255, 255), 1))
+    layers.append((f"Access: http://{get_ip_address()}:{config['port']}", (10, -10), 0.6, (255, 255, 255), 1))
+    return tuple(layers)
+
+# Pre-rendered static overlays. For each frame size and set of texts, every
+# layer is rasterized once into an inverse-alpha mask and a premultiplied
+# colour patch, grouped into horizontal bands around the text. Drawing a frame
+# is then frame * mask + colour per band, two SIMD calls that cost the same
+# however many text elements a band holds. A composite is rebuilt only when a
+# text or the frame size changes.
+class OverlayCompositor:
+    FONT = cv2.FONT_HERSHEY_SIMPLEX
+    BAND_GAP = 16
+
+    def __init__(self):
+        self.composites = {}
+
+    def build(self, shape, layers):
+        height, width = shape[:2]
+        coverage = np.zeros((height, width), dtype=np.float32)
+        premultiplied = np.zeros((height, width, 3), dtype=np.float32)
+        for text, (x, y), scale, color, thickness in layers:
+            y = y if y >= 0 else height + y
+            (text_width, text_height), baseline = cv2.getTextSize(text, self.FONT, scale, thickness)
+            pad = thickness + 4
+            top, bottom = max(y - text_height - pad, 0), min(y + baseline + pad, height)
+            left, right = max(x - pad, 0), min(x + text_width + pad, width)
+            if top >= bottom or left >= right:
+                continue
+            mask = np.zeros((bottom - top, right - left), dtype=np.uint8)
+            cv2.putText(mask, text, (x - left, y - top), self.FONT, scale, 255, thickness)
+            alpha = mask.astype(np.float32)[..., None] / 255
+            # Later layers go over earlier ones
+            window = premultiplied[top:bottom, left:right]
+            window[...] = window * (1 - alpha) + alpha * np.array(color, dtype=np.float32)
+            coverage[top:bottom, left:right] += alpha[..., 0] * (1 - coverage[top:bottom, left:right])
+        
+        bands = []
+        rows = np.flatnonzero(coverage.any(axis=1))
+        for run in np.split(rows, np.flatnonzero(np.diff(rows) > self.BAND_GAP) + 1) if len(rows) else []:
+            top, bottom = run[0], run[-1] + 1
+            columns = np.flatnonzero(coverage[top:bottom].any(axis=0))
+            left, right = columns[0], columns[-1] + 1
+            inverse = np.round((1 - coverage[top:bottom, left:right]) * 255).astype(np.uint8)
+            bands.append((top, bottom, left, right, cv2.merge([inverse] * 3),
+                          np.round(premultiplied[top:bottom, left:right]).astype(np.uint8)))
+        return bands
+
+    def apply(self, frame):
+        key = (frame.shape, overlay_layers())
+        bands = self.composites.get(key)
+        if bands is None:
+            if len(self.composites) > 16:
+                self.composites.clear()
+            bands = self.composites[key] = self.build(frame.shape, key[1])
+        for top, bottom, left, right, inverse, premultiplied in bands:
+            window = frame[top:bottom, left:right]
+            window[...] = cv2.add(cv2.multiply(window, inverse, scale=1 / 255), premultiplied)
+        return frame
+
+overlay_compositor = OverlayCompositor()
+
+# Draw the status and access overlays on the frame
+def draw_overlay(frame):
+    return overlay_compositor.apply(frame)
+
+# Capture stage: read frames from a source at sensor rate. Frames that the
+# inference stage has not picked up yet are replaced, never queued. Failed
+# reads back off exponentially, and a live source that keeps failing is
+# reopened.
+def capture_frames(source):
+    camera, slots = source.camera, source.slots
+    logger.info(f"Starting frame capture loop for source {source.source_id}")
+    frame_interval = 0.0 if is_live_source(source.spec) else 1.0 / (camera.get(cv2.CAP_PROP_FPS) or 30.0)
+    next_frame_at = time.monotonic()
+    frame_count = 0
+    frame_shape = None
+    failures = 0
     
-    # Check if model file exists
-    if not check_model_file():
-        logger.error("Cannot start camera: missing model file")
-        return
+    while source.camera is camera:
+        # Read straight into a pooled buffer once the frame shape is known
+        buffer = frame_pool.acquire(frame_shape) if frame_shape else None
+        start = time.perf_counter()
+        success, frame = camera.read(buffer.array if buffer else None)
+        if not success and frame_interval:
+            # Loop video files and image sequences
+            camera.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            success, frame = camera.read(buffer.array if buffer else None)
+        if not success:
+            if buffer is not None:
+                buffer.release()
+            failures += 1
+            delay = min(config['capture_retry_delay'] * 2 ** min(failures - 1, 16), config['capture_retry_max'])
+            logger.warning(f"Failed to read frame from source {source.source_id} ({failures} in a row), retrying in {delay:.2f}s")
+            metrics.inc('capture_failures', source=source.source_id)
+            retry_at = time.monotonic() + delay
+            while source.camera is camera and time.monotonic() < retry_at:
+                time.sleep(min(retry_at - time.monotonic(), 0.1))
+            if failures >= 3 and hasattr(camera, 'reconnect') and source.camera is camera:
+                # stop() may have released the camera while it was reopening
+                if camera.reconnect() and source.camera is not camera:
+                    camera.release()
+            continue
+        failures = 0
+        
+        if buffer is None or frame is not buffer.array:
+            # First frame or a resolution change: the capture allocated a new
+            # array, which the pool adopts and recycles from now on
+            if buffer is not None:
+                buffer.release()
+            buffer = frame_pool.adopt(frame)
+            frame_shape = frame.shape
+        metrics.observe('capture', time.perf_counter() - start, source.source_id)
+        
+        if frame_interval:
+            next_frame_at += frame_interval
+            time.sleep(max(next_frame_at - time.monotonic(), 0))
+        
+        packet = FramePacket(frame_count, frame, buffer, getattr(camera, 'timestamp', None))
+        source.mark_captured(packet.captured_at)
+        slots['capture'].put(packet)
+        frames_ready.set()
+            
+        frame_count += 1
+        if frame_count % 100 == 0:
+            logger.info(f"Captured {frame_count} frames from source {source.source_id}")
     
+    # Wake up and stop the downstream stages
+    for slot in slots.values():
+        slot.close()
+
+# Inference stage shared by all sources. Each round takes the newest frame of
+# every source that is due under its FPS cap and runs the detector over them as
+# one batch, so per-call overhead is amortized across cameras. The round-robin
+# starting point rotates and each source contributes at most one frame per
+# batch, so a busy source cannot starve the others.
+def inference_scheduler():
+    pin_inference_thread()
     # Load YOLOv5 model
-    if model is None:
-        load_model()
+    ensure_model()
     
-    logger.info("Starting frame capture loop")
-    frame_count = 0
+    cursor = 0
+    wait = 0.1
+    while True:
+        frames_ready.wait(timeout=wait)
+        frames_ready.clear()
+        
+        active = active_sources()
+        if not active:
+            wait = 0.1
+            continue
+        
+        cursor = (cursor + 1) % len(active)
+        now = time.monotonic()
+        batch, wait = [], 0.1
+        for source in active[cursor:] + active[:cursor]:
+            if len(batch) >= config['max_batch']:
+                # Frames left behind are picked up on the next round
+                frames_ready.set()
+                break
+            if not source.due(now):
+                wait = min(wait, source.next_due - now)
+                continue
+            packet = source.slots['capture'].get(timeout=0)
+            if packet is not None:
+                batch.append((source, packet))
+        
+        if batch:
+            process_batch(batch)
+
+# Run detection, tracking and motion gating for one scheduled batch and hand
+# every frame on to its source's annotation stage. Several scheduler threads
+# may run this at once, so per-source state is only touched under source.lock
+# and a frame that finishes after a newer one from the same source is dropped.
+def process_batch(batch):
+    requests = []
+    for source, packet in batch:
+        if not detection_enabled:
+            continue
+        with source.lock:
+            turn = source.scheduled
+            source.scheduled += 1
+            start = time.perf_counter()
+            try:
+                # Full inference every detection_stride frames, tracked boxes in between
+                if turn % config['detection_stride'] == 0:
+                    run_detector, region = source.motion_gate.check(packet.frame) if source.motion_gate else (True, None)
+                    if run_detector:
+                        requests.append((source, packet, region))
+                    else:
+                        # Static scene: reuse the last detections
+                        packet.detections = source.last_detections
+                else:
+                    packet.detections = source.tracker.propagate(packet.frame, packet.index)
+            except Exception as e:
+                logger.error(f"Tracking error: {str(e)}")
+            metrics.observe('tracking', time.perf_counter() - start, source.source_id)
+    
+    if requests:
+        start = time.perf_counter()
+        layouts = [get_tile_layout(packet.frame.shape, source.roi) if uses_layout(source.roi) else None
+                   for source, packet, _ in requests]
+        results = infer_layout_batch([packet.frame for _, packet, _ in requests],
+                                     [region for _, _, region in requests], layouts)
+        metrics.observe('inference', time.perf_counter() - start)
+        for (source, packet, region), detections in zip(requests, results or []):
+            if detections is None:
+                continue
+            with source.lock:
+                start = time.perf_counter()
+                try:
+                    if region is not None:
+                        detections = merge_region_detections(source.last_detections, detections, region)
+                    packet.detections = source.tracker.update(packet.frame, detections, packet.index)
+                    source.last_detections = packet.detections
+                except Exception as e:
+                    logger.error(f"Tracking error: {str(e)}")
+                metrics.observe('tracking', time.perf_counter() - start, source.source_id)
     
+    now = time.monotonic()
+    for source, packet in batch:
+        with source.lock:
+            if packet.index <= source.last_output_index:
+                source.stale_dropped += 1
+                packet.release()
+                continue
+            source.last_output_index = packet.index
+            source.mark_processed(now)
+            height, width = packet.frame.shape[:2]
+            source.detection_hub.publish(DetectionMessage(packet.index, packet.timestamp, width, height,
+                                                          packet.detections, source.detection_hub.latest()))
+            if detection_history.enabled:
+                detection_history.append(source.source_id, packet.timestamp, packet.detections)
+        source.slots['inference'].put(packet)
+        if source.processed % 100 == 0:
+            logger.info(f"Processed {source.processed} frames from source {source.source_id}")
+
+# Annotation stage: burn detections and status overlays into the frame
+def annotate_worker(source):
+    slots = source.slots
     while True:
-        if camera is None:
-            logger.info("Camera object is None, exiting capture loop")
+        packet = slots['inference'].get()
+        if packet is None:
             break
-            
-        success, frame = camera.read()
-        if not success:
-            logger.warning("Failed to read frame, retrying...")
-            # Try to reconnect if the camera is still available
-            if camera is not None:
+        
+        try:
+            # In client overlay mode browsers draw from the detection stream
+            if not config['client_overlay']:
+                start = time.perf_counter()
+                draw_detections(packet.frame, packet.detections)
+                drawn = time.perf_counter()
+                draw_overlay(packet.frame)
+                metrics.observe('draw', drawn - start, source.source_id)
+                metrics.observe('overlay', time.perf_counter() - drawn, source.source_id)
+        except Exception as e:
+            logger.error(f"Annotation error: {str(e)}")
+            packet.release()
+            continue
+        slots['annotate'].put(packet)
+    logger.info(f"Annotation stage for source {source.source_id} stopped")
+
+# JPEG encoder through OpenCV; subclasses wrap libjpeg-turbo bindings
+class JpegEncoder:
+    name = 'opencv'
+
+    def encode(self, frame, quality):
+        flag, encoded_frame = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not flag:
+            raise RuntimeError("cv2.imencode failed")
+        return encoded_frame.tobytes()
+
+# libjpeg-turbo through simplejpeg (pip install simplejpeg)
+class SimpleJpegEncoder(JpegEncoder):
+    name = 'simplejpeg'
+
+    def __init__(self):
+        import simplejpeg
+        self.simplejpeg = simplejpeg
+
+    def encode(self, frame, quality):
+        return self.simplejpeg.encode_jpeg(np.ascontiguousarray(frame), quality=quality, colorspace='BGR',
+                                            colorsubsampling='420')
+
+# libjpeg-turbo through PyTurboJPEG (pip install PyTurboJPEG plus the system library)
+class TurboJpegEncoder(JpegEncoder):
+    name = 'turbojpeg'
+
+    def __init__(self):
+        from turbojpeg import TurboJPEG, TJSAMP_420
+        self.turbo = TurboJPEG()
+        self.subsample = TJSAMP_420
+
+    def encode(self, frame, quality):
+        return self.turbo.encode(np.ascontiguousarray(frame), quality=quality, jpeg_subsample=self.subsample)
+
+JPEG_ENCODERS = {cls.name: cls for cls in (JpegEncoder, SimpleJpegEncoder, TurboJpegEncoder)}
+jpeg_encoder = None
+
+# Create a JPEG encoder by name, falling back to OpenCV when the optional
+# package is missing so the stream keeps working
+def create_jpeg_encoder(name):
+    try:
+        return JPEG_ENCODERS[name]()
+    except Exception as e:
+        logger.error(f"Cannot use the {name} JPEG encoder, falling back to OpenCV: {str(e)}")
+        return JpegEncoder()
+
+def get_jpeg_encoder():
+    global jpeg_encoder
+    if jpeg_encoder is None or jpeg_encoder.name != config['jpeg_encoder']:
+        jpeg_encoder = create_jpeg_encoder(config['jpeg_encoder'])
+        # Remember a fallback so it is not retried for every frame
+        config['jpeg_encoder'] = jpeg_encoder.name
+    return jpeg_encoder
+
+# Encode one frame for every tier that has clients and is due. Tiers that
+# resolve to the same width share one resize, and tiers that also share a
+# quality share one encode.
+def encode_tiers(frame, tiers, encoder, now):
+    height, width = frame.shape[:2]
+    scale, quality_cap = config['stream_scale'], config['stream_quality_cap']
+    scaled = {}
+    encoded = {}
+    try:
+        for tier in tiers:
+            if not tier.due(now):
                 continue
-            else:
+            target = tier.size if 0 < tier.size < width else width
+            if scale < 1.0 and tier.adaptive:
+                target = max(int(target * scale) // 16 * 16, 16)
+            quality = min(tier.quality, quality_cap) if tier.adaptive else tier.quality
+            data = encoded.get((target, quality))
+            if data is None:
+                if target == width:
+                    image = frame
+                else:
+                    buffer = scaled.get(target)
+                    if buffer is None:
+                        shape = (max(round(height * target / width), 1), target, frame.shape[2])
+                        buffer = scaled[target] = frame_pool.acquire(shape)
+                        cv2.resize(frame, (target, shape[0]), dst=buffer.array, interpolation=cv2.INTER_AREA)
+                    image = buffer.array
+                data = encoded[(target, quality)] = encoder.encode(image, quality)
+            tier.publish(data)
+    finally:
+        for buffer in scaled.values():
+            buffer.release()
+
+# A recording trigger: `class` detected at `confidence` or more, continuously
+# for `dwell` seconds. Gaps shorter than GAP (missed detections, skipped
+# frames) do not restart the dwell timer.
+class RecordRule:
+    GAP = 0.5
+
+    def __init__(self, class_name, confidence=0.5, dwell=0.0):
+        self.class_name = class_name
+        self.confidence = confidence
+        self.dwell = dwell
+        self.first_seen = None
+        self.last_seen = None
+
+    def update(self, names, confidences, now):
+        if not ((names == self.class_name) & (confidences >= self.confidence)).any():
+            return False
+        if self.last_seen is None or now - self.last_seen > self.GAP:
+            self.first_seen = now
+        self.last_seen = now
+        return now - self.first_seen >= self.dwell
+
+    def describe(self):
+        return {"class": self.class_name, "confidence": self.confidence, "dwell": self.dwell}
+
+# CLASS[:CONFIDENCE[:DWELL]] -> record rule settings; raises ValueError
+def parse_record_rule(text):
+    parts = text.split(':')
+    if not parts[0] or len(parts) > 3:
+        raise ValueError(f"Bad record rule {text!r}, expected CLASS[:CONFIDENCE[:DWELL]]")
+    return {
+        "class_name": parts[0],
+        "confidence": float(parts[1]) if len(parts) > 1 and parts[1] else 0.5,
+        "dwell": float(parts[2]) if len(parts) > 2 and parts[2] else 0.0,
+    }
+
+# Event recording for one source. The encoding stage encodes a recording
+# tier (exempt from the controller's stream knobs) and hands every frame
+# here; the last pre_roll seconds of encoded frames and their detections stay
+# in an in-memory ring. When a rule fires, the ring and then live frames go
+# to the clip writer until post_roll seconds after the last trigger. Nothing
+# here touches the disk, so recording never stalls the pipeline.
+class ClipRecorder:
+    def __init__(self, source_id):
+        self.source_id = source_id
+        size, quality, max_fps = stream_tier_key(config['record_size'], config['record_quality'], config['record_fps'])
+        self.tier = StreamTier(size, quality, max_fps, adaptive=False)
+        self.rules = [RecordRule(**rule) for rule in config['record_rules']]
+        self.ring = collections.deque()
+        self.ring_bytes = 0
+        self.seen = 0
+        self.clip_id = None
+        self.clip_started = 0.0
+        self.record_until = 0.0
+        self.triggers = []
+        self.clips = 0
+
+    # Take the frame the tier just encoded, if it encoded one
+    def add(self, packet):
+        if self.tier.encoded == self.seen:
+            return
+        self.seen = self.tier.encoded
+        now = packet.captured_at
+        detections = packet.detections
+        entry = (packet.timestamp, self.tier.hub.latest(), None if detections is None else detections.copy())
+        
+        self.ring.append((now, entry))
+        self.ring_bytes += len(entry[1])
+        while self.ring and (self.ring[0][0] < now - config['pre_roll'] or self.ring_bytes > config['record_ring_bytes']):
+            self.ring_bytes -= len(self.ring.popleft()[1][1])
+        
+        fired = []
+        if detections is not None and len(detections):
+            names, confidences = class_names[detections['class_id']], detections['confidence']
+            fired = [rule for rule in self.rules if rule.update(names, confidences, now)]
+        
+        if self.clip_id is None and fired:
+            self.open(packet.timestamp, now)
+            for _, ring_entry in self.ring:
+                clip_writer.submit(('frame', self.clip_id, ring_entry))
+        elif self.clip_id is not None:
+            clip_writer.submit(('frame', self.clip_id, entry))
+        
+        if fired:
+            self.record_until = min(now + config['post_roll'], self.clip_started + config['max_clip_seconds'])
+            for rule in fired:
+                if rule.describe() not in self.triggers:
+                    self.triggers.append(rule.describe())
+        if self.clip_id is not None and now >= self.record_until:
+            self.close()
+
+    def open(self, timestamp, now):
+        self.clip_id = f"{self.source_id}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp))}-{int(timestamp * 1000) % 1000:03d}"
+        self.clip_started = now
+        self.triggers = []
+        self.clips += 1
+        clip_writer.submit(('open', self.clip_id, {"source": self.source_id, "triggered_at": round(timestamp, 3)}))
+        logger.info(f"Recording clip {self.clip_id}")
+
+    def close(self):
+        if self.clip_id is None:
+            return
+        clip_writer.submit(('close', self.clip_id, {"triggers": self.triggers}))
+        self.clip_id = None
+
+    def stats(self):
+        return {
+            "rules": [rule.describe() for rule in self.rules],
+            "recording": self.clip_id,
+            "clips": self.clips,
+            "pre_roll_frames": len(self.ring),
+            "pre_roll_bytes": self.ring_bytes,
+        }
+
+# Clip ids become file names; anything else is rejected
+CLIP_ID = re.compile(r'^[\w.-]+$')
+
+# Background thread writing clips for every recorder: an MJPEG stream
+# (concatenated JPEGs, playable with ffplay -f mjpeg or VLC) and a JSON index
+# of per-frame timestamps, byte offsets and detections. Frames are dropped
+# rather than queued without bound when the disk falls behind. After each
+# clip the directory is trimmed to record_max_bytes, oldest clips first.
+class ClipWriter:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.written = 0
+        self.evicted = 0
+        self.thread = None
+
+    def submit(self, item):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="clip_writer", daemon=True)
+                self.thread.start()
+            if item[0] == 'frame':
+                if self.pending_bytes > config['record_ring_bytes']:
+                    self.dropped += 1
+                    return
+                self.pending_bytes += len(item[2][1])
+        self.queue.put(item)
+
+    def run(self):
+        clips = {}
+        while True:
+            kind, clip_id, payload = self.queue.get()
+            try:
+                if kind == 'open':
+                    os.makedirs(config['record_dir'], exist_ok=True)
+                    video = open(os.path.join(config['record_dir'], clip_id + '.mjpeg'), 'wb')
+                    clips[clip_id] = (video, dict(payload, id=clip_id), [])
+                elif kind == 'frame':
+                    with self.lock:
+                        self.pending_bytes -= len(payload[1])
+                    if clip_id in clips:
+                        self.write_frame(clips[clip_id], payload)
+                elif kind == 'close' and clip_id in clips:
+                    self.finish(*clips.pop(clip_id), payload)
+                    self.enforce_retention(set(clips))
+            except Exception as e:
+                logger.error(f"Error writing clip {clip_id}: {str(e)}")
+
+    def write_frame(self, clip, entry):
+        video, _, frames = clip
+        timestamp, data, detections = entry
+        frames.append({"ts": round(timestamp, 3), "offset": video.tell(), "size": len(data),
+                       "det": [] if detections is None else detection_rows(detections)})
+        video.write(data)
+
+    def finish(self, video, meta, frames, payload):
+        video.close()
+        meta.update(payload)
+        meta.update({
+            "started": frames[0]["ts"] if frames else meta["triggered_at"],
+            "ended": frames[-1]["ts"] if frames else meta["triggered_at"],
+            "frame_count": len(frames),
+            "bytes": sum(frame["size"] for frame in frames),
+            "names": {int(i): str(name) for i, name in enumerate(class_names)
+                      if any(row[1] == i for frame in frames for row in frame["det"])},
+            "frames": frames,
+        })
+        meta["duration"] = round(meta["ended"] - meta["started"], 3)
+        path = os.path.join(config['record_dir'], meta["id"] + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+        self.written += 1
+        logger.info(f"Saved clip {meta['id']}: {len(frames)} frames, {meta['duration']}s")
+
+    # Delete the oldest finished clips until the directory fits the budget
+    def enforce_retention(self, open_clips):
+        clips = list_clips()
+        total = sum(clip["disk_bytes"] for clip in clips)
+        for clip in sorted(clips, key=lambda clip: clip["started"]):
+            if total <= config['record_max_bytes']:
                 break
-            
-        # Apply object detection if enabled (only on every other frame to improve performance)
-        if detection_enabled:
-            frame = detect_objects(frame)
-            
-        # Add a status on the frame
-        cv2.putText(
-            frame, 
-            f"Detection: {'ON' if detection_enabled else 'OFF'}", 
-            (10, 30), 
-            cv2.FONT_HERSHEY_SIMPLEX, 
-            0.8, 
-            (0, 0, 255), 
-            2
-        )
+            if clip["id"] in open_clips:
+                continue
+            for extension in ('.mjpeg', '.json'):
+                path = os.path.join(config['record_dir'], clip["id"] + extension)
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= clip["disk_bytes"]
+            self.evicted += 1
+            logger.info(f"Evicted clip {clip['id']} to stay under {config['record_max_bytes']} bytes")
+
+    def stats(self):
+        return {
+            "directory": config['record_dir'],
+            "clips_written": self.written,
+            "clips_evicted": self.evicted,
+            "frames_dropped": self.dropped,
+            "queued_bytes": self.pending_bytes,
+        }
+
+clip_writer = ClipWriter()
+
+# Saved clips, newest first, without their per-frame index
+def list_clips():
+    directory = config['record_dir']
+    if not os.path.isdir(directory):
+        return []
+    clips = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        meta.pop("frames", None)
+        video = os.path.join(directory, meta["id"] + '.mjpeg')
+        meta["disk_bytes"] = os.path.getsize(path) + (os.path.getsize(video) if os.path.exists(video) else 0)
+        clips.append(meta)
+    return sorted(clips, key=lambda clip: clip["started"], reverse=True)
+
+# One logged detection: 28 bytes. Timestamps are wall-clock seconds and never
+# decrease across the log, so the ts column doubles as the time index.
+HISTORY_DTYPE = np.dtype([
+    ('ts', '<f8'), ('source', '<u2'), ('class_id', '<i2'), ('track_id', '<i4'), ('confidence', '<f4'),
+    ('x1', '<u2'), ('y1', '<u2'), ('x2', '<u2'), ('y2', '<u2'),
+])
+
+# Per-minute rollup of one source and class; class -1 rows only count the
+# frames logged. present = frames containing the class, max_count = most at
+# once, new_tracks = tracks appearing after HISTORY_TRACK_GAP seconds unseen.
+ROLLUP_DTYPE = np.dtype([
+    ('minute', '<i4'), ('source', '<u2'), ('class_id', '<i2'), ('frames', '<u4'),
+    ('present', '<u4'), ('detections', '<u4'), ('max_count', '<u2'), ('new_tracks', '<u4'),
+])
+HISTORY_TRACK_GAP = 60.0
+
+# A fixed-capacity memory-mapped file of HISTORY_DTYPE records. Unused
+# records are all zero, which is how the fill level is found on reopen.
+class HistorySegment:
+    def __init__(self, path, capacity=None):
+        self.path = path
+        if capacity is not None:
+            self.records = np.memmap(path, dtype=HISTORY_DTYPE, mode='w+', shape=(capacity,))
+            self.count = 0
+        else:
+            self.records = np.memmap(path, dtype=HISTORY_DTYPE, mode='r+')
+            empty = self.records['ts'] == 0
+            self.count = int(empty.argmax()) if empty.any() else len(self.records)
+
+    @property
+    def first_ts(self):
+        return float(self.records['ts'][0]) if self.count else None
+
+    @property
+    def last_ts(self):
+        return float(self.records['ts'][self.count - 1]) if self.count else None
+
+    # Append as many records as fit; returns how many were written
+    def append(self, records):
+        n = min(len(records), len(self.records) - self.count)
+        self.records[self.count:self.count + n] = records[:n]
+        self.count += n
+        return n
+
+    # Records with start <= ts < end, found by binary search on ts
+    def window(self, start, end):
+        ts = self.records['ts'][:self.count]
+        return self.records[np.searchsorted(ts, start):np.searchsorted(ts, end)]
+
+    def close(self):
+        self.records.flush()
+        del self.records
+
+# Rollup rows of one open minute for one source, built up frame by frame
+class MinuteRollup:
+    def __init__(self, minute, source):
+        self.minute = minute
+        self.source = source
+        self.frames = 0
+        self.classes = {}
+
+    def add(self, class_ids, new_tracks):
+        self.frames += 1
+        for class_id, count in zip(*np.unique(class_ids, return_counts=True)):
+            row = self.classes.setdefault(int(class_id), [0, 0, 0, 0])
+            row[0] += 1
+            row[1] += int(count)
+            row[2] = max(row[2], int(count))
+        for class_id, count in new_tracks.items():
+            self.classes[class_id][3] += count
+
+    def rows(self):
+        rows = np.zeros(len(self.classes) + 1, dtype=ROLLUP_DTYPE)
+        rows['minute'], rows['source'], rows['frames'] = self.minute, self.source, self.frames
+        rows['class_id'][0] = -1
+        for row, (class_id, (present, detections, max_count, new_tracks)) in zip(rows[1:], sorted(self.classes.items())):
+            row['class_id'], row['present'], row['detections'] = class_id, present, detections
+            row['max_count'], row['new_tracks'] = min(max_count, 65535), new_tracks
+        return rows
+
+# Append-only detection log: HISTORY_DTYPE records in memory-mapped segment
+# files, per-minute ROLLUP_DTYPE rows in rollups.bin, and last-seen times in
+# memory. The pipeline only enqueues (at most one frame per source every
+# history_interval); a writer thread batches records into the segments and
+# updates the rollups incrementally. Queries binary-search the minute column
+# of the rollups, so ranges over weeks cost a slice and a few sums.
+class DetectionHistory:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=10000)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.directory = None
+        self.source_ids = {}
+        self.segments = []
+        self.rollup_chunks = []
+        self.open_minutes = {}
+        self.last_seen = {}
+        self.track_seen = {}
+        self.next_due = {}
+        self.last_ts = 0.0
+        self.logged = 0
+        self.dropped = 0
+
+    # Open the store in config['history_dir'] and start the writer
+    def start(self):
+        directory = self.directory = config['history_dir']
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'sources.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                self.source_ids = json.load(f)
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.startswith('segment-'):
+                segment = HistorySegment(os.path.join(directory, name))
+                if segment.count:
+                    self.segments.append(segment)
+                else:
+                    segment.close()
+                    os.remove(segment.path)
+        if self.segments:
+            self.last_ts = self.segments[-1].last_ts
+        path = os.path.join(directory, 'rollups.bin')
+        if os.path.exists(path):
+            self.rollup_chunks = [np.fromfile(path, dtype=ROLLUP_DTYPE)]
         
-        # Add IP address to frame
-        cv2.putText(
-            frame,
-            f"Access: http://{get_ip_address()}:5000",
-            (10, frame.shape[0] - 10),
-            cv2.FONT_HERSHEY_SIMPLEX,
-            0.6,
-            (255, 255, 255),
-            1
-        )
+        # Exact last-seen times: the newest rollup minute with each class,
+        # then the newest raw record of that class inside it
+        rollups = self.rollups()
+        seen = rollups[(rollups['class_id'] >= 0) & (rollups['detections'] > 0)]
+        for minute, source, class_id in zip(seen['minute'], seen['source'], seen['class_id']):
+            self.last_seen[(int(source), int(class_id))] = float(minute) * 60
+        for (source, class_id), ts in self.last_seen.items():
+            records = self.window(ts, ts + 60)
+            records = records[(records['source'] == source) & (records['class_id'] == class_id)]
+            if len(records):
+                self.last_seen[(source, class_id)] = float(records['ts'].max())
+        
+        self.thread = threading.Thread(target=self.run, name="detection_history", daemon=True)
+        self.thread.start()
+        logger.info(f"Detection history in {directory}: {sum(s.count for s in self.segments)} detections, "
+                    f"{len(rollups)} rollup rows")
+
+    @property
+    def enabled(self):
+        return self.thread is not None
+
+    # Called from the pipeline for every processed frame; never blocks
+    def append(self, source_id, timestamp, detections):
+        interval = config['history_interval']
+        if interval:
+            if timestamp < self.next_due.get(source_id, 0.0):
+                return
+            self.next_due[source_id] = timestamp + interval
+        try:
+            self.queue.put_nowait((source_id, timestamp, None if detections is None else detections.copy()))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            # Up to 1000 frames per write, waking at least once a second to close minutes
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=1.0))
+                while len(batch) < 1000:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                with self.lock:
+                    self.write(batch)
+                    self.close_minutes(int(time.time() // 60))
+                if time.monotonic() - last_flush > 5:
+                    self.flush()
+                    last_flush = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error writing detection history: {str(e)}")
+
+    def source_index(self, source_id):
+        index = self.source_ids.get(source_id)
+        if index is None:
+            index = self.source_ids[source_id] = len(self.source_ids)
+            with open(os.path.join(self.directory, 'sources.json'), 'w') as f:
+                json.dump(self.source_ids, f)
+        return index
+
+    def write(self, batch):
+        parts = []
+        for source_id, timestamp, detections in sorted(batch, key=lambda item: item[1]):
+            source = self.source_index(source_id)
+            # Frames from different sources can arrive slightly out of order;
+            # clamping keeps the ts column sorted
+            timestamp = self.last_ts = max(timestamp, self.last_ts)
+            detections = detections if detections is not None else np.empty(0, dtype=DETECTION_DTYPE)
             
-        # Update the output frame
-        with lock:
-            output_frame = frame.copy()
+            new_tracks = {}
+            for track_id, class_id in zip(detections['track_id'].tolist(), detections['class_id'].tolist()):
+                self.last_seen[(source, class_id)] = timestamp
+                if track_id < 0:
+                    continue
+                if timestamp - self.track_seen.get((source, track_id), float('-inf')) > HISTORY_TRACK_GAP:
+                    new_tracks[class_id] = new_tracks.get(class_id, 0) + 1
+                self.track_seen[(source, track_id)] = timestamp
+            self.minute_rollup(source, int(timestamp // 60)).add(detections['class_id'], new_tracks)
             
-        frame_count += 1
-        if frame_count % 100 == 0:
-            logger.info(f"Processed {frame_count} frames")
+            records = np.zeros(len(detections), dtype=HISTORY_DTYPE)
+            records['ts'], records['source'] = timestamp, source
+            for name in ('class_id', 'track_id', 'confidence'):
+                records[name] = detections[name]
+            for name in ('x1', 'y1', 'x2', 'y2'):
+                records[name] = np.clip(detections[name], 0, 65535)
+            parts.append(records)
+        
+        records = np.concatenate(parts) if parts else np.empty(0, dtype=HISTORY_DTYPE)
+        while len(records):
+            if not self.segments or self.segments[-1].count == len(self.segments[-1].records):
+                self.new_segment(float(records['ts'][0]))
+            records = records[self.segments[-1].append(records):]
+        self.logged += sum(len(part) for part in parts)
+        
+        # Forget tracks that have been gone long enough to count as new again
+        if len(self.track_seen) > 10000:
+            cutoff = self.last_ts - HISTORY_TRACK_GAP
+            self.track_seen = {key: ts for key, ts in self.track_seen.items() if ts >= cutoff}
 
-# Generate video frames for streaming
-def generate():
-    global output_frame, lock
+    def new_segment(self, first_ts):
+        path = os.path.join(self.directory, f"segment-{int(first_ts * 1000):015d}.bin")
+        if self.segments:
+            self.segments[-1].records.flush()
+        self.segments.append(HistorySegment(path, config['history_segment_records']))
+        
+        # Drop raw segments past retention; their rollups are kept
+        cutoff = time.time() - config['history_days'] * 86400
+        while len(self.segments) > 1 and self.segments[0].last_ts < cutoff:
+            segment = self.segments.pop(0)
+            segment.close()
+            os.remove(segment.path)
+            logger.info(f"Deleted expired detection history segment {segment.path}")
+
+    # The open rollup of source for minute, closing an older one first
+    def minute_rollup(self, source, minute):
+        rollup = self.open_minutes.get(source)
+        if rollup is not None and rollup.minute < minute:
+            self.store_rollups([self.open_minutes.pop(source).rows()])
+            rollup = None
+        if rollup is None:
+            rollup = self.open_minutes[source] = MinuteRollup(minute, source)
+        return rollup
+
+    # Close rollups of minutes that have ended (with a few seconds' grace for
+    # frames still in the queue)
+    def close_minutes(self, current_minute):
+        if time.time() % 60 < 5:
+            current_minute -= 1
+        finished = sorted(source for source, rollup in self.open_minutes.items() if rollup.minute < current_minute)
+        if finished:
+            self.store_rollups([self.open_minutes.pop(source).rows() for source in finished])
+
+    def store_rollups(self, parts):
+        rows = np.concatenate(parts)
+        with open(os.path.join(self.directory, 'rollups.bin'), 'ab') as f:
+            f.write(rows.tobytes())
+        self.rollup_chunks.append(rows)
+
+    def flush(self):
+        with self.lock:
+            if self.segments:
+                self.segments[-1].records.flush()
+
+    # All rollup rows including the open minutes, sorted by minute. Closed
+    # chunks are merged (and re-sorted, in case a late frame reopened an old
+    # minute) only when new ones were stored.
+    def rollups(self):
+        if len(self.rollup_chunks) != 1:
+            rows = np.concatenate(self.rollup_chunks) if self.rollup_chunks else np.zeros(0, dtype=ROLLUP_DTYPE)
+            self.rollup_chunks = [rows[np.argsort(rows['minute'], kind='stable')]]
+        rows = self.rollup_chunks[0]
+        if self.open_minutes:
+            rows = np.concatenate([rows] + [rollup.rows() for rollup in self.open_minutes.values()])
+            rows = rows[np.argsort(rows['minute'], kind='stable')]
+        return rows
+
+    # Raw records with start <= ts < end across segments
+    def window(self, start, end):
+        parts = [segment.window(start, end) for segment in self.segments
+                 if segment.count and segment.first_ts < end and segment.last_ts >= start]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=HISTORY_DTYPE)
+
+    # Rollup rows for the minutes overlapping [start, end), optionally for one
+    # source and class
+    def select(self, start, end, source_id=None, class_id=None):
+        with self.lock:
+            rows = self.rollups()
+        minutes = rows['minute']
+        rows = rows[np.searchsorted(minutes, int(start // 60)):np.searchsorted(minutes, int(-(-end // 60)))]
+        if source_id is not None:
+            rows = rows[rows['source'] == self.source_ids.get(source_id, -1)]
+        frames = rows[rows['class_id'] == -1]
+        rows = rows[rows['class_id'] >= 0]
+        if class_id is not None:
+            rows = rows[rows['class_id'] == class_id]
+        return rows, frames
+
+    # Totals per class over [start, end) at minute resolution
+    def counts(self, start, end, source_id=None, class_id=None):
+        rows, frames = self.select(start, end, source_id, class_id)
+        frame_total = int(frames['frames'].sum())
+        classes = {}
+        for class_id in np.unique(rows['class_id']).tolist():
+            selected = rows[rows['class_id'] == class_id]
+            detections = int(selected['detections'].sum())
+            classes[class_name(class_id)] = {
+                "detections": detections,
+                "frames_present": int(selected['present'].sum()),
+                "max_at_once": int(selected['max_count'].max()),
+                "new_tracks": int(selected['new_tracks'].sum()),
+                "mean_occupancy": round(detections / frame_total, 3) if frame_total else 0.0,
+            }
+        return {"frames_logged": frame_total, "classes": classes}
+
+    # Per-bucket series over [start, end); bucket is rounded to whole minutes
+    def histogram(self, start, end, bucket=60, source_id=None, class_id=None):
+        rows, frames = self.select(start, end, source_id, class_id)
+        step = max(int(bucket // 60), 1)
+        first = int(start // 60)
+        count = max(-(-(int(-(-end // 60)) - first) // step), 1)
+        def index(minutes):
+            return np.clip((minutes.astype(np.int64) - first) // step, 0, count - 1)
+        
+        frame_counts = np.bincount(index(frames['minute']), weights=frames['frames'], minlength=count)
+        detections = np.bincount(index(rows['minute']), weights=rows['detections'], minlength=count)
+        new_tracks = np.bincount(index(rows['minute']), weights=rows['new_tracks'], minlength=count)
+        max_count = np.zeros(count, dtype=np.int64)
+        np.maximum.at(max_count, index(rows['minute']), rows['max_count'])
+        occupancy = np.divide(detections, frame_counts, out=np.zeros(count), where=frame_counts > 0)
+        return {
+            "start": first * 60,
+            "bucket": step * 60,
+            "frames_logged": frame_counts.astype(np.int64).tolist(),
+            "detections": detections.astype(np.int64).tolist(),
+            "new_tracks": new_tracks.astype(np.int64).tolist(),
+            "max_at_once": max_count.tolist(),
+            "mean_occupancy": np.round(occupancy, 3).tolist(),
+        }
+
+    # Newest sighting per source and class
+    def last_seen_times(self, source_id=None, class_id=None):
+        names = {index: name for name, index in self.source_ids.items()}
+        with self.lock:
+            items = list(self.last_seen.items())
+        now = time.time()
+        return [
+            {"source": names.get(source), "class": class_name(seen_class), "ts": round(ts, 3), "ago_s": round(now - ts, 1)}
+            for (source, seen_class), ts in sorted(items, key=lambda item: -item[1])
+            if (source_id is None or names.get(source) == source_id) and (class_id is None or seen_class == class_id)
+        ]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "directory": self.directory,
+                "segments": len(self.segments),
+                "detections_stored": sum(segment.count for segment in self.segments),
+                "detections_logged": self.logged,
+                "rollup_rows": sum(len(chunk) for chunk in self.rollup_chunks),
+                "queued": self.queue.qsize(),
+                "dropped": self.dropped,
+                "first_ts": self.segments[0].first_ts if self.segments else None,
+                "last_ts": self.segments[-1].last_ts if self.segments else None,
+            }
+
+detection_history = DetectionHistory()
+
+# Name of a class id, or the id as a string when the model has no name for it
+def class_name(class_id):
+    if 0 <= class_id < len(class_names) and class_names[class_id] is not None:
+        return str(class_names[class_id])
+    return str(class_id)
+
+# Encoding stage: JPEG-encode the annotated frame and publish it
+def encode_worker(source):
+    slots = source.slots
+    while True:
+        packet = slots['annotate'].get()
+        if packet is None:
+            break
+        
+        # Encode the frame for the tiers viewers asked for, then hand its
+        # buffer back to the pool. Without viewers nothing is encoded.
+        try:
+            tiers = source.active_tiers()
+            recorder = source.recorder
+            if recorder is not None:
+                tiers.append(recorder.tier)
+            if tiers:
+                start = time.perf_counter()
+                encode_tiers(packet.frame, tiers, get_jpeg_encoder(), time.monotonic())
+                metrics.observe('encode', time.perf_counter() - start, source.source_id)
+            if recorder is not None:
+                recorder.add(packet)
+            # Capture to encoded output, including time spent waiting in slots
+            metrics.observe('end_to_end', time.monotonic() - packet.captured_at, source.source_id)
+            startup.mark('first_frame_s')
+        except Exception as e:
+            logger.error(f"Error encoding frame: {str(e)}")
+        finally:
+            packet.release()
+    logger.info(f"Encoding stage for source {source.source_id} stopped")
+
+# One setting the adaptive controller may move. The ladder runs from best
+# quality to cheapest; a pinned knob keeps whatever value it was given.
+class ControlKnob:
+    def __init__(self, name, group, ladder, read, write, available=None):
+        self.name = name
+        self.group = group
+        self.ladder = list(ladder)
+        self.read = read
+        self.write = write
+        self.available = available or (lambda: True)
+
+    @property
+    def pinned(self):
+        return self.name in config['pinned']
+
+    # Ladder position of the current value (the closest rung if it is off the ladder)
+    def position(self):
+        value = self.read()
+        return min(range(len(self.ladder)), key=lambda i: abs(self.ladder[i] - value))
+
+    # Relative degradation, 0 = best quality, 1 = cheapest rung
+    def level(self):
+        return self.position() / max(len(self.ladder) - 1, 1)
+
+    # Move one rung (+1 cheaper, -1 better); returns (old, new) or None at the end of the ladder
+    def step(self, direction):
+        index = self.position() + direction
+        if not 0 <= index < len(self.ladder):
+            return None
+        old = self.read()
+        self.write(self.ladder[index])
+        return old, self.ladder[index]
+
+    def status(self):
+        return {"value": self.read(), "pinned": self.pinned, "available": self.available(), "ladder": self.ladder}
+
+def set_input_size(size):
+    model.input_size = size
+
+def input_size_adjustable():
+    return model is not None and model.supports_input_size
+
+# Closed loop over detection stride, inference size and stream size/quality.
+# Every interval it measures the slowest source's inference FPS and the p99
+# capture-to-output latency over that interval. Over budget, it degrades
+# one knob by one rung; with clear headroom, it restores one. It only
+# touches knobs of the group that costs most (inference or streaming)
+# while that group has rungs left, picks the knob in the group that has
+# been degraded least, and waits a few intervals after every change so
+# the effect shows up in the measurements before the next decision. A knob
+# that has to be degraded again right after it was restored is flapping; it
+# is held at the cheaper rung for a backoff that doubles with every flap.
+class AdaptiveController:
+    def __init__(self):
+        self.knobs = [
+            ControlKnob('detection_stride', 'inference', (1, 2, 3, 4, 6),
+                        lambda: config['detection_stride'], lambda value: config.update(detection_stride=value)),
+            ControlKnob('inference_size', 'inference', (640, 512, 416, 320),
+                        lambda: model.input_size if input_size_adjustable() else config['imgsz'],
+                        set_input_size, input_size_adjustable),
+            ControlKnob('stream_scale', 'stream', (1.0, 0.75, 0.5, 0.35),
+                        lambda: config['stream_scale'], lambda value: config.update(stream_scale=value)),
+            ControlKnob('stream_quality', 'stream', (100, 85, 75, 60, 50),
+                        lambda: config['stream_quality_cap'], lambda value: config.update(stream_quality_cap=value)),
+        ]
+        self.decisions = collections.deque(maxlen=20)
+        self.state = 'idle'
+        self.measured = {}
+        self.cooldown = 0
+        self.previous_counts = {}
+        self.last_direction = {}
+        self.flaps = {}
+        self.hold_until = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def knob(self, name):
+        for knob in self.knobs:
+            if knob.name == name:
+                return knob
+        raise ValueError(f"Unknown knob {name}")
+
+    # Latency histogram counts of a stage over every source since the last call
+    def window(self, stage):
+        counts, total, count = metrics.stage_counts(stage)
+        previous = self.previous_counts.get(stage)
+        self.previous_counts[stage] = (counts, total, count)
+        if previous is None:
+            return None
+        counts = [now - before for now, before in zip(counts, previous[0])]
+        return counts, total - previous[1], count - previous[2]
+
+    def measure(self):
+        running = active_sources()
+        latency = self.window('end_to_end')
+        inference = self.window('inference')
+        encode = self.window('encode')
+        measured = {
+            "inference_fps": round(min((s.inference_fps for s in running), default=0.0), 2),
+            "capture_fps": round(min((s.capture_fps for s in running), default=0.0), 2),
+            "p99_latency_ms": None,
+            "inference_ms": None,
+            "encode_ms": None,
+        }
+        # Too few samples in the window to trust a p99
+        if latency and latency[2] >= 5:
+            measured["p99_latency_ms"] = round(LatencyHistogram().quantile(0.99, latency[0], latency[2]) * 1e3, 2)
+        if inference and inference[2]:
+            measured["inference_ms"] = round(inference[1] / inference[2] * 1e3, 2)
+        if encode and encode[2]:
+            measured["encode_ms"] = round(encode[1] / encode[2] * 1e3, 2)
+        return measured
+
+    def decide(self):
+        target_fps, target_latency = config['target_fps'], config['target_latency_ms']
+        measured = self.measured = self.measure()
+        if not (target_fps or target_latency) or not active_sources():
+            self.state = 'idle'
+            return
+        
+        # A camera slower than the target caps what any setting can reach
+        fps_goal = min(target_fps, measured['capture_fps'] * 0.95) if target_fps else 0
+        latency = measured['p99_latency_ms']
+        over = ((fps_goal and measured['inference_fps'] < fps_goal * 0.9) or
+                (target_latency and latency is not None and latency > target_latency))
+        headroom = ((not fps_goal or measured['inference_fps'] >= fps_goal * 1.2) and
+                    (not target_latency or (latency is not None and latency < target_latency * 0.6)))
+        self.state = 'over_budget' if over else 'headroom' if headroom else 'steady'
+        if self.cooldown > 0:
+            self.cooldown -= 1
+            return
+        if not over and not headroom:
+            return
+        
+        direction = 1 if over else -1
+        # Streaming knobs when encoding costs more than inference, else inference knobs
+        stream_heavy = (measured['encode_ms'] or 0) > (measured['inference_ms'] or 0) / max(config['detection_stride'], 1)
+        preferred = 'stream' if stream_heavy else 'inference'
+        now = time.monotonic()
+        candidates = [knob for knob in self.knobs if not knob.pinned and knob.available()
+                      and (over or self.hold_until.get(knob.name, 0) <= now)]
+        candidates.sort(key=lambda knob: (knob.group != preferred if over else knob.group == preferred,
+                                          knob.level() * direction))
+        for knob in candidates:
+            change = knob.step(direction)
+            if change is not None:
+                reason = "over budget" if over else "headroom"
+                if over and self.last_direction.get(knob.name) == -1:
+                    flaps = self.flaps[knob.name] = min(self.flaps.get(knob.name, 0) + 1, 6)
+                    hold = config['controller_interval'] * 10 * 2 ** (flaps - 1)
+                    self.hold_until[knob.name] = now + hold
+                    reason += f", flapping: held for {hold:.0f} s"
+                self.last_direction[knob.name] = direction
+                self.record(knob.name, change[0], change[1], reason)
+                self.cooldown = config['controller_cooldown']
+                return
+
+    def record(self, name, old, new, reason):
+        decision = {"time": round(time.time(), 3), "knob": name, "from": old, "to": new, "reason": reason,
+                    "measured": dict(self.measured)}
+        self.decisions.append(decision)
+        logger.info(f"Controller: {name} {old} -> {new} ({reason})")
+
+    # Set a knob by hand and keep the controller off it until unpinned
+    def pin(self, name, value=None):
+        knob = self.knob(name)
+        if value is not None:
+            if not knob.available():
+                raise ValueError(f"{name} cannot be changed with the current backend")
+            old = knob.read()
+            knob.write(type(knob.ladder[0])(value))
+            self.record(name, old, knob.read(), "pinned")
+        if name not in config['pinned']:
+            config['pinned'].append(name)
+
+    def unpin(self, name):
+        self.knob(name)
+        if name in config['pinned']:
+            config['pinned'].remove(name)
+
+    def run(self):
+        while True:
+            time.sleep(config['controller_interval'])
+            try:
+                self.decide()
+            except Exception as e:
+                logger.error(f"Controller error: {str(e)}")
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="adaptive_controller", daemon=True)
+                self.thread.start()
+
+    def status(self):
+        return {
+            "state": self.state,
+            "target_fps": config['target_fps'],
+            "target_latency_ms": config['target_latency_ms'],
+            "measured": self.measured,
+            "knobs": {knob.name: dict(knob.status(), held_for_s=round(max(self.hold_until.get(knob.name, 0) - time.monotonic(), 0), 1))
+                      for knob in self.knobs},
+            "decisions": list(self.decisions),
+        }
+
+controller = AdaptiveController()
+
+# One frame's detections as published on a source's detection hub. Full
+# JSON and binary encodings, and the delta against the previous message, are
+# built once on first use and shared by every subscriber.
+class DetectionMessage:
+    # Binary header: seq, capture time, frame width/height, flags, row count
+    HEADER = struct.Struct('<IdHHBH')
+    FLAG_DELTA = 1
+    
+    def __init__(self, seq, timestamp, width, height, detections, previous=None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.width = width
+        self.height = height
+        self.detections = detections if detections is not None else np.empty(0, dtype=DETECTION_DTYPE)
+        self.previous = previous
+        self.cache = {}
+        # Only the previous message is needed for deltas; drop older history
+        if previous is not None:
+            previous.previous = None
+
+    # Rows that changed since the previous message, and track ids that disappeared.
+    # None when a delta is impossible (no previous message or untracked rows).
+    def delta(self):
+        previous = self.previous
+        if previous is None or (self.detections['track_id'] < 0).any() or (previous.detections['track_id'] < 0).any():
+            return None
+        old = {int(row['track_id']): row.tobytes() for row in previous.detections}
+        changed = np.array([old.get(int(row['track_id'])) != row.tobytes() for row in self.detections], dtype=bool)
+        removed = sorted(set(old) - set(self.detections['track_id'].tolist()))
+        return self.detections[changed], removed
+    
+    def to_json(self, delta=False):
+        key = ('json', delta)
+        if key not in self.cache:
+            message = {"seq": self.seq, "ts": round(self.timestamp, 3), "w": self.width, "h": self.height}
+            diff = self.delta() if delta else None
+            rows = self.detections if diff is None else diff[0]
+            # [track, class, confidence, x1, y1, x2, y2]
+            table = detection_rows(rows)
+            if diff is None:
+                message["det"] = table
+            else:
+                message["upd"], message["del"] = table, diff[1]
+            self.cache[key] = json.dumps(message, separators=(',', ':'))
+        return self.cache[key]
     
-    while True:
-        with lock:
-            if output_frame is None:
+    def to_binary(self, delta=False):
+        key = ('binary', delta)
+        if key not in self.cache:
+            diff = self.delta() if delta else None
+            rows = self.detections if diff is None else diff[0]
+            flags = 0 if diff is None else self.FLAG_DELTA
+            payload = [self.HEADER.pack(self.seq & 0xFFFFFFFF, self.timestamp, self.width, self.height, flags, len(rows)),
+                       np.ascontiguousarray(rows).tobytes()]
+            if diff is not None:
+                payload.append(struct.pack(f'<H{len(diff[1])}i', len(diff[1]), *diff[1]))
+            self.cache[key] = b''.join(payload)
+        return self.cache[key]
+
+# Metadata sent once when a detection stream opens
+def detection_stream_meta():
+    return {
+        "names": [str(name) for name in class_names.tolist()],
+        "row": ["track", "class", "confidence_pct", "x1", "y1", "x2", "y2"],
+        "binary_dtype": [[name, DETECTION_DTYPE[name].str] for name in DETECTION_DTYPE.names],
+    }
+
+# Per-subscriber delta state: a message may be sent as a delta only when it
+# directly follows the last message this subscriber received
+class DeltaCursor:
+    def __init__(self, delta=False, keyframe_interval=30):
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.last_message = None
+        self.sent = 0
+
+    def advance(self, message):
+        use_delta = (self.delta and self.last_message is not None
+                     and message.previous is self.last_message
+                     and self.sent % self.keyframe_interval != 0)
+        self.last_message = message
+        self.sent += 1
+        return use_delta
+
+# Yield successive detection messages of a source. A delta subscriber gets a
+# full keyframe first, after skipping frames and every keyframe_interval messages.
+def detection_updates(source, delta=False, keyframe_interval=30):
+    hub = source.detection_hub
+    last_seq = 0
+    cursor = DeltaCursor(delta, keyframe_interval)
+    with hub.cond:
+        hub.viewers += 1
+    try:
+        while True:
+            last_seq, message = hub.wait_newer(last_seq, timeout=1.0)
+            if message is None:
+                yield None, False
                 continue
-            
-            # Encode the frame as JPEG
-            try:
-                (flag, encoded_frame) = cv2.imencode(".jpg", output_frame)
-                
-                if not flag:
-                    continue
-            except Exception as e:
-                logger.error(f"Error encoding frame: {str(e)}")
+            yield message, cursor.advance(message)
+    finally:
+        with hub.cond:
+            hub.viewers -= 1
+
+# Server-Sent Events stream of detection messages
+def generate_detection_events(source, delta=False):
+    yield f"event: meta\ndata: {json.dumps(detection_stream_meta())}\n\n"
+    for message, use_delta in detection_updates(source, delta):
+        if message is None:
+            # Keep idle connections alive
+            yield ": keep-alive\n\n"
+            continue
+        event = f"id: {message.seq}\ndata: {message.to_json(use_delta)}\n\n"
+        metrics.inc('bytes_sent', len(event), source=source.source_id, stream='detections')
+        yield event
+
+# Generate video frames for streaming
+def generate(source, tier_key):
+    # Joined here rather than in the route so a client that never starts
+    # reading cannot leave a tier behind
+    tier = source.join_tier(tier_key)
+    hub = tier.hub
+    last_seq = 0
+    try:
+        while True:
+            # Sleep until the encoding stage publishes a newer frame
+            last_seq, encoded_frame = hub.wait_newer(last_seq, timeout=1.0)
+            if encoded_frame is None:
                 continue
-                
-        # Yield the output frame in byte format
-        yield(b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + 
-              bytearray(encoded_frame) + b'\r\n')
+                    
+            # Yield the output frame in byte format
+            chunk = b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + encoded_frame + b'\r\n'
+            metrics.inc('bytes_sent', len(chunk), source=source.source_id, stream='video')
+            yield chunk
+    finally:
+        source.leave_tier(tier)
 
-# Get the IP address of the machine
-def get_ip_address():
+# Resolve the IP address of the machine
+def resolve_ip_address():
     try:
         # Get the primary IP address
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -182,36 +4051,94 @@ def get_ip_address():
         logger.error(f"Error getting IP address: {str(e)}")
         return "127.0.0.1"  # Fallback to localhost
 
+# Names of the network interfaces, to notice one coming or going
+def interface_signature():
+    try:
+        return tuple(sorted(name for _, name in socket.if_nameindex()))
+    except (AttributeError, OSError):
+        return None
+
+# Cached server IP address. A background thread re-resolves it every
+# ip_refresh seconds, and within a couple of seconds when an interface is
+# added or removed, so frames and page loads never touch a socket.
+class NetworkInfo:
+    CHECK_INTERVAL = 2.0
+
+    def __init__(self):
+        self.ip = None
+        self.interfaces = None
+        self.lock = threading.Lock()
+
+    def address(self):
+        if self.ip is None:
+            with self.lock:
+                if self.ip is None:
+                    self.interfaces = interface_signature()
+                    self.ip = resolve_ip_address()
+                    threading.Thread(target=self.run, name="network_info", daemon=True).start()
+        return self.ip
+
+    def run(self):
+        resolved_at = time.monotonic()
+        while True:
+            time.sleep(self.CHECK_INTERVAL)
+            interfaces = interface_signature()
+            if interfaces == self.interfaces and time.monotonic() - resolved_at < config['ip_refresh']:
+                continue
+            ip = resolve_ip_address()
+            if ip != self.ip:
+                logger.info(f"Server IP address changed: {self.ip} -> {ip}")
+            self.ip, self.interfaces, resolved_at = ip, interfaces, time.monotonic()
+
+network_info = NetworkInfo()
+
+# Get the IP address of the machine
+def get_ip_address():
+    return network_info.address()
+
 # API routes
 @app.route('/')
 def index():
     ip_address = get_ip_address()
-    return render_template('index.html', ip_address=ip_address)
+    return render_template('index.html', ip_address=ip_address, client_overlay=config['client_overlay'])
 
+# Optional ?size=<width>&quality=<10-100>&max_fps=<n> select a stream tier
 @app.route('/video_feed')
-def video_feed():
-    return Response(generate(),
+@app.route('/video_feed/<source_id>')
+def video_feed(source_id=DEFAULT_SOURCE_ID):
+    try:
+        tier_key = stream_tier_key(request.args.get('size'), request.args.get('quality'), request.args.get('max_fps'))
+    except ValueError as e:
+        return jsonify({"status": f"Invalid stream parameters: {str(e)}", "success": False}), 400
+    
+    source = get_source(source_id)
+    if source is None:
+        if source_id != DEFAULT_SOURCE_ID:
+            return jsonify({"status": f"Unknown source {source_id}", "success": False}), 404
+        # Viewers may connect before the default camera is started
+        source = get_or_add_source(DEFAULT_SOURCE_ID, config['camera'])
+    return Response(generate(source, tier_key),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/start_camera', methods=['POST'])
 def start_camera():
-    global camera, detection_enabled
+    global detection_enabled
     
-    if camera is not None:
+    source = get_source(DEFAULT_SOURCE_ID)
+    if source is not None and source.running:
         return jsonify({"status": "Camera is already running"})
     
+    # Check if model file exists
+    if not check_model_file():
+        return jsonify({"status": "Cannot start camera: missing model file", "success": False})
+    
     try:
         # Open the laptop's webcam (0 is usually the default camera)
-        logger.info("Opening camera...")
-        camera = cv2.VideoCapture(0)
-        
-        if not camera.isOpened():
-            logger.error("Failed to open camera")
+        source = get_or_add_source(DEFAULT_SOURCE_ID, config['camera'])
+        if not source.start():
             return jsonify({"status": "Failed to open camera", "success": False})
         
-        # Start the camera thread
         detection_enabled = request.json.get('detection', True) if request.is_json else True
-        threading.Thread(target=capture_frames, daemon=True).start()
         logger.info("Camera started successfully")
         
         return jsonify({"status": "Camera started successfully", "success": True})
@@ -221,20 +4148,14 @@ def start_camera():
 
 @app.route('/stop_camera', methods=['POST'])
 def stop_camera():
-    global camera, output_frame
-    
-    if camera is None:
+    source = get_source(DEFAULT_SOURCE_ID)
+    if source is None or not source.running:
         return jsonify({"status": "Camera is not running", "success": False})
     
     try:
         # Release the camera
         logger.info("Stopping camera...")
-        camera.release()
-        camera = None
-        
-        # Clear the output frame
-        with lock:
-            output_frame = None
+        source.stop()
         
         logger.info("Camera stopped successfully")
         return jsonify({"status": "Camera stopped successfully", "success": True})
@@ -246,7 +4167,7 @@ def stop_camera():
 def toggle_detection():
     global detection_enabled
     
-    if camera is None:
+    if not active_sources():
         return jsonify({"status": "Camera is not running", "success": False})
     
     try:
@@ -264,23 +4185,596 @@ def toggle_detection():
 
 @app.route('/status', methods=['GET'])
 def get_status():
-    global camera, detection_enabled
-    
-    camera_running = camera is not None
+    source = get_source(DEFAULT_SOURCE_ID)
+    camera_running = source is not None and source.running
+    with sources_lock:
+        all_sources = list(sources.values())
     
     return jsonify({
         "camera_running": camera_running,
         "detection_enabled": detection_enabled if camera_running else False,
-        "server_ip": get_ip_address()
+        "server_ip": get_ip_address(),
+        "detection_stride": config['detection_stride'],
+        "max_batch": config['max_batch'],
+        "client_overlay": config['client_overlay'],
+        "inference_pool": model.stats() if isinstance(model, (InferenceWorkerPool, RemoteInferencePool)) else None,
+        "frame_pool": frame_pool.stats(),
+        "viewers": sum(tier.hub.viewers for s in all_sources for tier in s.active_tiers()),
+        "jpeg_encoder": get_jpeg_encoder().name,
+        "stream_clients": asgi_stream_stats() if config['server'] == 'asgi' else None,
+        "latency": metrics.stage_summary(),
+        "controller": controller.status(),
+        "startup": startup.status(),
+        "cpu": cpu_status(),
+        "recording": clip_writer.stats() if config['record_rules'] else None,
+        "history": detection_history.stats() if detection_history.enabled else None,
+        "bytes_sent": {f"{dict(labels)['source']}/{dict(labels)['stream']}": value
+                       for labels, value in metrics.counter_totals('bytes_sent').items()},
+        "sources": {s.source_id: s.status() for s in all_sources}
     })
 
-# Create HTML template directory and file
-def create_template():
-    if not os.path.exists('templates'):
-        os.makedirs('templates')
+# Readiness probe: 200 once the model is loaded and warmed up, 503 before
+# that or when loading failed. Unlike /status it touches no sources.
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    return jsonify(startup.status()), 200 if startup.ready else 503
+
+# Adaptive controller state and recent decisions
+@app.route('/controller', methods=['GET'])
+def get_controller():
+    return jsonify(controller.status())
+
+# Update controller targets and pin/unpin knobs, e.g.
+# {"target_fps": 15, "pin": {"detection_stride": 2}, "unpin": ["stream_scale"]}.
+# A pin with a null value keeps the knob where it is.
+@app.route('/controller', methods=['POST'])
+def update_controller():
+    data = request.get_json(silent=True) or {}
+    try:
+        for key in ('target_fps', 'target_latency_ms'):
+            if key in data:
+                config[key] = max(float(data[key] or 0), 0.0)
+        for name, value in (data.get('pin') or {}).items():
+            controller.pin(name, value)
+        for name in data.get('unpin') or []:
+            controller.unpin(name)
+    except (ValueError, TypeError) as e:
+        return jsonify({"status": str(e), "success": False}), 400
+    controller.start()
+    return jsonify(dict(controller.status(), success=True))
+
+# Prometheus text exposition: stage latency histograms and byte counters from
+# the metrics registry, plus per-source gauges and counters read at scrape time
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    with sources_lock:
+        all_sources = list(sources.values())
+    
+    lines = metrics.render()
+    per_source = (
+        ("capture_fps", "gauge", lambda s: round(s.capture_fps, 3)),
+        ("inference_fps", "gauge", lambda s: round(s.inference_fps, 3)),
+        ("viewers", "gauge", lambda s: sum(tier.hub.viewers for tier in s.active_tiers())),
+        ("detection_subscribers", "gauge", lambda s: s.detection_hub.viewers),
+        ("stream_tiers", "gauge", lambda s: len(s.active_tiers())),
+        ("frames_captured_total", "counter", lambda s: s.captured),
+        ("frames_processed_total", "counter", lambda s: s.processed),
+    )
+    for name, kind, read in per_source:
+        lines.append(f"# TYPE yolo_{name} {kind}")
+        lines.extend(f'yolo_{name}{{source="{s.source_id}"}} {read(s)}' for s in all_sources)
+    
+    # Frames superseded in each pipeline slot, plus batches that finished late
+    lines.append("# TYPE yolo_frames_dropped_total counter")
+    for s in all_sources:
+        for slot_name, slot in s.slots.items():
+            lines.append(f'yolo_frames_dropped_total{{source="{s.source_id}",reason="{slot_name}"}} {slot.stats()["dropped"]}')
+        lines.append(f'yolo_frames_dropped_total{{source="{s.source_id}",reason="stale"}} {s.stale_dropped}')
+    
+    pool = frame_pool.stats()
+    lines.append("# TYPE yolo_frame_pool_buffers gauge")
+    lines.append(f"yolo_frame_pool_buffers {pool['buffers']}")
+    lines.append("# TYPE yolo_frame_pool_allocations_total counter")
+    lines.append(f"yolo_frame_pool_allocations_total {pool['allocations']}")
+    if config['server'] == 'asgi':
+        lines.append("# TYPE yolo_stream_clients gauge")
+        lines.append(f"yolo_stream_clients {len(asgi_streams)}")
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+@app.route('/sources', methods=['GET'])
+def list_sources():
+    with sources_lock:
+        return jsonify({"sources": [source.status() for source in sources.values()], "success": True})
+
+@app.route('/sources', methods=['POST'])
+def create_source():
+    data = request.get_json(silent=True) or {}
+    if 'id' not in data or 'source' not in data:
+        return jsonify({"status": "Both 'id' and 'source' are required", "success": False}), 400
+    
+    if not check_model_file():
+        return jsonify({"status": "Cannot start source: missing model file", "success": False})
+    
+    try:
+        roi = parse_roi(data['roi']) if data.get('roi') is not None else None
+        source = add_source(str(data['id']), data['source'], data.get('fps_cap'), roi)
+    except (ValueError, TypeError) as e:
+        return jsonify({"status": str(e), "success": False}), 400
+    
+    if not source.start():
+        with sources_lock:
+            sources.pop(source.source_id, None)
+        return jsonify({"status": f"Failed to open source {source.source_id}", "success": False})
+    return jsonify({"status": f"Source {source.source_id} started", "source": source.status(), "success": True})
+
+@app.route('/sources/<source_id>', methods=['DELETE'])
+def delete_source(source_id):
+    if remove_source(source_id) is None:
+        return jsonify({"status": f"Unknown source {source_id}", "success": False}), 404
+    return jsonify({"status": f"Source {source_id} removed", "success": True})
+
+# Replace a source's ROI polygons; an empty list watches the whole frame
+@app.route('/sources/<source_id>/roi', methods=['PUT'])
+def set_source_roi(source_id):
+    source = get_source(source_id)
+    if source is None:
+        return jsonify({"status": f"Unknown source {source_id}", "success": False}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        source.roi = parse_roi(data.get('roi'))
+    except (ValueError, TypeError) as e:
+        return jsonify({"status": f"Invalid ROI: {str(e)}", "success": False}), 400
+    return jsonify({"status": f"ROI of source {source_id} updated", "roi": source.roi, "success": True})
+
+@app.route('/sources/<source_id>/status', methods=['GET'])
+def get_source_status(source_id):
+    source = get_source(source_id)
+    if source is None:
+        return jsonify({"status": f"Unknown source {source_id}", "success": False}), 404
+    return jsonify(source.status())
+
+@app.route('/detections')
+@app.route('/detections/<source_id>')
+def latest_detections(source_id=DEFAULT_SOURCE_ID):
+    source = get_source(source_id)
+    if source is None:
+        return jsonify({"status": f"Unknown source {source_id}", "success": False}), 404
+    message = source.detection_hub.latest()
+    if message is None:
+        return jsonify({"status": "No detections yet", "success": False})
+    return Response(message.to_json(), mimetype='application/json')
+
+# Recorded clips, newest first, and the writer's counters
+@app.route('/clips', methods=['GET'])
+def get_clips():
+    return jsonify({"clips": list_clips(), "writer": clip_writer.stats(), "success": True})
+
+# Full clip metadata, or None for an unknown or malformed id
+def load_clip(clip_id):
+    path = os.path.join(config['record_dir'], clip_id + '.json')
+    if not CLIP_ID.match(clip_id) or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# Clip metadata with the per-frame timestamps, offsets and detections
+@app.route('/clips/<clip_id>', methods=['GET'])
+def get_clip(clip_id):
+    meta = load_clip(clip_id)
+    if meta is None:
+        return jsonify({"status": f"Unknown clip {clip_id}", "success": False}), 404
+    return jsonify(meta)
+
+# The clip's MJPEG stream as a download
+@app.route('/clips/<clip_id>/video', methods=['GET'])
+def get_clip_video(clip_id):
+    if load_clip(clip_id) is None:
+        return jsonify({"status": f"Unknown clip {clip_id}", "success": False}), 404
+    path = os.path.abspath(os.path.join(config['record_dir'], clip_id + '.mjpeg'))
+    return send_file(path, mimetype='video/x-motion-jpeg', as_attachment=True, download_name=clip_id + '.mjpeg')
+
+# One JPEG frame of a clip, read through the clip's byte offsets
+@app.route('/clips/<clip_id>/frames/<int:index>', methods=['GET'])
+def get_clip_frame(clip_id, index):
+    meta = load_clip(clip_id)
+    if meta is None or index >= len(meta["frames"]):
+        return jsonify({"status": f"Unknown clip frame {clip_id}/{index}", "success": False}), 404
+    frame = meta["frames"][index]
+    with open(os.path.join(config['record_dir'], clip_id + '.mjpeg'), 'rb') as f:
+        f.seek(frame["offset"])
+        data = f.read(frame["size"])
+    return Response(data, mimetype='image/jpeg')
+
+# Time range, source and class filters of a history query. start/end are
+# epoch seconds, or seconds relative to now when zero or negative; the
+# default range is the last hour. Raises ValueError on bad input.
+def history_query():
+    now = time.time()
+    end = float(request.args.get('end', 0))
+    end = now + end if end <= 0 else end
+    start = float(request.args.get('start', -3600))
+    start = now + start if start <= 0 else start
+    if start >= end:
+        raise ValueError("start must be before end")
+    class_id = request.args.get('class')
+    if class_id is not None and not class_id.lstrip('-').isdigit():
+        matches = [i for i, name in enumerate(class_names) if name == class_id]
+        if not matches:
+            raise ValueError(f"Unknown class {class_id}")
+        class_id = matches[0]
+    return start, end, request.args.get('source'), None if class_id is None else int(class_id)
+
+# Run a history query and wrap its result, with 503 while the store is off
+# and 400 for bad parameters
+def history_response(query):
+    if not detection_history.enabled:
+        return jsonify({"status": "Detection history is off (start with --history-dir)", "success": False}), 503
+    try:
+        start, end, source_id, class_id = history_query()
+        result = query(start, end, source_id, class_id)
+    except ValueError as e:
+        return jsonify({"status": str(e), "success": False}), 400
+    return jsonify({"start": round(start, 3), "end": round(end, 3), "result": result, "success": True})
+
+@app.route('/history', methods=['GET'])
+def get_history_stats():
+    if not detection_history.enabled:
+        return jsonify({"status": "Detection history is off (start with --history-dir)", "success": False}), 503
+    return jsonify(dict(detection_history.stats(), success=True))
+
+# Per-class detections, frames present, peak count, new tracks and mean
+# occupancy over a range, e.g. /history/counts?start=-86400&source=0
+@app.route('/history/counts', methods=['GET'])
+def get_history_counts():
+    return history_response(detection_history.counts)
+
+# The same measures as a series, e.g. /history/histogram?class=person&bucket=300
+@app.route('/history/histogram', methods=['GET'])
+def get_history_histogram():
+    bucket = request.args.get('bucket', 60, type=int)
+    return history_response(lambda *query: detection_history.histogram(query[0], query[1], bucket, *query[2:]))
+
+# When each class was last seen, newest first
+@app.route('/history/last_seen', methods=['GET'])
+def get_history_last_seen():
+    return history_response(lambda start, end, source_id, class_id: detection_history.last_seen_times(source_id, class_id))
+
+# Raw logged detections in a range, oldest first, at most `limit` rows of
+# [ts, source, class, confidence %, track, x1, y1, x2, y2]
+@app.route('/history/detections', methods=['GET'])
+def get_history_detections():
+    limit = min(request.args.get('limit', 1000, type=int), 100000)
+    def query(start, end, source_id, class_id):
+        with detection_history.lock:
+            records = detection_history.window(start, end)
+        if source_id is not None:
+            records = records[records['source'] == detection_history.source_ids.get(source_id, -1)]
+        if class_id is not None:
+            records = records[records['class_id'] == class_id]
+        names = {index: name for name, index in detection_history.source_ids.items()}
+        return [[round(float(r['ts']), 3), names.get(int(r['source'])), class_name(int(r['class_id'])),
+                 int(round(float(r['confidence']) * 100)), int(r['track_id']),
+                 int(r['x1']), int(r['y1']), int(r['x2']), int(r['y2'])] for r in records[:limit]]
+    return history_response(query)
+
+# Server-Sent Events stream of per-frame detections; ?delta=1 sends only the
+# tracks that changed since the previous message
+@app.route('/detections/stream')
+@app.route('/detections/<source_id>/stream')
+def detection_events(source_id=DEFAULT_SOURCE_ID):
+    source = get_source(source_id)
+    if source is None:
+        return jsonify({"status": f"Unknown source {source_id}", "success": False}), 404
+    delta = request.args.get('delta', '0').lower() in ('1', 'true', 'yes')
+    return Response(generate_detection_events(source, delta), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Binary WebSocket variant: one JSON text frame of metadata, then one binary
+# frame per message (DetectionMessage.HEADER followed by DETECTION_DTYPE rows)
+def detection_socket(ws, source_id=DEFAULT_SOURCE_ID):
+    source = get_source(source_id)
+    if source is None:
+        ws.close(reason=1008, message=f"Unknown source {source_id}")
+        return
+    delta = request.args.get('delta', '0').lower() in ('1', 'true', 'yes')
+    
+    ws.send(json.dumps(detection_stream_meta()))
+    updates = detection_updates(source, delta)
+    try:
+        for message, use_delta in updates:
+            if message is not None:
+                data = message.to_binary(use_delta)
+                ws.send(data)
+                metrics.inc('bytes_sent', len(data), source=source.source_id, stream='detections')
+    finally:
+        updates.close()
+
+# WebSocket routes need the optional flask-sock package
+if Sock is not None:
+    sock = Sock(app)
+    sock.route('/detections/ws', endpoint='detection_socket')(detection_socket)
+    sock.route('/detections/<source_id>/ws', endpoint='source_detection_socket')(detection_socket)
+
+# ASGI serving mode. Streams run as one coroutine per client instead of one
+# thread per client; every other route is handed to the Flask app through a
+# small WSGI bridge on the default executor.
+asgi_streams = {}
+asgi_stream_ids = iter(range(1, sys.maxsize))
+WEBSOCKET_ROUTE = re.compile(r'^/detections(?:/([^/]+))?/ws$')
+
+def asgi_stream_stats():
+    return {
+        "active": len(asgi_streams),
+        "max_clients": config['max_clients'],
+        "dropped": sum(stream['dropped'] for stream in asgi_streams.values()),
+    }
+
+def asgi_query(scope):
+    query = scope.get('query_string', b'').decode('latin-1')
+    return {key: values[0] for key, values in urllib.parse.parse_qs(query).items()}
+
+def asgi_query_flag(scope, name):
+    return asgi_query(scope).get(name, '0').lower() in ('1', 'true', 'yes')
+
+async def asgi_send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+# Build a WSGI environ for an ASGI http scope with an already read body
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif key != 'CONTENT_LENGTH':
+            key = 'HTTP_' + key
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+# Run the Flask app on one request; only used for non-streaming routes
+def call_wsgi(environ):
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+    chunks = app(environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response[0], response[1], body
+
+async def asgi_wsgi_bridge(scope, receive, send):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    loop = asyncio.get_running_loop()
+    status, headers, content = await loop.run_in_executor(None, call_wsgi, wsgi_environ(scope, body))
+    await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]})
+    await send({'type': 'http.response.body', 'body': content})
+
+# Push the newest value of a hub to one client until it disconnects. A slow
+# client never queues frames: while its send is blocked on a full socket the
+# hub keeps moving, and the next send takes whatever is newest, so every
+# frame published meanwhile is dropped for that client only. join() returns
+# the hub to follow and registers the client; leave() undoes it.
+async def asgi_stream(scope, receive, send, join, leave, content_type, render, labels,
+                      preamble=b'', keep_alive=None):
+    if len(asgi_streams) >= config['max_clients']:
+        await asgi_send_json(send, 503, {"status": "Too many stream clients", "success": False})
+        return
+    
+    stream_id = next(asgi_stream_ids)
+    stats = asgi_streams[stream_id] = {"path": scope['path'], "sent": 0, "dropped": 0}
+    disconnected = asyncio.Event()
     
-    with open('templates/index.html', 'w') as f:
-        f.write('''
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+    
+    watcher = asyncio.ensure_future(watch_disconnect())
+    hub = join()
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', content_type.encode()),
+                                (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        if preamble:
+            await send({'type': 'http.response.body', 'body': preamble, 'more_body': True})
+        last_seq = 0
+        while not disconnected.is_set():
+            seq, value = await hub.wait_newer_async(last_seq, timeout=1.0)
+            if value is None:
+                chunk = keep_alive
+            else:
+                if last_seq:
+                    stats['dropped'] += seq - last_seq - 1
+                last_seq = seq
+                chunk = render(value)
+            if not chunk or disconnected.is_set():
+                continue
+            try:
+                await asyncio.wait_for(send({'type': 'http.response.body', 'body': chunk, 'more_body': True}),
+                                       config['client_send_timeout'])
+            except asyncio.TimeoutError:
+                logger.info(f"Dropping stalled stream client on {scope['path']}")
+                break
+            stats['sent'] += 1
+            metrics.inc('bytes_sent', len(chunk), **labels)
+    except OSError:
+        # The transport went away between the disconnect check and the send
+        pass
+    finally:
+        watcher.cancel()
+        leave()
+        del asgi_streams[stream_id]
+
+async def asgi_video_feed(scope, receive, send, source_id):
+    query = asgi_query(scope)
+    try:
+        tier_key = stream_tier_key(query.get('size'), query.get('quality'), query.get('max_fps'))
+    except ValueError as e:
+        await asgi_send_json(send, 400, {"status": f"Invalid stream parameters: {str(e)}", "success": False})
+        return
+    
+    source = get_source(source_id)
+    if source is None:
+        if source_id != DEFAULT_SOURCE_ID:
+            await asgi_send_json(send, 404, {"status": f"Unknown source {source_id}", "success": False})
+            return
+        source = get_or_add_source(DEFAULT_SOURCE_ID, config['camera'])
+    tier = None
+    
+    def join():
+        nonlocal tier
+        tier = source.join_tier(tier_key)
+        return tier.hub
+    
+    await asgi_stream(scope, receive, send, join, lambda: source.leave_tier(tier),
+                      'multipart/x-mixed-replace; boundary=frame',
+                      lambda frame: b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n',
+                      {'source': source.source_id, 'stream': 'video'})
+
+async def asgi_detection_events(scope, receive, send, source_id):
+    source = get_source(source_id)
+    if source is None:
+        await asgi_send_json(send, 404, {"status": f"Unknown source {source_id}", "success": False})
+        return
+    cursor = DeltaCursor(asgi_query_flag(scope, 'delta'))
+    render = lambda message: f"id: {message.seq}\ndata: {message.to_json(cursor.advance(message))}\n\n".encode()
+    preamble = f"event: meta\ndata: {json.dumps(detection_stream_meta())}\n\n".encode()
+    hub = source.detection_hub
+    
+    def join():
+        with hub.cond:
+            hub.viewers += 1
+        return hub
+    
+    def leave():
+        with hub.cond:
+            hub.viewers -= 1
+    
+    await asgi_stream(scope, receive, send, join, leave, 'text/event-stream', render,
+                      {'source': source.source_id, 'stream': 'detections'},
+                      preamble=preamble, keep_alive=b': keep-alive\n\n')
+
+async def asgi_detection_socket(scope, receive, send, source_id):
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    source = get_source(source_id)
+    if source is None:
+        await send({'type': 'websocket.close', 'code': 1008, 'reason': f"Unknown source {source_id}"})
+        return
+    if len(asgi_streams) >= config['max_clients']:
+        await send({'type': 'websocket.close', 'code': 1013, 'reason': "Too many stream clients"})
+        return
+    await send({'type': 'websocket.accept'})
+    await send({'type': 'websocket.send', 'text': json.dumps(detection_stream_meta())})
+    
+    hub = source.detection_hub
+    cursor = DeltaCursor(asgi_query_flag(scope, 'delta'))
+    stream_id = next(asgi_stream_ids)
+    stats = asgi_streams[stream_id] = {"path": scope['path'], "sent": 0, "dropped": 0}
+    disconnected = asyncio.Event()
+    
+    async def watch_disconnect():
+        while True:
+            if (await receive())['type'] == 'websocket.disconnect':
+                disconnected.set()
+                return
+    
+    watcher = asyncio.ensure_future(watch_disconnect())
+    with hub.cond:
+        hub.viewers += 1
+    try:
+        last_seq = 0
+        while not disconnected.is_set():
+            seq, detections = await hub.wait_newer_async(last_seq, timeout=1.0)
+            if detections is None or disconnected.is_set():
+                continue
+            if last_seq:
+                stats['dropped'] += seq - last_seq - 1
+            last_seq = seq
+            data = detections.to_binary(cursor.advance(detections))
+            await asyncio.wait_for(send({'type': 'websocket.send', 'bytes': data}), config['client_send_timeout'])
+            stats['sent'] += 1
+            metrics.inc('bytes_sent', len(data), source=source_id, stream='detections')
+    except (asyncio.TimeoutError, OSError):
+        pass
+    finally:
+        watcher.cancel()
+        with hub.cond:
+            hub.viewers -= 1
+        del asgi_streams[stream_id]
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    if scope['type'] == 'websocket':
+        match = WEBSOCKET_ROUTE.match(scope['path'])
+        if match is None:
+            await receive()
+            await send({'type': 'websocket.close', 'code': 1000})
+            return
+        await asgi_detection_socket(scope, receive, send, match.group(1) or DEFAULT_SOURCE_ID)
+        return
+    
+    # Route through Flask's URL map so both servers agree on every path
+    try:
+        endpoint, view_args = app.url_map.bind('localhost').match(scope['path'], scope['method'])
+    except Exception:
+        endpoint, view_args = None, {}
+    source_id = view_args.get('source_id', DEFAULT_SOURCE_ID)
+    if endpoint == 'video_feed':
+        await asgi_video_feed(scope, receive, send, source_id)
+    elif endpoint == 'detection_events':
+        await asgi_detection_events(scope, receive, send, source_id)
+    else:
+        await asgi_wsgi_bridge(scope, receive, send)
+
+# Page served at /, written to templates/index.html by create_template
+INDEX_HTML = '''
 <!DOCTYPE html>
 <html>
 <head>
@@ -324,6 +4818,14 @@ def create_template():
             height: auto;
             display: block;
         }
+        .video-container canvas {
+            position: absolute;
+            top: 0;
+            left: 0;
+            width: 100%;
+            height: 100%;
+            pointer-events: none;
+        }
         .controls {
             display: flex;
             justify-content: center;
@@ -437,6 +4939,7 @@ def create_template():
         
         <div class="video-container">
             <img id="video" src="{{ url_for('video_feed') }}" alt="Video feed will appear here when camera is started" style="display: none;">
+            <canvas id="overlay" style="display: none;"></canvas>
             <div id="videoPlaceholder">Video feed will appear here when camera is started</div>
             <div class="loading" id="loadingIndicator" style="display: none;">
                 <div class="spinner"></div>
@@ -453,6 +4956,10 @@ def create_template():
     <script>
         let cameraRunning = false;
         let detectionEnabled = true;
+        // In client overlay mode the server streams raw frames and the boxes are drawn here
+        const clientOverlay = {{ 'true' if client_overlay else 'false' }};
+        let classNames = [];
+        let detectionStream = null;
         
         // Update UI based on current status
         function updateUI() {
@@ -472,14 +4979,57 @@ def create_template():
                 statusBox.className = 'status running';
                 video.style.display = 'block';
                 videoPlaceholder.style.display = 'none';
+                startDetectionStream();
             } else {
                 statusBox.textContent = 'Camera is stopped. Click "Start Camera" to begin.';
                 statusBox.className = 'status stopped';
                 video.style.display = 'none';
                 videoPlaceholder.style.display = 'block';
+                stopDetectionStream();
             }
         }
         
+        // Draw one detection message over the video
+        function drawDetections(message) {
+            const video = document.getElementById('video');
+            const canvas = document.getElementById('overlay');
+            canvas.width = video.clientWidth;
+            canvas.height = video.clientHeight;
+            const ctx = canvas.getContext('2d');
+            ctx.clearRect(0, 0, canvas.width, canvas.height);
+            if (!detectionEnabled) return;
+            
+            const sx = canvas.width / message.w;
+            const sy = canvas.height / message.h;
+            ctx.lineWidth = 2;
+            ctx.strokeStyle = '#00ff00';
+            ctx.fillStyle = '#00ff00';
+            ctx.font = '12px Arial';
+            message.det.forEach(([track, cls, conf, x1, y1, x2, y2]) => {
+                ctx.strokeRect(x1 * sx, y1 * sy, (x2 - x1) * sx, (y2 - y1) * sy);
+                const label = `${track >= 0 ? '#' + track + ' ' : ''}${classNames[cls] || cls} ${(conf / 100).toFixed(2)}`;
+                ctx.fillText(label, x1 * sx, Math.max(y1 * sy - 4, 12));
+            });
+        }
+        
+        // Subscribe to the detection stream when the browser draws the overlay
+        function startDetectionStream() {
+            if (!clientOverlay || detectionStream) return;
+            document.getElementById('overlay').style.display = 'block';
+            detectionStream = new EventSource('/detections/stream');
+            detectionStream.addEventListener('meta', event => {
+                classNames = JSON.parse(event.data).names;
+            });
+            detectionStream.onmessage = event => drawDetections(JSON.parse(event.data));
+        }
+        
+        function stopDetectionStream() {
+            if (!detectionStream) return;
+            detectionStream.close();
+            detectionStream = null;
+            document.getElementById('overlay').style.display = 'none';
+        }
+        
         // Function to start the camera
         function startCamera() {
             showLoading(true);
@@ -599,16 +5149,1098 @@ def create_template():
     </script>
 </body>
 </html>
-        ''')
+        '''
 
-if __name__ == '__main__':
+# Write the HTML template when it is missing or out of date. An unchanged
+# file is left alone, so restarts skip the write and read-only images work.
+def create_template():
+    path = os.path.join(app.root_path, app.template_folder, 'index.html')
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == INDEX_HTML:
+                return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(INDEX_HTML)
+        logger.info(f"Wrote {path}")
+    except OSError as e:
+        logger.warning(f"Could not write {path}: {str(e)}")
+
+# Micro-benchmark of detection post-processing: the old results.pandas() +
+# iterrows() path against the vectorized structured-array path
+def benchmark_postprocess(counts=(0, 10, 50), repeat=2000):
+    import pandas as pd
+    
+    global class_names
+    names = [f"class{i}" for i in range(80)]
+    class_names = build_class_names(names)
+    rng = np.random.default_rng(0)
+    report = {}
+    
+    for count in counts:
+        xy = rng.uniform(0, 600, size=(count, 2))
+        xyxy = torch.from_numpy(np.hstack([
+            xy, xy + rng.uniform(10, 100, size=(count, 2)),
+            rng.uniform(0.45, 1.0, size=(count, 1)),
+            rng.integers(0, 80, size=(count, 1)),
+        ]).astype(np.float32))
+        
+        # Same DataFrame construction as yolov5's Detections.pandas()
+        def pandas_path():
+            rows = [x[:5] + [int(x[5]), names[int(x[5])]] for x in xyxy.tolist()]
+            frame = pd.DataFrame(rows, columns=['xmin', 'ymin', 'xmax', 'ymax', 'confidence', 'class', 'name'])
+            for _, detection in frame.iterrows():
+                box = (int(detection['xmin']), int(detection['ymin']), int(detection['xmax']), int(detection['ymax']))
+                label = f"{detection['name']} {detection['confidence']:.2f}"
+        
+        def vectorized_path():
+            detections = detections_from_xyxy(xyxy)
+            boxes = detection_boxes(detections).tolist()
+            labels = format_labels(detections)
+        
+        timings = {}
+        for name, path in (("pandas", pandas_path), ("vectorized", vectorized_path)):
+            path()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                path()
+            timings[name] = (time.perf_counter() - start) / repeat * 1e6
+        timings["speedup"] = timings["pandas"] / timings["vectorized"]
+        report[count] = {key: round(value, 2) for key, value in timings.items()}
+        logger.info(f"{count} detections: pandas {timings['pandas']:.1f} us, "
+                    f"vectorized {timings['vectorized']:.1f} us ({timings['speedup']:.1f}x)")
+    
+    print(json.dumps({"postprocess_us_per_frame": report}, indent=2))
+    return report
+
+# Overlay drawing cost per frame: the old per-element cv2.putText path against
+# the cached compositor for growing numbers of static text layers, with the
+# largest pixel difference between the two (blending rounds slightly
+# differently from OpenCV's anti-aliasing). Also times the IP lookup the
+# overlay used to do on every frame against the cached one.
+def benchmark_overlay(static_counts=(2, 8, 24), repeat=200):
+    frame = synthetic_frame()
+    report = {"static_layers": {}}
+    
+    def timed(path, *args):
+        path(*args)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            path(*args)
+        return (time.perf_counter() - start) / repeat * 1e6
+    
+    report["ip_lookup_us"] = {"socket": round(timed(resolve_ip_address), 2),
+                              "cached": round(timed(get_ip_address), 2)}
+    for count in static_counts:
+        config['overlay_text'] = [f"Static line {i}" for i in range(max(count - 2, 0))]
+        layers = overlay_layers()
+        def puttext_path(target):
+            for text, (x, y), scale, color, thickness in layers:
+                cv2.putText(target, text, (x, y if y >= 0 else target.shape[0] + y),
+                            cv2.FONT_HERSHEY_SIMPLEX, scale, color, thickness)
+        expected, actual = frame.copy(), frame.copy()
+        puttext_path(expected)
+        draw_overlay(actual)
+        timings = {"puttext": round(timed(puttext_path, frame.copy()), 2),
+                   "compositor": round(timed(draw_overlay, frame.copy()), 2),
+                   "max_pixel_diff": int(np.abs(expected.astype(np.int16) - actual).max())}
+        report["static_layers"][len(layers)] = timings
+        logger.info(f"{len(layers)} static layers: putText {timings['puttext']:.1f} us, "
+                    f"compositor {timings['compositor']:.1f} us")
+    config['overlay_text'] = []
+    
+    print(json.dumps({"overlay_us_per_frame": report}, indent=2))
+    return report
+
+# Time every available encoder per tier (width, quality). Resizing is timed
+# separately since tiers of the same width share one resize.
+def benchmark_jpeg(image=None, sizes=(0, 640, 320), qualities=(95, 75, 50), repeat=100):
+    frame = cv2.imread(image) if image else synthetic_frame()
+    if frame is None:
+        logger.error(f"Cannot read image {image}")
+        return None
+    height, width = frame.shape[:2]
+    encoders = {}
+    for name, cls in JPEG_ENCODERS.items():
+        try:
+            encoders[name] = cls()
+        except Exception as e:
+            logger.info(f"Skipping the {name} encoder: {str(e)}")
+    
+    report = {"frame": f"{width}x{height}", "resize_ms": {}, "encode": {}}
+    for size in sizes:
+        target = size if 0 < size < width else width
+        scaled = frame
+        if target != width:
+            shape = (round(height * target / width), target)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                scaled = cv2.resize(frame, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+            report["resize_ms"][target] = round((time.perf_counter() - start) / repeat * 1e3, 3)
+        
+        for quality in qualities:
+            tier = f"{target}w q{quality}"
+            timings = {}
+            for name, encoder in encoders.items():
+                data = encoder.encode(scaled, quality)
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    encoder.encode(scaled, quality)
+                elapsed = (time.perf_counter() - start) / repeat * 1e3
+                timings[name] = {"ms": round(elapsed, 3), "kb": round(len(data) / 1024, 1)}
+            if 'opencv' in timings:
+                for name, timing in timings.items():
+                    timing["speedup"] = round(timings['opencv']["ms"] / timing["ms"], 2)
+            report["encode"][tier] = timings
+            logger.info(f"{tier}: " + ", ".join(f"{name} {t['ms']:.2f} ms {t['kb']} KB" for name, t in timings.items()))
+    
+    print(json.dumps({"jpeg": report}, indent=2))
+    return report
+
+# Ground truth for an image in YOLO txt format (class cx cy w h, normalized)
+# next to the image or in the matching labels/ directory of an images/
+# tree. Returns an (n, 5) array of class, x1, y1, x2, y2 in pixels, or
+# None when the image has no label file.
+def load_yolo_labels(image_path, shape):
+    stem = os.path.splitext(image_path)[0]
+    candidates = [stem + '.txt']
+    parts = stem.split(os.sep)
+    if 'images' in parts:
+        index = len(parts) - 1 - parts[::-1].index('images')
+        candidates.append(os.sep.join(parts[:index] + ['labels'] + parts[index + 1:]) + '.txt')
+    for path in candidates:
+        if os.path.exists(path):
+            rows = np.loadtxt(path, ndmin=2).reshape(-1, 5)
+            height, width = shape[:2]
+            labels = np.empty_like(rows)
+            labels[:, 0] = rows[:, 0]
+            labels[:, 1] = (rows[:, 1] - rows[:, 3] / 2) * width
+            labels[:, 2] = (rows[:, 2] - rows[:, 4] / 2) * height
+            labels[:, 3] = (rows[:, 1] + rows[:, 3] / 2) * width
+            labels[:, 4] = (rows[:, 2] + rows[:, 4] / 2) * height
+            return labels
+    return None
+
+# mAP@0.5 (all-point interpolated AP averaged over the classes present in
+# the ground truth) plus recall overall and for small objects (< 32x32 px,
+# the COCO definition) of per-image detections against YOLO labels
+def detection_accuracy(predictions, truths, iou_threshold=0.5):
+    scored = {}
+    positives = {}
+    matched_small = total_small = matched_all = total_all = 0
+    for detections, labels in zip(predictions, truths):
+        if labels is None:
+            continue
+        small = np.prod(labels[:, 3:5] - labels[:, 1:3], axis=1) < 32 * 32
+        total_small += int(small.sum())
+        total_all += len(labels)
+        for class_id in np.unique(np.concatenate([labels[:, 0], detections['class_id']])).astype(int):
+            truth = labels[labels[:, 0] == class_id]
+            found = detections[detections['class_id'] == class_id]
+            found = found[np.argsort(-found['confidence'])]
+            positives[class_id] = positives.get(class_id, 0) + len(truth)
+            taken = np.zeros(len(truth), dtype=bool)
+            ious = box_iou(detection_boxes(found).astype(np.float32), truth[:, 1:5]) if len(truth) and len(found) else None
+            for row, confidence in enumerate(found['confidence']):
+                hit = False
+                if ious is not None:
+                    candidates = np.where(~taken & (ious[row] >= iou_threshold))[0]
+                    if len(candidates):
+                        taken[candidates[np.argmax(ious[row][candidates])]] = True
+                        hit = True
+                scored.setdefault(class_id, []).append((float(confidence), hit))
+            matched_all += int(taken.sum())
+            matched_small += int(taken[small[labels[:, 0] == class_id]].sum())
+    
+    average_precisions = []
+    for class_id, count in positives.items():
+        if not count:
+            continue
+        hits = sorted(scored.get(class_id, []), key=lambda item: -item[0])
+        true_positives = np.cumsum([hit for _, hit in hits]) if hits else np.zeros(0)
+        recall = true_positives / count
+        precision = true_positives / np.arange(1, len(hits) + 1)
+        # Precision envelope, integrated over the recall steps
+        recall = np.concatenate([[0.0], recall, [1.0]])
+        precision = np.concatenate([[1.0], precision, [0.0]])
+        precision = np.maximum.accumulate(precision[::-1])[::-1]
+        steps = np.where(recall[1:] != recall[:-1])[0]
+        average_precisions.append(float(np.sum((recall[steps + 1] - recall[steps]) * precision[steps + 1])))
+    if not total_all:
+        return None
+    return {
+        "map50": round(float(np.mean(average_precisions)), 4) if average_precisions else 0.0,
+        "recall": round(matched_all / total_all, 4),
+        "small_recall": round(matched_small / total_small, 4) if total_small else None,
+        "ground_truth": total_all,
+    }
+
+# Images of a local evaluation set and their YOLO labels (None where an
+# image has no label file)
+def load_image_set(images_dir):
+    paths = sorted(os.path.join(images_dir, name) for name in os.listdir(images_dir)
+                   if name.lower().endswith(ImageSequenceCapture.EXTENSIONS))
+    loaded = [(path, image) for path, image in ((path, cv2.imread(path)) for path in paths) if image is not None]
+    if not loaded:
+        logger.error(f"No images found in {images_dir}")
+    return [image for _, image in loaded], [load_yolo_labels(path, image.shape) for path, image in loaded]
+
+# Accuracy vs throughput of whole-frame inference against tiled inference
+# at each tile size over a local image set. Ground truth is read from YOLO
+# label files when present; without it only speed and detection counts are
+# compared.
+def benchmark_tiles(images_dir, tile_sizes=(0, 640), overlap=0.2, repeat=1):
+    if not check_model_file() or ensure_model() is None:
+        return None
+    images, truths = load_image_set(images_dir)
+    if not images:
+        return None
+    
+    saved = (config['tile_size'], config['tile_overlap'])
+    report = {"images": len(images), "labelled": sum(truth is not None for truth in truths), "configs": {}}
+    try:
+        for tile_size in tile_sizes:
+            config['tile_size'], config['tile_overlap'] = tile_size, overlap
+            layouts = [get_tile_layout(image.shape, config['roi']) if uses_layout(config['roi']) else None
+                       for image in images]
+            infer_layout_batch(images[:1], [None], layouts[:1])
+            start = time.perf_counter()
+            for _ in range(repeat):
+                predictions = [infer_layout_batch([image], [None], [layout])[0]
+                               for image, layout in zip(images, layouts)]
+            elapsed = (time.perf_counter() - start) / repeat
+            name = f"tiles_{tile_size}" if tile_size else "whole_frame"
+            report["configs"][name] = {
+                "regions_per_image": round(float(np.mean([len(layout.tiles) if layout else 1 for layout in layouts])), 2),
+                "fps": round(len(images) / elapsed, 2),
+                "ms_per_image": round(elapsed / len(images) * 1e3, 2),
+                "detections": int(sum(len(p) for p in predictions)),
+                "accuracy": detection_accuracy(predictions, truths),
+            }
+            logger.info(f"{name}: {report['configs'][name]}")
+    finally:
+        config['tile_size'], config['tile_overlap'] = saved
+    
+    print(json.dumps({"tiling": report}, indent=2))
+    return report
+
+CPU_OPTIONS = ('int8-dynamic', 'int8-static', 'channels-last')
+
+# Parse a CPU inference configuration such as "onnx:int8-static" or
+# "torchscript:channels-last" into config values
+def parse_cpu_config(spec):
+    backend, _, options = spec.partition(':')
+    options = [option for option in options.split(',') if option]
+    if backend not in INFERENCE_BACKENDS or any(option not in CPU_OPTIONS for option in options):
+        raise ValueError(f"Bad CPU configuration {spec}: expected BACKEND[:{','.join(CPU_OPTIONS)}]")
+    quantize = [option[len('int8-'):] for option in options if option.startswith('int8-')]
+    return {'backend': backend, 'quantize': quantize[-1] if quantize else 'none',
+            'channels_last': 'channels-last' in options}
+
+# Server flags that select a CPU inference configuration
+def cpu_config_flags(settings, threads):
+    flags = [f"--backend {settings['backend']}"]
+    if settings['quantize'] != 'none':
+        flags.append(f"--quantize {settings['quantize']}")
+    if settings['channels_last']:
+        flags.append("--channels-last")
+    if threads:
+        flags.append(f"--intra-threads {threads}")
+    return ' '.join(flags)
+
+# Accuracy vs throughput of CPU inference configurations (backend, INT8
+# quantization, channels-last) at each intra-op thread count over a local
+# image set. mAP@0.5 is measured against YOLO labels when the images have
+# them, otherwise against the first configuration's detections. The
+# fastest configuration whose mAP is at most max_map_drop below the first
+# one is recommended.
+def benchmark_cpu(images_dir, specs, thread_counts=(0,), max_map_drop=0.01, repeat=1):
+    images, truths = load_image_set(images_dir)
+    if not images:
+        return None
+    labelled = sum(truth is not None for truth in truths)
+    reference = truths if labelled else None
+    
+    saved = {key: config[key] for key in ('backend', 'quantize', 'channels_last', 'intra_op_threads')}
+    default_threads = torch.get_num_threads()
+    report = {"images": len(images), "labelled": labelled, "reference": "labels" if labelled else specs[0],
+              "max_map_drop": max_map_drop, "configs": {}}
+    baseline = None
+    try:
+        for spec in specs:
+            settings = parse_cpu_config(spec)
+            for threads in thread_counts:
+                name = f"{spec}@{threads}" if threads else spec
+                config.update(settings, intra_op_threads=threads)
+                torch.set_num_threads(threads or default_threads)
+                try:
+                    engine = create_engine(settings['backend'], config['weights'], config['imgsz'])
+                except Exception as e:
+                    logger.error(f"Skipping {name}: {str(e)}")
+                    report["configs"][name] = {"error": str(e)}
+                    continue
+                # The thresholds load_model() serves with
+                engine.conf, engine.iou, engine.max_det = 0.45, 0.45, 50
+                engine.infer_batch(images[:1])
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    predictions = [engine(image) for image in images]
+                elapsed = (time.perf_counter() - start) / repeat
+                
+                if reference is None:
+                    # No labels: the first configuration's detections stand in for them
+                    reference = [np.column_stack([p['class_id'], detection_boxes(p)]).astype(np.float32)
+                                 for p in predictions]
+                accuracy = detection_accuracy(predictions, reference)
+                map50 = accuracy["map50"] if accuracy else None
+                if baseline is None:
+                    baseline = map50
+                report["configs"][name] = {
+                    "fps": round(len(images) / elapsed, 2),
+                    "ms_per_image": round(elapsed / len(images) * 1e3, 2),
+                    "threads": torch.get_num_threads() if settings['backend'] in ('torch', 'torchscript') else threads,
+                    "detections": int(sum(len(p) for p in predictions)),
+                    "map50": map50,
+                    "map_delta": round(map50 - baseline, 4) if map50 is not None and baseline is not None else None,
+                    "within_budget": baseline is None or (map50 is not None and map50 >= baseline - max_map_drop),
+                    "flags": cpu_config_flags(settings, threads),
+                }
+                logger.info(f"{name}: {report['configs'][name]}")
+                del engine
+    finally:
+        config.update(saved)
+        torch.set_num_threads(default_threads)
+    
+    eligible = {name: result for name, result in report["configs"].items() if result.get("within_budget")}
+    if eligible:
+        best = max(eligible, key=lambda name: eligible[name]["fps"])
+        report["recommended"] = {"config": best, "fps": eligible[best]["fps"], "flags": eligible[best]["flags"]}
+    print(json.dumps({"cpu": report}, indent=2))
+    return report
+
+# CPU seconds (user + system) of this process and its live children, and
+# current/peak RSS in MB. psutil is optional; without it worker processes
+# are not counted and the current RSS comes from /proc.
+def process_usage():
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    peak_mb = usage.ru_maxrss / 1024
+    try:
+        import psutil
+        process = psutil.Process()
+        processes = [process] + process.children(recursive=True)
+        cpu = 0.0
+        rss = 0
+        for proc in processes:
+            try:
+                times = proc.cpu_times()
+                cpu += times.user + times.system
+                rss += proc.memory_info().rss
+            except psutil.Error:
+                continue
+        return cpu, rss / 2**20, peak_mb
+    except ImportError:
+        pass
+    rss_mb = peak_mb
+    try:
+        with open('/proc/self/statm') as f:
+            rss_mb = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        pass
+    return usage.ru_utime + usage.ru_stime, rss_mb, peak_mb
+
+# Headless run of the real pipeline: capture_frames -> scheduler/process_batch
+# -> annotate -> encode -> generate, fed by `sources` copies of a source spec
+# (synthetic:WxH by default, or a video file) and read by simulated
+# /video_feed consumers. Stage latencies come from the metrics registry,
+# which is reset after the warm-up.
+def benchmark_pipeline(spec='synthetic:1280x720?fps=30', sources_count=1, consumers=1, tiers=('0',),
+                       duration=10.0, warmup=2.0, output=None):
+    if not check_model_file():
+        return None
+    started = time.perf_counter()
+    if ensure_model() is None:
+        return None
+    model_load_s = time.perf_counter() - started
+    
+    bench_sources = [add_source(f"bench{i}", spec) for i in range(sources_count)]
+    for source in bench_sources:
+        if not source.start():
+            logger.error(f"Cannot open {spec}")
+            for opened in bench_sources:
+                remove_source(opened.source_id)
+            return None
+    
+    stop = threading.Event()
+    readers = []
+    
+    # One simulated viewer: pull frames through generate() like the HTTP response would
+    def consume(source, tier_key, stats):
+        frames = generate(source, tier_key)
+        last = None
+        try:
+            for chunk in frames:
+                now = time.perf_counter()
+                if stats['measuring']:
+                    stats['frames'] += 1
+                    stats['bytes'] += len(chunk)
+                    if last is not None:
+                        stats['gaps'].append(now - last)
+                last = now
+                if stop.is_set():
+                    break
+        finally:
+            frames.close()
+    
+    for i in range(consumers):
+        source = bench_sources[i % len(bench_sources)]
+        size, _, rest = tiers[i % len(tiers)].partition(':')
+        quality, _, max_fps = rest.partition(':')
+        stats = {"source": source.source_id, "tier": stream_tier_key(size, quality, max_fps),
+                 "frames": 0, "bytes": 0, "gaps": [], "measuring": False}
+        thread = threading.Thread(target=consume, args=(source, stats['tier'], stats), daemon=True)
+        thread.start()
+        readers.append((thread, stats))
+    
+    time.sleep(warmup)
+    metrics.reset()
+    baseline = {s.source_id: (s.captured, s.processed) for s in bench_sources}
+    for _, stats in readers:
+        stats['measuring'] = True
+    cpu_start, _, _ = process_usage()
+    wall_start = time.perf_counter()
+    time.sleep(duration)
+    elapsed = time.perf_counter() - wall_start
+    cpu_end, rss_mb, peak_rss_mb = process_usage()
+    for _, stats in readers:
+        stats['measuring'] = False
+    
+    captured = sum(s.captured - baseline[s.source_id][0] for s in bench_sources)
+    processed = sum(s.processed - baseline[s.source_id][1] for s in bench_sources)
+    consumer_reports = []
+    for _, stats in readers:
+        gaps = np.array(stats['gaps']) * 1e3
+        consumer_reports.append({
+            "source": stats['source'],
+            "tier": list(stats['tier']),
+            "fps": round(stats['frames'] / elapsed, 2),
+            "mbit_per_s": round(stats['bytes'] * 8 / elapsed / 1e6, 3),
+            "frame_gap_p50_ms": round(float(np.percentile(gaps, 50)), 3) if len(gaps) else None,
+            "frame_gap_p99_ms": round(float(np.percentile(gaps, 99)), 3) if len(gaps) else None,
+        })
+    
+    try:
+        import subprocess
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    
+    report = {
+        "commit": commit,
+        "config": {
+            "source": spec, "sources": sources_count, "consumers": consumers, "tiers": list(tiers),
+            "duration_s": round(elapsed, 3), "warmup_s": warmup, "backend": config['backend'],
+            "imgsz": config['imgsz'], "workers": config['workers'], "max_batch": config['max_batch'],
+            "detection_stride": config['detection_stride'], "jpeg_encoder": get_jpeg_encoder().name,
+            "client_overlay": config['client_overlay'], "cpu_count": os.cpu_count(),
+        },
+        "model_load_s": round(model_load_s, 3),
+        "throughput": {
+            "capture_fps": round(captured / elapsed, 2),
+            "processed_fps": round(processed / elapsed, 2),
+            "consumer_fps_mean": round(float(np.mean([c['fps'] for c in consumer_reports])), 2) if consumer_reports else 0.0,
+        },
+        "latency_ms": metrics.stage_summary(),
+        "dropped": {s.source_id: dict({name: slot.stats()['dropped'] for name, slot in s.slots.items()},
+                                      stale=s.stale_dropped) for s in bench_sources},
+        "consumers": consumer_reports,
+        "cpu_percent": round((cpu_end - cpu_start) / elapsed * 100, 1),
+        "rss_mb": round(rss_mb, 1),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }
+    
+    stop.set()
+    for thread, _ in readers:
+        thread.join(timeout=2.0)
+    for source in bench_sources:
+        remove_source(source.source_id)
+    
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + "\n")
+        logger.info(f"Wrote benchmark results to {output}")
+    print(text)
+    return report
+
+# Offline batch processing of archived footage
+# Throughput of a capture node against 1..N inference servers, each a
+# serve-inference process on this machine with its share of the cores, to
+# check that adding servers scales. Several threads keep synthetic frames in
+# flight, as the scheduler does with many sources. Local fallback is off so
+# only the servers are measured.
+def benchmark_distributed(servers=2, base_port=6100, clients=8, duration=10.0):
+    import subprocess
+    addresses = [('127.0.0.1', base_port + i) for i in range(servers)]
+    threads = config['intra_op_threads'] or max((os.cpu_count() or 1) // servers, 1)
+    command = [sys.executable, os.path.abspath(__file__), '--backend', config['backend'], '--weights', config['weights'],
+               '--imgsz', str(config['imgsz']), '--quantize', config['quantize'], '--max-batch', str(config['max_batch']),
+               '--intra-threads', str(threads)] + (['--offline'] if config['offline'] else [])
+    processes = [subprocess.Popen(command + ['serve-inference', '--listen', f"{host}:{port}"]) for host, port in addresses]
+    saved = {key: config[key] for key in ('remote_servers', 'remote_fallback')}
+    frame = synthetic_frame()
+    report = {"clients": clients, "threads_per_server": threads, "servers": {}}
+    try:
+        # A server listens once its model is loaded
+        for (host, port), process in zip(addresses, processes):
+            deadline = time.monotonic() + 300
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"Inference server on port {port} exited")
+                try:
+                    socket.create_connection((host, port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"Inference server on port {port} did not start")
+                    time.sleep(0.5)
+        
+        for count in range(1, servers + 1):
+            config.update(remote_servers=addresses[:count], remote_fallback=False)
+            pool = RemoteInferencePool(addresses[:count])
+            pool.conf, pool.iou, pool.max_det = 0.45, 0.45, 50
+            pool.infer_batch([frame] * count)
+            latencies, errors = [], []
+            stop = threading.Event()
+            
+            def client():
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    try:
+                        pool.infer_batch([frame])
+                    except Exception as e:
+                        errors.append(str(e))
+                        continue
+                    latencies.append(time.perf_counter() - start)
+            
+            workers = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            time.sleep(duration)
+            stop.set()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            
+            latency_ms = np.array(latencies) * 1e3 if latencies else np.zeros(1)
+            report["servers"][count] = {
+                "fps": round(len(latencies) / elapsed, 2),
+                "latency_p50_ms": round(float(np.percentile(latency_ms, 50)), 2),
+                "latency_p99_ms": round(float(np.percentile(latency_ms, 99)), 2),
+                "errors": len(errors),
+                "sent_per_server": [server.sent for server in pool.servers],
+            }
+            report["servers"][count]["speedup"] = round(report["servers"][count]["fps"] / max(report["servers"][1]["fps"], 1e-9), 2)
+            logger.info(f"{count} server(s): {report['servers'][count]}")
+            pool.close()
+    finally:
+        config.update(saved)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+    
+    print(json.dumps({"distributed": report}, indent=2))
+    return report
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v', '.mpg', '.mpeg', '.ts')
+
+# Expand files and directories (searched recursively) into a sorted video list
+def collect_videos(inputs):
+    videos = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, names in os.walk(item):
+                videos.extend(os.path.join(root, name) for name in names
+                              if name.lower().endswith(VIDEO_EXTENSIONS))
+        elif os.path.isfile(item):
+            videos.append(item)
+        else:
+            logger.error(f"Skipping missing input {item}")
+    return sorted(dict.fromkeys(videos))
+
+# One input video: its outputs, tracker and resumable progress. Progress is
+# checkpointed as the next frame to process plus the length of the
+# detections file at that point, so a resumed run truncates any lines
+# written after the last checkpoint and continues from there. A video
+# writer cannot be appended to, so a resumed run starts a new segment file.
+class VideoJob:
+    def __init__(self, path, output_dir, stride, write_video, write_detections, restart=False):
+        self.path = path
+        self.stride = stride
+        self.write_video = write_video
+        self.write_detections = write_detections
+        stem = os.path.splitext(os.path.basename(path))[0]
+        self.prefix = os.path.join(output_dir, stem)
+        self.progress_path = self.prefix + '.progress.json'
+        self.tracker = ObjectTracker()
+        self.writer = None
+        self.detections_file = None
+        self.fps = 30.0
+        self.processed = 0
+        self.last_checkpoint = time.monotonic()
+        
+        progress = {}
+        if not restart and os.path.exists(self.progress_path):
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+            if progress.get('stride') != stride:
+                logger.warning(f"{path}: stride changed since the last run, starting over")
+                progress = {}
+        self.complete = progress.get('complete', False)
+        self.next_frame = progress.get('next_frame', 0)
+        self.detections_bytes = progress.get('detections_bytes', 0)
+
+    def open_outputs(self, fps):
+        self.fps = fps
+        if self.write_detections:
+            path = self.prefix + '.detections.jsonl'
+            if self.next_frame and os.path.exists(path):
+                self.detections_file = open(path, 'r+')
+                self.detections_file.truncate(self.detections_bytes)
+                self.detections_file.seek(self.detections_bytes)
+            else:
+                self.detections_file = open(path, 'w')
+                meta = dict(detection_stream_meta(), source=self.path, fps=fps, stride=self.stride)
+                self.detections_file.write(json.dumps({"meta": meta}) + "\n")
+
+    def write(self, index, frame, detections):
+        detections = self.tracker.update(frame, detections, index)
+        if self.detections_file is not None:
+            height, width = frame.shape[:2]
+            message = DetectionMessage(index, index / self.fps, width, height, detections)
+            self.detections_file.write(message.to_json() + "\n")
+        if self.write_video:
+            if self.writer is None:
+                suffix = '' if self.next_frame == 0 else f'.from{index}'
+                self.writer = cv2.VideoWriter(f"{self.prefix}.annotated{suffix}.mp4", cv2.VideoWriter_fourcc(*'mp4v'),
+                                              self.fps / self.stride, (frame.shape[1], frame.shape[0]))
+            self.writer.write(draw_detections(frame, detections))
+        self.processed += 1
+        self.next_frame = index + self.stride
+        if time.monotonic() - self.last_checkpoint > 2.0:
+            self.checkpoint()
+
+    def checkpoint(self, complete=False):
+        self.last_checkpoint = time.monotonic()
+        if self.detections_file is not None:
+            self.detections_file.flush()
+            os.fsync(self.detections_file.fileno())
+            self.detections_bytes = self.detections_file.tell()
+        self.complete = complete
+        progress = {"source": self.path, "stride": self.stride, "next_frame": self.next_frame,
+                    "detections_bytes": self.detections_bytes, "complete": complete}
+        # Write then rename so a crash never leaves a torn progress file
+        with open(self.progress_path + '.tmp', 'w') as f:
+            json.dump(progress, f)
+        os.replace(self.progress_path + '.tmp', self.progress_path)
+
+    def close(self, complete=False):
+        self.checkpoint(complete)
+        if self.detections_file is not None:
+            self.detections_file.close()
+            self.detections_file = None
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+# Decoder thread: take jobs off the queue and push every stride-th frame of
+# each video. Skipped frames are only grabbed, never decoded. The frame
+# queue is bounded so decoding cannot run ahead of inference; (job, None,
+# None) marks the end of a video.
+def decode_videos(jobs, frames, stop):
+    while not stop.is_set():
+        try:
+            job = jobs.get_nowait()
+        except queue.Empty:
+            return
+        capture = cv2.VideoCapture(job.path)
+        if not capture.isOpened():
+            logger.error(f"Cannot open {job.path}")
+            frames.put((job, None, None))
+            continue
+        job.open_outputs(capture.get(cv2.CAP_PROP_FPS) or 30.0)
+        index = job.next_frame
+        if index:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+        buffer = None
+        while not stop.is_set():
+            if index % job.stride:
+                if not capture.grab():
+                    break
+                index += 1
+                continue
+            target = frame_pool.acquire(buffer.array.shape) if buffer is not None else None
+            success, frame = capture.read(target.array if target is not None else None)
+            if not success:
+                if target is not None:
+                    target.release()
+                break
+            if target is None or frame is not target.array:
+                if target is not None:
+                    target.release()
+                target = frame_pool.adopt(frame)
+            buffer = target
+            frames.put((job, index, target))
+            index += 1
+        capture.release()
+        frames.put((job, None, None))
+
+# Run detection over video files or directories of videos and write annotated
+# videos and/or per-frame detections (JSON lines in the /detections format)
+def process_videos(inputs, output_dir='output', stride=1, batch_size=None, decoders=2,
+                   write_video=True, write_detections=True, restart=False):
+    if not check_model_file() or ensure_model() is None:
+        return None
+    videos = collect_videos(inputs)
+    if not videos:
+        logger.error("No input videos found")
+        return None
+    os.makedirs(output_dir, exist_ok=True)
+    batch_size = batch_size or config['max_batch']
+    
+    jobs = queue.Queue()
+    all_jobs = []
+    for path in videos:
+        job = VideoJob(path, output_dir, stride, write_video, write_detections, restart)
+        if job.complete:
+            logger.info(f"Skipping {path}: already processed")
+            continue
+        jobs.put(job)
+        all_jobs.append(job)
+    
+    frames = queue.Queue(maxsize=batch_size * 4)
+    stop = threading.Event()
+    threads = [threading.Thread(target=decode_videos, args=(jobs, frames, stop), daemon=True)
+               for _ in range(min(decoders, len(all_jobs)))]
+    cpu_start, _, _ = process_usage()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    
+    pending = len(all_jobs)
+    failed = False
+    total = 0
+    try:
+        while pending:
+            # Block for one frame, then batch whatever else is already decoded
+            batch = [frames.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(frames.get_nowait())
+                except queue.Empty:
+                    break
+            
+            items = [item for item in batch if item[1] is not None]
+            finished = [job for job, index, _ in batch if index is None]
+            if items:
+                layouts = [get_tile_layout(buffer.array.shape, config['roi']) if uses_layout(config['roi']) else None
+                           for _, _, buffer in items]
+                results = infer_layout_batch([buffer.array for _, _, buffer in items], [None] * len(items), layouts)
+                if results is None:
+                    failed = True
+                    break
+                for (job, index, buffer), detections in zip(items, results):
+                    try:
+                        job.write(index, buffer.array, detections)
+                    finally:
+                        buffer.release()
+                total += len(items)
+            
+            # End markers trail their video's frames, so close only after writing
+            for job in finished:
+                job.close(complete=True)
+                pending -= 1
+                logger.info(f"Finished {job.path} ({job.processed} frames this run)")
+            if items and total // 500 != (total - len(items)) // 500:
+                elapsed = time.perf_counter() - started
+                logger.info(f"Processed {total} frames ({total / elapsed:.1f} FPS)")
+    except KeyboardInterrupt:
+        logger.info("Interrupted, saving progress")
+        failed = True
+    finally:
+        stop.set()
+        # Unblock decoders waiting on a full queue, then save partial progress
+        while any(thread.is_alive() for thread in threads):
+            try:
+                frames.get(timeout=0.1)[2].release()
+            except (queue.Empty, AttributeError):
+                pass
+        for job in all_jobs:
+            if not job.complete:
+                job.close()
+    
+    elapsed = time.perf_counter() - started
+    cpu_end, _, _ = process_usage()
+    cpu_seconds = cpu_end - cpu_start
+    report = {
+        "videos": len(videos),
+        "processed_videos": sum(job.complete for job in all_jobs),
+        "frames": total,
+        "stride": stride,
+        "batch_size": batch_size,
+        "decoders": len(threads),
+        "wall_s": round(elapsed, 3),
+        "fps": round(total / elapsed, 2) if elapsed else 0.0,
+        "cpu_s": round(cpu_seconds, 3),
+        "cores_busy": round(cpu_seconds / elapsed, 2) if elapsed else 0.0,
+        # Frames per CPU-second: what one fully used core sustains
+        "fps_per_core": round(total / cpu_seconds, 2) if cpu_seconds else 0.0,
+        "complete": not failed,
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+# Parse command line arguments
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="YOLOv5 real-time object detection server")
+    parser.add_argument('--host', default='0.0.0.0', help="Interface to bind the server to")
+    parser.add_argument('--port', type=int, default=5000, help="Port to serve on")
+    parser.add_argument('--backend', choices=INFERENCE_BACKENDS + ('auto',), default=config['backend'],
+                        help="Inference backend; auto picks the first exported graph found next to the weights")
+    parser.add_argument('--offline', action='store_true', help="Load the yolov5 hub code from the local cache only")
+    parser.add_argument('--warmup-runs', type=int, default=config['warmup_runs'], help="Warm-up inferences at boot (0 = load the model on first use)")
+    parser.add_argument('--weights', default=config['weights'], help="YOLOv5 .pt weights (exported artifacts are found next to it)")
+    parser.add_argument('--imgsz', type=int, default=config['imgsz'], help="Network input size for exported backends")
+    parser.add_argument('--quantize', choices=QUANTIZE_MODES, default=config['quantize'], help="Load the INT8 ONNX graph made by export --quantize (onnx backend)")
+    parser.add_argument('--channels-last', action='store_true', help="Run the torch and torchscript backends in NHWC memory format")
+    parser.add_argument('--intra-threads', type=int, default=config['intra_op_threads'], help="Threads per operator (0 = runtime default)")
+    parser.add_argument('--inter-threads', type=int, default=config['inter_op_threads'], help="Threads running independent operators (0 = runtime default)")
+    parser.add_argument('--inference-cores', default='', metavar='LIST', help="Pin inference to these cores, e.g. 0-3; other threads use the rest")
+    parser.add_argument('--detect-every', type=int, default=config['detection_stride'], help="Run YOLO every N frames and track objects in between")
+    parser.add_argument('--optical-flow', action='store_true', help="Refine tracked boxes with sparse optical flow")
+    parser.add_argument('--motion-gate', action='store_true', help="Skip inference while the scene is static")
+    parser.add_argument('--motion-threshold', type=float, default=config['motion_threshold'], help="Fraction of changed pixels that triggers inference")
+    parser.add_argument('--motion-refresh', type=float, default=config['motion_refresh'], help="Seconds between forced inferences on a static scene")
+    parser.add_argument('--camera', default=config['camera'], help="Source opened by Start Camera: device index, video file, image directory or fake:VIDEO")
+    parser.add_argument('--source', action='append', default=[], metavar='ID=SOURCE', help="Extra source served at /video_feed/ID (repeatable)")
+    parser.add_argument('--max-batch', type=int, default=config['max_batch'], help="Most frames per batched model call")
+    parser.add_argument('--fps-cap', type=float, default=config['source_fps_cap'], help="Per-source inference FPS cap (0 = uncapped)")
+    parser.add_argument('--client-overlay', action='store_true', help="Stream raw frames and let browsers draw boxes from /detections/stream")
+    parser.add_argument('--workers', type=int, default=config['workers'], help="Inference worker processes fed through shared memory (0 = in-process)")
+    parser.add_argument('--server', choices=('flask', 'asgi'), default=config['server'], help="Serve with threaded Flask or the asyncio ASGI app (needs uvicorn)")
+    parser.add_argument('--max-clients', type=int, default=config['max_clients'], help="Concurrent stream clients accepted by the ASGI server")
+    parser.add_argument('--jpeg-encoder', choices=tuple(JPEG_ENCODERS), default=config['jpeg_encoder'], help="JPEG encoder for the video stream")
+    parser.add_argument('--jpeg-quality', type=int, default=config['jpeg_quality'], help="JPEG quality of the default stream tier")
+    parser.add_argument('--max-tiers', type=int, default=config['max_tiers'], help="Distinct size/quality/fps stream tiers per source")
+    parser.add_argument('--tile-size', type=int, default=config['tile_size'], help="Run the detector on overlapping tiles of this size (0 = whole frame)")
+    parser.add_argument('--tile-overlap', type=float, default=config['tile_overlap'], help="Fraction of a tile shared with its neighbour")
+    parser.add_argument('--no-tile-full-frame', action='store_true', help="Skip the extra whole-frame pass when tiling")
+    parser.add_argument('--target-fps', type=float, default=config['target_fps'], help="Adapt quality to hold this inference FPS (0 = off)")
+    parser.add_argument('--target-latency-ms', type=float, default=config['target_latency_ms'], help="Adapt quality to hold this p99 latency (0 = off)")
+    parser.add_argument('--pin', action='append', default=[], metavar='KNOB[=VALUE]',
+                        help="Keep the controller off a knob: detection_stride, inference_size, stream_scale or stream_quality")
+    parser.add_argument('--capture-api', choices=tuple(CAPTURE_APIS), default=config['capture_api'], help="OpenCV backend for devices and streams")
+    parser.add_argument('--capture-buffer', type=int, default=config['capture_buffer_size'], help="Frames the driver may queue for a live device")
+    parser.add_argument('--capture-fourcc', default=config['capture_fourcc'], help="Pixel format requested from live devices ('' = driver default)")
+    parser.add_argument('--capture-size', default='', metavar='WIDTHxHEIGHT', help="Resolution requested from live devices")
+    parser.add_argument('--capture-fps', type=float, default=config['capture_fps'], help="Frame rate requested from live devices (0 = driver default)")
+    parser.add_argument('--record', action='append', default=[], metavar='CLASS[:CONFIDENCE[:DWELL]]',
+                        help="Record a clip when CLASS is seen at CONFIDENCE for DWELL seconds (repeatable)")
+    parser.add_argument('--record-dir', default=config['record_dir'], help="Where recorded clips are written")
+    parser.add_argument('--pre-roll', type=float, default=config['pre_roll'], help="Seconds saved before a trigger")
+    parser.add_argument('--post-roll', type=float, default=config['post_roll'], help="Seconds recorded after the last trigger")
+    parser.add_argument('--record-max-mb', type=float, default=config['record_max_bytes'] / 2**20, help="Disk budget for clips; oldest are evicted")
+    parser.add_argument('--history-dir', default=config['history_dir'], help="Keep a queryable detection history here (/history/...)")
+    parser.add_argument('--history-interval', type=float, default=config['history_interval'], help="Seconds between frames logged per source (0 = all)")
+    parser.add_argument('--overlay-text', action='append', default=[], metavar='TEXT', help="Extra static text line on every frame (repeatable)")
+    parser.add_argument('--remote', action='append', default=[], metavar='HOST:PORT',
+                        help="Send frames to this inference server (repeatable) instead of running the model here")
+    parser.add_argument('--remote-in-flight', type=int, default=config['remote_max_in_flight'], help="Requests outstanding per inference server")
+    parser.add_argument('--remote-timeout', type=float, default=config['remote_timeout'], help="Seconds to wait for an inference server reply")
+    parser.add_argument('--remote-quality', type=int, default=config['remote_quality'], help="JPEG quality of frames sent to inference servers")
+    parser.add_argument('--no-local-fallback', action='store_true', help="Never run the model locally when no inference server responds")
+    parser.add_argument('--roi', action='append', default=[], metavar='"X,Y X,Y X,Y ..."',
+                        help="ROI polygon in normalized coordinates (repeatable); areas outside every ROI are not processed")
+    commands = parser.add_subparsers(dest='command')
+    
+    export = commands.add_parser('export', help="Export the weights for the torchscript/onnx/openvino backends")
+    export.add_argument('--weights', default=config['weights'], help="YOLOv5 .pt weights to export")
+    export.add_argument('--formats', nargs='*', choices=INFERENCE_BACKENDS[1:], default=list(INFERENCE_BACKENDS[1:]),
+                        help="Formats to export (none: only quantize an already exported ONNX graph)")
+    export.add_argument('--imgsz', type=int, default=config['imgsz'], help="Export input size")
+    export.add_argument('--quantize', dest='quantize_modes', nargs='+', choices=QUANTIZE_MODES[1:], default=[],
+                        help="Also write INT8 ONNX graphs (static needs --calibration)")
+    export.add_argument('--calibration', help="Directory of sample images for static quantization")
+    export.add_argument('--calibration-images', type=int, default=100, help="Most calibration images used")
+    
+    bench = commands.add_parser('bench-postprocess', help="Benchmark detection post-processing paths")
+    bench.add_argument('--counts', type=int, nargs='+', default=[0, 10, 50], help="Detection counts per frame")
+    bench.add_argument('--repeat', type=int, default=2000, help="Iterations per measurement")
+    
+    process = commands.add_parser('process', help="Run detection over video files offline")
+    process.add_argument('inputs', nargs='+', help="Video files or directories of videos")
+    process.add_argument('--output-dir', default='output', help="Where annotated videos, detections and progress go")
+    process.add_argument('--stride', type=int, default=1, help="Process every Nth frame")
+    process.add_argument('--batch', type=int, default=None, help="Frames per model call (default: --max-batch)")
+    process.add_argument('--decoders', type=int, default=2, help="Videos decoded in parallel")
+    process.add_argument('--no-video', action='store_true', help="Skip the annotated video output")
+    process.add_argument('--no-detections', action='store_true', help="Skip the detections file")
+    process.add_argument('--restart', action='store_true', help="Ignore saved progress and start every video over")
+    
+    bench_pipeline = commands.add_parser('bench-pipeline', help="Benchmark the full pipeline headless with simulated viewers")
+    bench_pipeline.add_argument('--source', dest='bench_source', default='synthetic:1280x720?fps=30',
+                                help="Frame source: synthetic:WxH[?fps=N&objects=N] or a video file")
+    bench_pipeline.add_argument('--sources', type=int, default=1, help="Copies of the source run side by side")
+    bench_pipeline.add_argument('--consumers', type=int, default=1, help="Simulated /video_feed viewers")
+    bench_pipeline.add_argument('--tiers', nargs='+', default=['0'], help="Viewer tiers as SIZE[:QUALITY[:MAX_FPS]], assigned round-robin")
+    bench_pipeline.add_argument('--duration', type=float, default=10.0, help="Measured seconds")
+    bench_pipeline.add_argument('--warmup', type=float, default=2.0, help="Seconds run before measuring")
+    bench_pipeline.add_argument('--output', help="Also write the JSON report to this file")
+    
+    bench_tiles = commands.add_parser('bench-tiles', help="Compare whole-frame and tiled inference on an image set")
+    bench_tiles.add_argument('images', help="Directory of images, with optional YOLO-format label files")
+    bench_tiles.add_argument('--sizes', type=int, nargs='+', default=[0, 640], help="Tile sizes to compare (0 = whole frame)")
+    bench_tiles.add_argument('--overlap', type=float, default=config['tile_overlap'], help="Tile overlap")
+    bench_tiles.add_argument('--repeat', type=int, default=1, help="Passes over the image set per configuration")
+    
+    bench_jpeg = commands.add_parser('bench-jpeg', help="Benchmark the available JPEG encoders against cv2.imencode")
+    bench_jpeg.add_argument('--image', help="Frame to encode (default: a synthetic 1280x720 scene)")
+    bench_jpeg.add_argument('--sizes', type=int, nargs='+', default=[0, 640, 320], help="Tier widths to encode (0 = native)")
+    bench_jpeg.add_argument('--qualities', type=int, nargs='+', default=[95, 75, 50], help="JPEG qualities to encode")
+    bench_jpeg.add_argument('--repeat', type=int, default=100, help="Iterations per measurement")
+    
+    bench_overlay = commands.add_parser('bench-overlay', help="Benchmark overlay drawing against per-element cv2.putText")
+    bench_overlay.add_argument('--static', type=int, nargs='+', default=[2, 8, 24], help="Static text layers per frame")
+    bench_overlay.add_argument('--repeat', type=int, default=200, help="Iterations per measurement")
+    
+    serve_inference = commands.add_parser('serve-inference', help="Serve inference to capture nodes started with --remote")
+    serve_inference.add_argument('--listen', default='0.0.0.0:6000', metavar='HOST:PORT', help="Address to accept capture nodes on")
+    
+    bench_distributed = commands.add_parser('bench-distributed', help="Measure capture-node throughput against 1..N local inference servers")
+    bench_distributed.add_argument('--servers', type=int, default=2, help="Most inference server processes to start")
+    bench_distributed.add_argument('--port', dest='base_port', type=int, default=6100, help="Port of the first server")
+    bench_distributed.add_argument('--clients', type=int, default=8, help="Threads sending frames, like sources on a capture node")
+    bench_distributed.add_argument('--duration', type=float, default=10.0, help="Measured seconds per server count")
+    
+    bench_cpu = commands.add_parser('bench-cpu', help="Compare CPU inference configurations for accuracy and speed on an image set")
+    bench_cpu.add_argument('images', help="Directory of images, with optional YOLO-format label files")
+    bench_cpu.add_argument('--configs', nargs='+', metavar='BACKEND[:OPTIONS]',
+                           default=['torch', 'torch:channels-last', 'onnx', 'onnx:int8-dynamic', 'onnx:int8-static'],
+                           help=f"Configurations; options are {', '.join(CPU_OPTIONS)}. The first is the accuracy baseline")
+    bench_cpu.add_argument('--threads', type=int, nargs='+', default=[0], help="Intra-op thread counts to try (0 = runtime default)")
+    bench_cpu.add_argument('--max-map-drop', type=float, default=0.01, help="mAP@0.5 the recommended configuration may lose")
+    bench_cpu.add_argument('--repeat', type=int, default=1, help="Passes over the image set per configuration")
+    return parser.parse_args(argv)
+
+# Start the web server
+def run_server(args):
     create_template()
     ip_address = get_ip_address()
     logger.info("Starting YOLOv5 object detection server...")
     logger.info(f"Server IP address: {ip_address}")
-    logger.info("Using pre-downloaded yolov5s.pt model")
-    logger.info(f"Access the interface at http://{ip_address}:5000")
+    logger.info(f"Using pre-downloaded {config['weights']} model with the {config['backend']} backend "
+                f"(imports took {import_seconds:.2f}s)")
+    logger.info(f"Access the interface at http://{ip_address}:{args.port}")
     logger.info("Other devices on the same network can access this interface using the same URL")
     
+    if config['history_dir']:
+        detection_history.start()
+    
+    # Load and warm the model in the background while the server comes up
+    if config['warmup_runs'] <= 0:
+        # The model loads on first use instead
+        startup.enter('ready')
+    elif check_model_file():
+        batch_sizes = sorted({1, min(len(args.source) + 1, config['max_batch'])})
+        threading.Thread(target=warm_up_model, args=(batch_sizes,), name="warm_up_model", daemon=True).start()
+    else:
+        startup.fail(f"Missing {engine_artifact(config['backend'], config['weights'])}")
+    
+    # Start the sources given on the command line
+    for item in args.source:
+        source_id, _, spec = item.partition('=')
+        if not spec:
+            logger.error(f"Ignoring --source {item}: expected ID=SOURCE")
+            continue
+        if check_model_file():
+            add_source(source_id, spec).start()
+    
+    if config['server'] == 'asgi':
+        # One event loop serves every stream; uvicorn is only needed for this mode
+        import uvicorn
+        uvicorn.run(asgi_app, host=args.host, port=args.port, log_level='warning')
+        return
+    
     # Run the Flask app, binding to all network interfaces
-    app.run(debug=False, host='0.0.0.0', port=5000, threaded=True)
+    app.run(debug=False, host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    args = parse_args()
+    config.update(backend=resolve_backend(args.backend, args.weights), weights=args.weights, imgsz=args.imgsz,
+                  offline=args.offline, warmup_runs=max(args.warmup_runs, 0),
+                  detection_stride=max(args.detect_every, 1), optical_flow=args.optical_flow,
+                  motion_gate=args.motion_gate, motion_threshold=args.motion_threshold,
+                  motion_refresh=args.motion_refresh, camera=args.camera,
+                  max_batch=max(args.max_batch, 1), source_fps_cap=args.fps_cap,
+                  workers=max(args.workers, 0), client_overlay=args.client_overlay,
+                  server=args.server, max_clients=max(args.max_clients, 1),
+                  jpeg_encoder=args.jpeg_encoder, jpeg_quality=min(max(args.jpeg_quality, 10), 100),
+                  max_tiers=max(args.max_tiers, 1), tile_size=max(args.tile_size, 0),
+                  tile_overlap=min(max(args.tile_overlap, 0.0), 0.9), tile_full_frame=not args.no_tile_full_frame,
+                  roi=parse_roi([[point.split(',') for point in polygon.split()] for polygon in args.roi]),
+                  target_fps=max(args.target_fps, 0.0), target_latency_ms=max(args.target_latency_ms, 0.0),
+                  capture_api=args.capture_api, capture_buffer_size=max(args.capture_buffer, 0),
+                  capture_fourcc=args.capture_fourcc, capture_fps=max(args.capture_fps, 0.0))
+    config.update(record_rules=[parse_record_rule(rule) for rule in args.record], record_dir=args.record_dir,
+                  pre_roll=max(args.pre_roll, 0.0), post_roll=max(args.post_roll, 0.0),
+                  record_max_bytes=int(args.record_max_mb * 2**20),
+                  history_dir=args.history_dir, history_interval=max(args.history_interval, 0.0),
+                  port=args.port, overlay_text=args.overlay_text)
+    config.update(quantize=args.quantize, channels_last=args.channels_last,
+                  intra_op_threads=max(args.intra_threads, 0), inter_op_threads=max(args.inter_threads, 0),
+                  inference_cores=parse_cpu_list(args.inference_cores))
+    config.update(remote_servers=[parse_address(address) for address in args.remote],
+                  remote_max_in_flight=max(args.remote_in_flight, 1), remote_timeout=max(args.remote_timeout, 0.1),
+                  remote_quality=min(max(args.remote_quality, 10), 100), remote_fallback=not args.no_local_fallback)
+    configure_cpu()
+    if args.capture_size:
+        width, _, height = args.capture_size.partition('x')
+        config.update(capture_width=int(width), capture_height=int(height))
+    for item in args.pin:
+        name, _, value = item.partition('=')
+        if name == 'inference_size' and value:
+            # No engine yet; the torch engine picks its input size up from imgsz
+            config['imgsz'] = int(value)
+            value = None
+        controller.pin(name, value or None)
+    if args.command == 'export':
+        if args.formats:
+            export_model(args.weights, args.formats, args.imgsz)
+        if args.quantize_modes:
+            quantize_model(args.weights, args.quantize_modes, args.calibration, args.imgsz, args.calibration_images)
+    elif args.command == 'bench-postprocess':
+        benchmark_postprocess(args.counts, args.repeat)
+    elif args.command == 'process':
+        process_videos(args.inputs, args.output_dir, max(args.stride, 1), args.batch, max(args.decoders, 1),
+                       not args.no_video, not args.no_detections, args.restart)
+    elif args.command == 'bench-pipeline':
+        benchmark_pipeline(args.bench_source, max(args.sources, 1), max(args.consumers, 0), args.tiers,
+                           args.duration, args.warmup, args.output)
+    elif args.command == 'bench-tiles':
+        benchmark_tiles(args.images, args.sizes, args.overlap, max(args.repeat, 1))
+    elif args.command == 'bench-jpeg':
+        benchmark_jpeg(args.image, args.sizes, args.qualities, args.repeat)
+    elif args.command == 'bench-overlay':
+        benchmark_overlay(args.static, args.repeat)
+    elif args.command == 'serve-inference':
+        run_inference_server(args.listen)
+    elif args.command == 'bench-distributed':
+        benchmark_distributed(max(args.servers, 1), args.base_port, max(args.clients, 1), args.duration)
+    elif args.command == 'bench-cpu':
+        benchmark_cpu(args.images, args.configs, args.threads, args.max_map_drop, max(args.repeat, 1))
+    else:
+        run_server(args)